@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import shutil
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchmarkInfo(dict):
+   """
+   INFO dictionary that counts assignments, i.e. the number of INFO updates (bcf_update_info calls) a cyvcf2 Variant would encode
+   """
+   num_updates = 0
+
+   def __setitem__(self, tag, value):
+      BenchmarkInfo.num_updates += 1
+      dict.__setitem__(self, tag, value)
+
+
+class BenchmarkRecord(object):
+   """
+   Minimal stand-in for a cyvcf2 Variant, with INFO as a dictionary
+   """
+   def __init__(self, info):
+      self.INFO = BenchmarkInfo(info)
+
+
+def __main__():
+   parser = argparse.ArgumentParser(description='Micro-benchmark of the per-record annotation hot path of annoutils (set_coding_change, threeToOneAA) on synthetic VEP consequences, reporting calls per second and INFO updates per record', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('--num_records', default=200000, type=int, help='Number of synthetic records')
+   parser.add_argument('--baseline_ref', help='git revision of annoutils.py to compare against (e.g. HEAD~1), results are also checked for equality')
+   parser.add_argument('--repeats', default=3, type=int, help='Number of timed runs per implementation (best run is reported)')
+   args = parser.parse_args()
+
+   records = synthetic_records(args.num_records)
+   implementations = [('current', os.path.join(repo_dir, 'src', 'gvanno', 'lib', 'annoutils.py'))]
+   tmp_dir = tempfile.mkdtemp(prefix='annoutils_benchmark.')
+   if not args.baseline_ref is None:
+      baseline_py = os.path.join(tmp_dir, 'annoutils_baseline.py')
+      f = open(baseline_py, 'wb')
+      f.write(subprocess.check_output(['git', '-C', repo_dir, 'show', str(args.baseline_ref) + ':src/gvanno/lib/annoutils.py']))
+      f.close()
+      implementations.append((str(args.baseline_ref), baseline_py))
+
+   rates = {}
+   results = {}
+   for label, module_py in implementations:
+      module = load_module('annoutils_' + str(len(rates)), module_py)
+      for benchmark in ['set_coding_change', 'threeToOneAA']:
+         best_seconds = None
+         for i in range(args.repeats):
+            if hasattr(module.threeToOneAA, 'cache_clear'):
+               module.threeToOneAA.cache_clear()
+            if hasattr(module, 'get_consequence_status'):
+               module.get_consequence_status.cache_clear()
+            if benchmark == 'set_coding_change':
+               recs = [BenchmarkRecord(info) for info in records]
+               BenchmarkInfo.num_updates = 0
+               start = time.time()
+               for rec in recs:
+                  module.set_coding_change(rec)
+            else:
+               hgvsp = [info['HGVSp'].split(':')[1] for info in records]
+               start = time.time()
+               protein_changes = [module.threeToOneAA(aa_change) for aa_change in hgvsp]
+            seconds = time.time() - start
+            if best_seconds is None or seconds < best_seconds:
+               best_seconds = seconds
+         if benchmark == 'set_coding_change':
+            results[(label, benchmark)] = [rec.INFO for rec in recs]
+         else:
+            results[(label, benchmark)] = protein_changes
+         rates[(label, benchmark)] = len(records) / best_seconds
+         print(str(label) + '\t' + str(benchmark) + ':\t' + str(len(records)) + ' calls in ' + str(round(best_seconds, 3)) + ' s\t' + str(round(rates[(label, benchmark)], 1)) + ' calls/s')
+         if benchmark == 'set_coding_change':
+            print(str(label) + '\t' + str(benchmark) + ':\t' + str(round(float(BenchmarkInfo.num_updates) / len(records), 2)) + ' INFO updates per record')
+   shutil.rmtree(tmp_dir)
+   if not args.baseline_ref is None:
+      for benchmark in ['set_coding_change', 'threeToOneAA']:
+         identical = results[('current', benchmark)] == results[(str(args.baseline_ref), benchmark)]
+         print(str(benchmark) + ' speedup:\t' + str(round(rates[('current', benchmark)] / rates[(str(args.baseline_ref), benchmark)], 2)) + 'x\t(identical results: ' + str(identical) + ')')
+
+
+def synthetic_records(num_records):
+   """
+   Function that generates INFO elements of picked VEP consequences, with the skewed repetition of consequences/protein changes seen in real callsets
+   """
+   rng = random.Random(1)
+   consequences = ['missense_variant','synonymous_variant','intron_variant','frameshift_variant','stop_gained','splice_donor_variant','splice_acceptor_variant&intron_variant',
+                   'missense_variant&splice_region_variant','inframe_deletion','upstream_gene_variant','3_prime_UTR_variant','stop_lost','start_lost','non_coding_transcript_exon_variant']
+   amino_acids = ['Ala','Arg','Asn','Asp','Cys','Glu','Gln','Gly','His','Ile','Leu','Lys','Met','Phe','Pro','Ser','Thr','Trp','Tyr','Val']
+   records = []
+   for i in range(num_records):
+      consequence = consequences[min(int(rng.expovariate(0.4)), len(consequences) - 1)]
+      position = rng.randint(1, 2000)
+      ref_aa, alt_aa = rng.choice(amino_acids), rng.choice(amino_acids)
+      hgvsp = 'p.' + ref_aa + str(position) + alt_aa
+      if consequence == 'frameshift_variant':
+         hgvsp = 'p.' + ref_aa + str(position) + alt_aa + 'fsTer' + str(rng.randint(1, 50))
+      elif consequence == 'stop_gained':
+         hgvsp = 'p.' + ref_aa + str(position) + 'Ter'
+      info = {'Consequence': consequence, 'HGVSc': 'ENST00000' + str(i % 5000) + '.1:c.' + str(position * 3) + 'A>G', 'Amino_acids': ref_aa[0] + '/' + alt_aa[0],
+              'Protein_position': str(position) + '/2000', 'HGVSp': 'ENSP00000' + str(i % 5000) + '.1:' + hgvsp, 'EXON': str(rng.randint(1, 20)) + '/20'}
+      records.append(info)
+   return records
+
+
+def load_module(module_name, module_py):
+   spec = importlib.util.spec_from_file_location(module_name, module_py)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+if __name__=="__main__": __main__()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo_dir, 'src', 'gvanno', 'lib'))
+
+
+def __main__():
+   parser = argparse.ArgumentParser(description='Benchmark gvanno-summarise (STEP 3 of gvanno) on a VEP/vcfanno-annotated VCF, e.g. <sample>.gvanno_ready.vep.vcfanno.vcf.gz, reporting records per second', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('query_vcf', help='Bgzipped VEP/vcfanno-annotated VCF file')
+   parser.add_argument('gvanno_db_dir', help='gvanno data directory (data/<assembly>)')
+   parser.add_argument('--lof_prediction', default=0, type=int, help='VEP LoF prediction setting (0/1)')
+   parser.add_argument('--baseline_ref', help='git revision of gvanno_summarise.py to compare against (e.g. HEAD~1)')
+   parser.add_argument('--repeats', default=3, type=int, help='Number of timed runs per implementation (best run is reported)')
+   args = parser.parse_args()
+
+   num_records = count_vcf_records(args.query_vcf)
+   implementations = [('current', os.path.join(repo_dir, 'src', 'gvanno', 'gvanno_summarise.py'))]
+   tmp_dir = tempfile.mkdtemp(prefix='summarise_benchmark.')
+   if not args.baseline_ref is None:
+      baseline_py = os.path.join(tmp_dir, 'gvanno_summarise_baseline.py')
+      f = open(baseline_py, 'wb')
+      f.write(subprocess.check_output(['git', '-C', repo_dir, 'show', str(args.baseline_ref) + ':src/gvanno/gvanno_summarise.py']))
+      f.close()
+      implementations.append((str(args.baseline_ref), baseline_py))
+
+   rates = {}
+   for label, module_py in implementations:
+      module = load_module('gvanno_summarise_' + str(len(rates)), module_py)
+      best_seconds = None
+      for i in range(args.repeats):
+         out_vcf = os.path.join(tmp_dir, 'benchmark.' + str(len(rates)) + '.annotated.vcf')
+         start = time.time()
+         module.extend_vcf_annotations(args.query_vcf, args.gvanno_db_dir, args.lof_prediction, out_vcf)
+         seconds = time.time() - start
+         if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+      rates[label] = num_records / best_seconds
+      print(str(label) + ':\t' + str(num_records) + ' records in ' + str(round(best_seconds, 2)) + ' s\t' + str(round(rates[label], 1)) + ' records/s')
+   shutil.rmtree(tmp_dir)
+   if not args.baseline_ref is None:
+      print('speedup:\t' + str(round(rates['current'] / rates[str(args.baseline_ref)], 2)) + 'x')
+
+
+def count_vcf_records(query_vcf):
+   num_records = 0
+   f = gzip.open(query_vcf, 'rt')
+   for line in f:
+      if not line.startswith('#'):
+         num_records += 1
+   f.close()
+   return num_records
+
+
+def load_module(module_name, module_py):
+   spec = importlib.util.spec_from_file_location(module_name, module_py)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+if __name__=="__main__": __main__()
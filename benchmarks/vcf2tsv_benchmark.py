@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def __main__():
+   parser = argparse.ArgumentParser(description='Benchmark vcf2tsv (STEP 4 of gvanno) on an annotated VCF, e.g. a WGS-sized <sample>_gvanno_<assembly>.vcf.gz, reporting records per second', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('query_vcf', help='Bgzipped gvanno-annotated VCF file')
+   parser.add_argument('--baseline_ref', help='git revision of vcf2tsv.py to compare against (e.g. HEAD~1)')
+   parser.add_argument('--repeats', default=3, type=int, help='Number of timed runs per implementation (best run is reported)')
+   args = parser.parse_args()
+
+   num_records = count_vcf_records(args.query_vcf)
+   implementations = [('current', os.path.join(repo_dir, 'src', 'gvanno', 'vcf2tsv.py'))]
+   tmp_dir = tempfile.mkdtemp(prefix='vcf2tsv_benchmark.')
+   if not args.baseline_ref is None:
+      baseline_py = os.path.join(tmp_dir, 'vcf2tsv_baseline.py')
+      f = open(baseline_py, 'wb')
+      f.write(subprocess.check_output(['git', '-C', repo_dir, 'show', str(args.baseline_ref) + ':src/gvanno/vcf2tsv.py']))
+      f.close()
+      implementations.append((str(args.baseline_ref), baseline_py))
+
+   rates = {}
+   for label, module_py in implementations:
+      module = load_module('vcf2tsv_' + str(len(rates)), module_py)
+      best_seconds = None
+      for i in range(args.repeats):
+         out_tsv = os.path.join(tmp_dir, 'benchmark.' + str(len(rates)) + '.tsv')
+         start = time.time()
+         module.vcf2tsv(args.query_vcf, out_tsv, False, False, True, False, False)
+         seconds = time.time() - start
+         if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+         os.remove(out_tsv)
+      rates[label] = num_records / best_seconds
+      print(str(label) + ':\t' + str(num_records) + ' records in ' + str(round(best_seconds, 2)) + ' s\t' + str(round(rates[label], 1)) + ' records/s')
+   shutil.rmtree(tmp_dir)
+   if not args.baseline_ref is None:
+      print('speedup:\t' + str(round(rates['current'] / rates[str(args.baseline_ref)], 2)) + 'x')
+
+
+def count_vcf_records(query_vcf):
+   num_records = 0
+   f = gzip.open(query_vcf, 'rt')
+   for line in f:
+      if not line.startswith('#'):
+         num_records += 1
+   f.close()
+   return num_records
+
+
+def load_module(module_name, module_py):
+   spec = importlib.util.spec_from_file_location(module_name, module_py)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+if __name__=="__main__": __main__()
@@ -10,18 +10,59 @@ import sys
 import getpass
 import platform
 import toml
+import concurrent.futures
+import atexit
+import glob
+import hashlib
+import json
+import struct
+import copy
+import math
+import time
+import itertools
+import threading
+import signal
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+## shared (cyvcf2-independent) utilities of the workflow scripts, e.g. annoutils.read_tabix_index
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'gvanno', 'lib'))
+import annoutils
 
 
-gvanno_version = '0.7.0'
+gvanno_version = '0.7.1'
 db_version = 'GVANNO_DB_VERSION = 20190204'
 vep_version = '95'
 global vep_assembly
 
+## approximate resident memory (MB) of the annotation steps, used to plan VEP forks/buffer size and vcfanno processes (get_resource_plan)
+vep_main_rss_mb = 700
+vep_fork_rss_mb = 400
+vep_lof_fork_rss_mb = 300
+vep_buffered_variant_rss_kb = 40
+vcfanno_proc_rss_mb = 150
+## minimum number of variants per VEP fork (in a buffer) and per vcfanno process, below which more forks/processes do not pay off
+vep_min_variants_per_fork = 500
+vcfanno_min_variants_per_proc = 5000
+## approximate resident memory (MB) of the other workflow stages, requested from the host-wide scheduler (see acquire_slots)
+validate_rss_mb = 2000
+summarise_proc_rss_mb = 500
+vcf2tsv_rss_mb = 1000
+## seconds between attempts to acquire slots from the host-wide scheduler
+scheduler_poll_interval = 5
+## processes of the workflow steps currently running (terminated, and no new steps started, once a shard has failed, see stop_workflow_steps)
+workflow_processes = set()
+workflow_processes_lock = threading.Lock()
+workflow_stopped = threading.Event()
+
 def __main__():
    
    parser = argparse.ArgumentParser(description='Germline variant annotation (gvanno) workflow for clinical and functional interpretation of germline nucleotide variants',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
    parser.add_argument('--input_vcf', dest = "input_vcf", help='VCF input file with somatic query variants (SNVs/InDels)')
    parser.add_argument('--force_overwrite', action = "store_true", help='The script will fail with an error if the output file already exists. Force the overwrite of existing result files by using this flag')
+   parser.add_argument('--resume', action = "store_true", help='Resume a previous (failed or modified) run of the same sample, skipping workflow stages whose inputs, settings and outputs (as recorded in the run manifest) are still valid')
+   parser.add_argument('--docker_session', action = "store_true", help='Run all workflow steps within a single, long-lived Docker container (docker exec) rather than starting a new container for each command')
    parser.add_argument('--version', action='version', version='%(prog)s ' + str(gvanno_version))
    parser.add_argument('gvanno_dir',help='gvanno base directory with accompanying data directory, e.g. ~/gvanno-0.2.0')
    parser.add_argument('output_dir',help='Output directory')
@@ -34,7 +75,7 @@ def __main__():
    args = parser.parse_args()
    
    overwrite = 0
-   if args.force_overwrite is True:
+   if args.force_overwrite is True or args.resume is True:
       overwrite = 1
       
    # check that script and Docker image version correspond
@@ -54,7 +95,7 @@ def __main__():
       gvanno_error_message(err_msg,logger)
    host_directories = verify_input_files(args.input_vcf, args.configuration_file, config_options, args.gvanno_dir, args.output_dir, args.sample_id, args.genome_assembly, overwrite, logger)
 
-   run_gvanno(host_directories, docker_image_version, config_options, args.sample_id, args.genome_assembly, gvanno_version)
+   run_gvanno(host_directories, docker_image_version, config_options, args.sample_id, args.genome_assembly, gvanno_version, args.docker_session, args.resume)
 
 
 def read_config_options(configuration_file, gvanno_dir, genome_assembly, logger):
@@ -70,6 +111,21 @@ def read_config_options(configuration_file, gvanno_dir, genome_assembly, logger)
    except(IndexError,TypeError):
       err_msg = 'Configuration file ' + str(configuration_file) + ' is not formatted correctly'
       gvanno_error_message(err_msg, logger)
+   ## options introduced after the data bundle was released (absent from the default configuration file)
+   gvanno_config_options['other'].setdefault('n_vcf_validation_proc', 1)
+   gvanno_config_options['other'].setdefault('vcf_validation_max_errors', 100)
+   gvanno_config_options['other'].setdefault('n_shards', 1)
+   gvanno_config_options['other'].setdefault('n_summarise_proc', 1)
+   gvanno_config_options['other'].setdefault('n_bgzf_threads', 1)
+   gvanno_config_options['other'].setdefault('annotation_cache', 0)
+   gvanno_config_options['other'].setdefault('annotation_cache_max_mb', 10240)
+   gvanno_config_options['other'].setdefault('annotation_streaming', 0)
+   gvanno_config_options['other'].setdefault('columnar_output', 'none')
+   gvanno_config_options['other'].setdefault('memory_limit_mb', 0)
+   gvanno_config_options['other'].setdefault('scheduler_dir', '')
+   gvanno_config_options['other'].setdefault('scheduler_cpu_slots', 0)
+   gvanno_config_options['other'].setdefault('scheduler_memory_mb', 0)
+   gvanno_config_options['other'].setdefault('scheduler_priority', 0)
 
    ## override with options set by the users
    try:
@@ -79,8 +135,10 @@ def read_config_options(configuration_file, gvanno_dir, genome_assembly, logger)
       gvanno_error_message(err_msg, logger)
    
    
-   boolean_tags = ['vep_skip_intergenic', 'vcf_validation', 'lof_prediction']
-   integer_tags = ['n_vcfanno_proc','n_vep_forks','buffer_size']
+   boolean_tags = ['vep_skip_intergenic', 'vcf_validation', 'lof_prediction', 'annotation_cache', 'annotation_streaming']
+   integer_tags = ['n_vcfanno_proc','n_vep_forks','buffer_size','n_shards','annotation_cache_max_mb','n_vcf_validation_proc','vcf_validation_max_errors','n_summarise_proc','n_bgzf_threads','memory_limit_mb','scheduler_cpu_slots','scheduler_memory_mb','scheduler_priority']
+   ## settings that can be resolved at run time from available resources (see get_resource_plan)
+   auto_tags = ['n_vcfanno_proc','n_vep_forks','buffer_size']
    for section in ['other']:
       if section in user_options:
          for t in boolean_tags:
@@ -91,11 +149,53 @@ def read_config_options(configuration_file, gvanno_dir, genome_assembly, logger)
                gvanno_config_options[section][t] = int(user_options[section][t])
          for t in integer_tags:
             if t in user_options[section]:
+               if t in auto_tags and user_options[section][t] == 'auto':
+                  gvanno_config_options[section][t] = 'auto'
+                  continue
                if not isinstance(user_options[section][t],int):
                   err_msg = 'Configuration value ' + str(user_options[section][t]) + ' for ' + str(t) + ' cannot be parsed properly (expecting integer)'
+                  if t in auto_tags:
+                     err_msg = 'Configuration value ' + str(user_options[section][t]) + ' for ' + str(t) + ' cannot be parsed properly (expecting integer or \'auto\')'
                   gvanno_error_message(err_msg, logger)
                gvanno_config_options[section][t] = user_options[section][t]
+         if 'columnar_output' in user_options[section]:
+            if not user_options[section]['columnar_output'] in ['none','parquet','arrow']:
+               err_msg = 'Configuration value ' + str(user_options[section]['columnar_output']) + ' for columnar_output cannot be parsed properly (expecting \'none\', \'parquet\' or \'arrow\')'
+               gvanno_error_message(err_msg, logger)
+            gvanno_config_options[section]['columnar_output'] = user_options[section]['columnar_output']
+         if 'scheduler_dir' in user_options[section]:
+            if not isinstance(user_options[section]['scheduler_dir'],str):
+               err_msg = 'Configuration value ' + str(user_options[section]['scheduler_dir']) + ' for scheduler_dir cannot be parsed properly (expecting a directory name)'
+               gvanno_error_message(err_msg, logger)
+            gvanno_config_options[section]['scheduler_dir'] = user_options[section]['scheduler_dir']
    
+   if gvanno_config_options['other']['n_shards'] < 1:
+      err_msg = 'Configuration value ' + str(gvanno_config_options['other']['n_shards']) + ' for n_shards must be a positive integer'
+      gvanno_error_message(err_msg, logger)
+   if gvanno_config_options['other']['n_vcf_validation_proc'] < 1:
+      err_msg = 'Configuration value ' + str(gvanno_config_options['other']['n_vcf_validation_proc']) + ' for n_vcf_validation_proc must be a positive integer'
+      gvanno_error_message(err_msg, logger)
+   if gvanno_config_options['other']['n_summarise_proc'] < 1:
+      err_msg = 'Configuration value ' + str(gvanno_config_options['other']['n_summarise_proc']) + ' for n_summarise_proc must be a positive integer'
+      gvanno_error_message(err_msg, logger)
+   if gvanno_config_options['other']['n_bgzf_threads'] < 1:
+      err_msg = 'Configuration value ' + str(gvanno_config_options['other']['n_bgzf_threads']) + ' for n_bgzf_threads must be a positive integer'
+      gvanno_error_message(err_msg, logger)
+   for t in auto_tags:
+      if gvanno_config_options['other'][t] != 'auto' and gvanno_config_options['other'][t] < 1:
+         err_msg = 'Configuration value ' + str(gvanno_config_options['other'][t]) + ' for ' + str(t) + ' must be a positive integer (or \'auto\')'
+         gvanno_error_message(err_msg, logger)
+   if gvanno_config_options['other']['memory_limit_mb'] < 0:
+      err_msg = 'Configuration value ' + str(gvanno_config_options['other']['memory_limit_mb']) + ' for memory_limit_mb must be a non-negative integer'
+      gvanno_error_message(err_msg, logger)
+   for t in ['scheduler_cpu_slots','scheduler_memory_mb']:
+      if gvanno_config_options['other'][t] < 0:
+         err_msg = 'Configuration value ' + str(gvanno_config_options['other'][t]) + ' for ' + str(t) + ' must be a non-negative integer'
+         gvanno_error_message(err_msg, logger)
+   if gvanno_config_options['other']['scheduler_dir'] != '' and fcntl is None:
+      err_msg = 'The host-wide scheduler (scheduler_dir) requires file locking (fcntl), which is not available on this platform (' + str(platform.system()) + ')'
+      gvanno_error_message(err_msg, logger)
+
    return gvanno_config_options
 
 
@@ -220,17 +320,40 @@ def verify_input_files(input_vcf, configuration_file, gvanno_config_options, bas
    
 
 def check_subprocess(command):
-   try:
-      output = subprocess.check_output(str(command), stderr=subprocess.STDOUT, shell=True)
-      if len(output) > 0:
-         print(str(output.decode()).rstrip())
-   except subprocess.CalledProcessError as e:
-      print(e.output.decode())
+   with workflow_processes_lock:
+      if workflow_stopped.is_set():
+         exit(1)
+      ## steps run on shards (in worker threads) get their own process group, so that the whole step (not only its shell) can be terminated
+      process = subprocess.Popen(str(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, start_new_session = threading.current_thread() is not threading.main_thread())
+      workflow_processes.add(process)
+   output = process.communicate()[0]
+   with workflow_processes_lock:
+      workflow_processes.discard(process)
+   if process.returncode != 0:
+      print(output.decode())
       exit(0)
+   if len(output) > 0:
+      print(str(output.decode()).rstrip())
+
+def stop_workflow_steps():
+   """
+   Function that terminates the workflow steps still running (in other threads), and prevents new steps from being started
+   """
+   with workflow_processes_lock:
+      workflow_stopped.set()
+      for process in workflow_processes:
+         if process.poll() is None:
+            try:
+               os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
+               process.terminate()
 
 def getlogger(logger_name):
    logger = logging.getLogger(logger_name)
    logger.setLevel(logging.DEBUG)
+   ## loggers are re-used across stages (and shards), only attach the console handler once
+   if len(logger.handlers) > 0:
+      return logger
 
    # create console handler and set level to debug
    ch = logging.StreamHandler(sys.stdout)
@@ -247,7 +370,577 @@ def getlogger(logger_name):
    
    return logger
 
-def run_gvanno(host_directories, docker_image_version, config_options, sample_id, genome_assembly, gvanno_version):
+def get_indexed_variant_count(tbi_file):
+   """
+   Function that returns the number of (mapped) variant records in a bgzipped VCF, as recorded in the pseudo-bins of its tabix index
+   Returns None if the index cannot be read
+   """
+   if not os.path.exists(tbi_file):
+      return None
+   try:
+      return sum([ref['n_mapped'] for ref in annoutils.read_tabix_index(tbi_file)])
+   except (IOError, OSError, EOFError, struct.error):
+      return None
+
+def get_available_cores():
+   """
+   Function that returns the number of CPU cores available to gvanno (and the Docker containers it starts)
+   """
+   if hasattr(os, 'sched_getaffinity'):
+      return len(os.sched_getaffinity(0))
+   return os.cpu_count() or 1
+
+def get_available_memory_mb(meminfo_key = 'MemAvailable'):
+   """
+   Function that returns the memory (MB) available for new processes without swapping (MemAvailable in /proc/meminfo, or another /proc/meminfo entry, e.g. MemTotal)
+   Returns None if not available on the underlying platform
+   """
+   if not os.path.exists('/proc/meminfo'):
+      return None
+   f = open('/proc/meminfo','r')
+   for line in f:
+      if line.startswith(str(meminfo_key) + ':'):
+         f.close()
+         return int(line.split()[1]) // 1024
+   f.close()
+   return None
+
+def get_projected_rss_mb(config_options):
+   """
+   Function that returns the approximate resident memory (MB) of VEP and vcfanno (tuple), given (resolved) n_vep_forks, buffer_size, n_vcfanno_proc and lof_prediction
+   """
+   fork_rss_mb = vep_fork_rss_mb
+   if config_options['other']['lof_prediction'] == 1:
+      fork_rss_mb += vep_lof_fork_rss_mb
+   ## the buffered variants are held by the main VEP process, and (split) by its forks
+   vep_rss_mb = vep_main_rss_mb + config_options['other']['n_vep_forks'] * fork_rss_mb + 2 * config_options['other']['buffer_size'] * vep_buffered_variant_rss_kb // 1024
+   vcfanno_rss_mb = config_options['other']['n_vcfanno_proc'] * vcfanno_proc_rss_mb
+   return (vep_rss_mb, vcfanno_rss_mb)
+
+def get_resource_plan(config_options, num_variants, num_chains, logger):
+   """
+   Function that resolves 'auto' values of n_vep_forks, buffer_size and n_vcfanno_proc for STEP 1-3, from the available cores and memory,
+   the number of input variants (None if unknown) and lof_prediction, given 'num_chains' annotation chains (shards) running in parallel
+   Forks are lowered (and then the buffer size and vcfanno processes) if the projected memory usage of a chain exceeds its share of 'memory_limit_mb'
+   (default: 80% of the available memory). Returns a copy of the configuration options with the resolved values
+   """
+   plan = copy.deepcopy(config_options)
+   other = plan['other']
+   streaming = other['annotation_streaming'] == 1
+   num_cores = get_available_cores()
+   cores_per_chain = max(1, num_cores // num_chains)
+   memory_limit_mb = other['memory_limit_mb']
+   if memory_limit_mb == 0:
+      available_memory_mb = get_available_memory_mb()
+      if not available_memory_mb is None:
+         memory_limit_mb = int(available_memory_mb * 0.8)
+   memory_per_chain_mb = None
+   if memory_limit_mb > 0:
+      memory_per_chain_mb = memory_limit_mb // num_chains
+   variants_per_chain = None
+   if not num_variants is None:
+      variants_per_chain = max(1, int(math.ceil(float(num_variants) / num_chains)))
+
+   if other['n_vep_forks'] == 'auto':
+      ## with streaming, vcfanno and summarise run next to VEP
+      other['n_vep_forks'] = cores_per_chain
+      if streaming:
+         other['n_vep_forks'] = max(1, cores_per_chain - 1)
+      if not variants_per_chain is None:
+         other['n_vep_forks'] = max(1, min(other['n_vep_forks'], variants_per_chain // vep_min_variants_per_fork))
+   def auto_buffer_size():
+      ## VEP's default buffer (5000 variants), enlarged so that each fork gets at least 1000 variants per buffer
+      buffer_size = max(5000, 1000 * other['n_vep_forks'])
+      if not variants_per_chain is None:
+         buffer_size = max(1, min(buffer_size, variants_per_chain))
+      return buffer_size
+
+   if other['buffer_size'] == 'auto':
+      other['buffer_size'] = auto_buffer_size()
+   if other['n_vcfanno_proc'] == 'auto':
+      ## with streaming, vcfanno gets the cores not used by VEP forks
+      other['n_vcfanno_proc'] = cores_per_chain
+      if streaming:
+         other['n_vcfanno_proc'] = max(1, cores_per_chain - other['n_vep_forks'])
+      if not variants_per_chain is None:
+         other['n_vcfanno_proc'] = max(1, min(other['n_vcfanno_proc'], variants_per_chain // vcfanno_min_variants_per_proc))
+
+   def peak_rss_mb():
+      (vep_rss_mb, vcfanno_rss_mb) = get_projected_rss_mb(plan)
+      if streaming:
+         return vep_rss_mb + vcfanno_rss_mb
+      return max(vep_rss_mb, vcfanno_rss_mb)
+
+   if not memory_per_chain_mb is None:
+      ## memory-pressure guard, only adjusts values that were set to 'auto' (VEP forks first, unless vcfanno is the largest consumer)
+      while peak_rss_mb() > memory_per_chain_mb:
+         (vep_rss_mb, vcfanno_rss_mb) = get_projected_rss_mb(plan)
+         lower_vep = streaming or vep_rss_mb > memory_per_chain_mb
+         lower_vcfanno = streaming or vcfanno_rss_mb > memory_per_chain_mb
+         if vcfanno_rss_mb > vep_rss_mb and lower_vcfanno and config_options['other']['n_vcfanno_proc'] == 'auto' and other['n_vcfanno_proc'] > 1:
+            other['n_vcfanno_proc'] -= 1
+         elif lower_vep and config_options['other']['n_vep_forks'] == 'auto' and other['n_vep_forks'] > 1:
+            other['n_vep_forks'] -= 1
+            if config_options['other']['buffer_size'] == 'auto':
+               other['buffer_size'] = min(other['buffer_size'], auto_buffer_size())
+         elif lower_vep and config_options['other']['buffer_size'] == 'auto' and other['buffer_size'] > 1000:
+            other['buffer_size'] = max(1000, other['buffer_size'] // 2)
+         elif lower_vcfanno and config_options['other']['n_vcfanno_proc'] == 'auto' and other['n_vcfanno_proc'] > 1:
+            other['n_vcfanno_proc'] -= 1
+         else:
+            break
+
+   plan_msg = 'Resource plan for STEP 1-3: ' + str(num_cores) + ' cores'
+   if not memory_limit_mb == 0:
+      plan_msg = plan_msg + ', memory limit ' + str(memory_limit_mb) + ' MB'
+   if not num_variants is None:
+      plan_msg = plan_msg + ', ' + str(num_variants) + ' variants'
+   if num_chains > 1:
+      plan_msg = plan_msg + ', ' + str(num_chains) + ' shards'
+   plan_msg = plan_msg + ' -> n_vep_forks = ' + str(other['n_vep_forks']) + ', buffer_size = ' + str(other['buffer_size']) + ', n_vcfanno_proc = ' + str(other['n_vcfanno_proc']) + ' (projected memory usage ' + str(peak_rss_mb() * num_chains) + ' MB)'
+   logger.info(plan_msg)
+   if not memory_per_chain_mb is None and peak_rss_mb() > memory_per_chain_mb:
+      logger.warning('Projected memory usage of STEP 1-3 (' + str(peak_rss_mb() * num_chains) + ' MB) exceeds the memory limit (' + str(memory_limit_mb) + ' MB), consider lowering n_vep_forks/buffer_size/n_vcfanno_proc (or n_shards), or setting them to \'auto\'')
+
+   return plan
+
+def run_annotation_chain(input_vcf_gvanno_ready, docker_command_run1, docker_command_run2, docker_command_run_end, config_options, genome_assembly, vep_assembly, gencode_version, shard_label = None, checkpoint = None, scheduler = None):
+   """
+   Function that runs STEP 1-3 of the gvanno workflow (VEP, gvanno-vcfanno, gvanno-summarise) on a gvanno-ready VCF file (or a shard of it)
+   Produces '<prefix>.vep.vcfanno.annotated.vcf.gz' and '<prefix>.vep.vcfanno.annotated.pass.vcf.gz' (bgzipped and tabix-indexed)
+   With a checkpoint, STEP 1 (vep) and STEP 2 (vcfanno) are skipped if still valid from a previous run, and recorded in the run manifest when completed
+   With 'annotation_streaming', STEP 1-3 are run as a single pipeline (no intermediate VEP/vcfanno files, hence no checkpoints within the chain)
+   With a (host-wide) scheduler, CPU and memory slots are acquired before each step, and released when it is completed
+   """
+   data_dir = '/data'
+   vep_dir = '/usr/local/share/vep/data'
+   step_suffix = ''
+   if not shard_label is None:
+      step_suffix = ' [' + str(shard_label) + ']'
+
+   vep_vcf = re.sub(r'(\.vcf$|\.vcf\.gz$)','.vep.vcf',input_vcf_gvanno_ready)
+   vep_vcfanno_vcf = re.sub(r'(\.vcf$|\.vcf\.gz$)','.vep.vcfanno.vcf',input_vcf_gvanno_ready)
+
+   fasta_assembly = os.path.join(vep_dir, "homo_sapiens", str(vep_version) + "_" + str(vep_assembly), "Homo_sapiens." + str(vep_assembly) + ".dna.primary_assembly.fa.gz")
+   pick_order = "biotype,canonical,appris,tsl,ccds,rank,length"
+   vep_flags = "--hgvs --dont_skip --failed 1 --af --af_1kg --af_gnomad --variant_class --regulatory --domains --symbol --protein --ccds --uniprot --appris --biotype --canonical --gencode_basic --cache --numbers --total_length --allele_number --no_escape --xref_refseq"
+   vep_options = "--vcf --quiet --check_ref --flag_pick_allele --pick_order " + pick_order + " --force_overwrite --species homo_sapiens --assembly " + str(vep_assembly) + " --offline --fork " + str(config_options['other']['n_vep_forks']) + " --buffer_size " + str(config_options['other']['buffer_size']) + " " + str(vep_flags) + " --dir /usr/local/share/vep/data"
+   if config_options['other']['vep_skip_intergenic'] == 1:
+      vep_options = vep_options + " --no_intergenic"
+   if config_options['other']['lof_prediction'] == 1:
+      vep_options = vep_options + " --plugin LoF"
+   vep_main_command = str(docker_command_run1) + "vep --input_file " + str(input_vcf_gvanno_ready) + " --output_file " + str(vep_vcf) + " " + str(vep_options) + " --fasta " + str(fasta_assembly) + docker_command_run_end
+   vep_bgzip_command = docker_command_run1 + "bgzip -f -c " + str(vep_vcf) + " > " + str(vep_vcf) + ".gz" + docker_command_run_end
+   vep_tabix_command = str(docker_command_run1) + "tabix -f -p vcf " + str(vep_vcf) + ".gz" + docker_command_run_end
+   logger = getlogger('gvanno-vep')
+   (vep_rss_mb, vcfanno_rss_mb) = get_projected_rss_mb(config_options)
+
+   if config_options['other']['annotation_streaming'] == 1:
+      ## STEP 1-3 as a single pipeline (VEP -> gvanno-vcfanno -> gvanno-summarise), without intermediate (compressed) VCF files
+      vep_vcfanno_annotated_vcf = re.sub(r'(\.vcf$|\.vcf\.gz$)','.vep.vcfanno.annotated.vcf',input_vcf_gvanno_ready)
+      vep_stream_command = "vep --input_file " + str(input_vcf_gvanno_ready) + " --output_file STDOUT " + str(vep_options) + " --fasta " + str(fasta_assembly)
+      gvanno_vcfanno_stream_command = "gvanno_vcfanno.py --stream --num_processes "  + str(config_options['other']['n_vcfanno_proc']) + " --dbnsfp --clinvar --uniprot --gwas --cancer_hotspots - " + str(vep_vcfanno_vcf) + " " + os.path.join(data_dir, "data", str(genome_assembly))
+      gvanno_summarise_stream_command = "gvanno_summarise.py - " + os.path.join(data_dir, "data", str(genome_assembly)) + " " + str(config_options['other']['lof_prediction']) + " --output_vcf " + str(vep_vcfanno_annotated_vcf) + " --bgzf_threads " + str(config_options['other']['n_bgzf_threads'])
+      gvanno_stream_command = str(docker_command_run1) + "bash -o pipefail -c '" + vep_stream_command + " | " + gvanno_vcfanno_stream_command + " | " + gvanno_summarise_stream_command + "'" + docker_command_run_end
+      print()
+      logger.info("STEP 1-3: Streaming variant annotation with Variant Effect Predictor (" + str(vep_version) + ", GENCODE " + str(gencode_version) + ", " + str(genome_assembly) + "), gvanno-vcfanno and gvanno-summarise" + step_suffix)
+      slots = acquire_slots(scheduler, 'annotate' + step_suffix, config_options['other']['n_vep_forks'] + config_options['other']['n_vcfanno_proc'] + 1, vep_rss_mb + vcfanno_rss_mb + summarise_proc_rss_mb, logger)
+      check_subprocess(gvanno_stream_command)
+      release_slots(scheduler, slots)
+      logger.info("Finished" + step_suffix)
+      return
+
+   print()
+   if config_options['other']['lof_prediction'] == 1:
+      logger.info("STEP 1: Basic variant annotation with Variant Effect Predictor (" + str(vep_version) + ", GENCODE " + str(gencode_version) + ", " + str(genome_assembly) + ") including loss-of-function prediction" + step_suffix)
+   else:
+      logger.info("STEP 1: Basic variant annotation with Variant Effect Predictor (" + str(vep_version) + ", GENCODE " + str(gencode_version) + ", " + str(genome_assembly) + ")" + step_suffix)
+   if not stage_skipped(checkpoint, 'vep', logger):
+      slots = acquire_slots(scheduler, 'vep' + step_suffix, config_options['other']['n_vep_forks'], vep_rss_mb, logger)
+      check_subprocess(vep_main_command)
+      check_subprocess(vep_bgzip_command)
+      check_subprocess(vep_tabix_command)
+      release_slots(scheduler, slots)
+      record_stage(checkpoint, 'vep')
+      logger.info("Finished" + step_suffix)
+
+   ## vcfanno command
+   print()
+   logger = getlogger('gvanno-vcfanno')
+   logger.info("STEP 2: Clinical/functional variant annotations with gvanno-vcfanno (ClinVar, dbNSFP, GWAS catalog, UniProtKB, cancerhotspots.org)" + step_suffix)
+   gvanno_vcfanno_command = str(docker_command_run2) + "gvanno_vcfanno.py --num_processes "  + str(config_options['other']['n_vcfanno_proc']) + " --bgzf_threads " + str(config_options['other']['n_bgzf_threads']) + " --dbnsfp --clinvar --uniprot --gwas --cancer_hotspots " + str(vep_vcf) + ".gz " + str(vep_vcfanno_vcf) + " " + os.path.join(data_dir, "data", str(genome_assembly)) + docker_command_run_end
+   if not stage_skipped(checkpoint, 'vcfanno', logger):
+      slots = acquire_slots(scheduler, 'vcfanno' + step_suffix, config_options['other']['n_vcfanno_proc'], vcfanno_rss_mb, logger)
+      check_subprocess(gvanno_vcfanno_command)
+      release_slots(scheduler, slots)
+      record_stage(checkpoint, 'vcfanno')
+      logger.info("Finished" + step_suffix)
+
+   ## summarise command
+   print()
+   logger = getlogger("gvanno-summarise")
+   logger.info("STEP 3: Gene annotations with gvanno-summarise" + step_suffix)
+   gvanno_summarise_command = str(docker_command_run2) + "gvanno_summarise.py --num_processes " + str(config_options['other']['n_summarise_proc']) + " --bgzf_threads " + str(config_options['other']['n_bgzf_threads']) + " " + str(vep_vcfanno_vcf) + ".gz " + os.path.join(data_dir, "data", str(genome_assembly)) + " " + str(config_options['other']['lof_prediction']) + docker_command_run_end
+   slots = acquire_slots(scheduler, 'summarise' + step_suffix, config_options['other']['n_summarise_proc'], config_options['other']['n_summarise_proc'] * summarise_proc_rss_mb, logger)
+   check_subprocess(gvanno_summarise_command)
+   release_slots(scheduler, slots)
+   logger.info("Finished" + step_suffix)
+
+def run_annotation_shards(shard_vcfs, docker_command_run1, docker_command_run2, docker_command_run_end, config_options, genome_assembly, vep_assembly, gencode_version, scheduler, logger):
+   """
+   Function that runs STEP 1-3 of the gvanno workflow on each shard in parallel (one thread per shard)
+   If a shard fails, the steps still running on the other shards are terminated (and no new steps started), and gvanno exits with a non-zero status
+   """
+   executor = concurrent.futures.ThreadPoolExecutor(max_workers = len(shard_vcfs))
+   shard_runs = {}
+   i = 1
+   for shard_vcf in shard_vcfs:
+      shard_label = 'shard ' + str(i) + '/' + str(len(shard_vcfs))
+      shard_runs[executor.submit(run_annotation_chain, shard_vcf, docker_command_run1, docker_command_run2, docker_command_run_end, config_options, genome_assembly, vep_assembly, gencode_version, shard_label, scheduler = scheduler)] = shard_label
+      i = i + 1
+   try:
+      (completed_runs, pending_runs) = concurrent.futures.wait(list(shard_runs.keys()), return_when = concurrent.futures.FIRST_EXCEPTION)
+   except KeyboardInterrupt:
+      ## the shard steps run in their own process groups, and do not receive the interrupt from the terminal
+      stop_workflow_steps()
+      raise
+   failed_shards = sorted([shard_runs[r] for r in completed_runs if not r.exception() is None])
+   if len(failed_shards) > 0:
+      ## a failing step exits its (worker) thread, stop the other shards and fail from the main thread
+      stop_workflow_steps()
+      concurrent.futures.wait(pending_runs)
+      executor.shutdown()
+      logger.error('')
+      logger.error('STEP 1-3 failed for ' + ', '.join(failed_shards) + ', stopped the remaining shards')
+      logger.error('')
+      exit(1)
+   executor.shutdown()
+
+def start_docker_session(docker_command_session, logger):
+   """
+   Function that starts a long-lived (detached) gvanno container, in which all workflow commands are run with 'docker exec'
+   The container is removed when gvanno.py exits
+   """
+   try:
+      output = subprocess.check_output(str(docker_command_session), stderr=subprocess.STDOUT, shell=True)
+   except subprocess.CalledProcessError as e:
+      print(e.output.decode())
+      exit(0)
+   container_id = output.decode().strip().split('\n')[-1]
+   atexit.register(stop_docker_session, container_id)
+   logger.info('Started gvanno Docker session (container ' + str(container_id[:12]) + ')')
+   return container_id
+
+def stop_docker_session(container_id):
+   subprocess.call('docker rm -f ' + str(container_id) + ' > /dev/null 2>&1', shell=True)
+
+def init_scheduler(config_options, sample_id, logger):
+   """
+   Function that sets up the host-wide scheduler (a token pool in 'scheduler_dir', shared by all gvanno runs on the host), from which CPU and memory slots
+   are acquired before each workflow stage. Returns None if no scheduler is configured
+   Capacity: 'scheduler_cpu_slots' (0: all cores) and 'scheduler_memory_mb' (0: 80% of the total memory, not accounted if unknown), and should be the same for all runs
+   Waiting runs are served in order of 'scheduler_priority' (highest first), and then in order of arrival
+   """
+   if config_options['other']['scheduler_dir'] == '':
+      return None
+   scheduler_dir = os.path.abspath(os.path.expanduser(config_options['other']['scheduler_dir']))
+   if not os.path.isdir(scheduler_dir):
+      os.makedirs(scheduler_dir)
+   cpu_slots = config_options['other']['scheduler_cpu_slots']
+   if cpu_slots == 0:
+      cpu_slots = get_available_cores()
+   memory_mb = config_options['other']['scheduler_memory_mb']
+   if memory_mb == 0:
+      total_memory_mb = get_available_memory_mb('MemTotal')
+      if not total_memory_mb is None:
+         memory_mb = int(total_memory_mb * 0.8)
+   scheduler = {'lock_file': os.path.join(scheduler_dir, 'gvanno_scheduler.lock'), 'state_file': os.path.join(scheduler_dir, 'gvanno_scheduler.json'),
+                'cpu_slots': cpu_slots, 'memory_mb': memory_mb, 'priority': config_options['other']['scheduler_priority'], 'sample_id': sample_id,
+                'host': platform.node(), 'token_counter': itertools.count(1), 'tokens': set()}
+   atexit.register(release_all_slots, scheduler)
+   memory_msg = 'memory not accounted'
+   if memory_mb > 0:
+      memory_msg = str(memory_mb) + ' MB memory'
+   logger.info('Using host-wide scheduler in ' + str(scheduler_dir) + ' (' + str(cpu_slots) + ' CPU slots, ' + memory_msg + ', priority ' + str(scheduler['priority']) + ')')
+   return scheduler
+
+def is_process_alive(scheduler, entry):
+   """
+   Function that checks whether the gvanno run holding/waiting for slots is still alive (entries of runs on other hosts, with a shared scheduler_dir, are kept)
+   """
+   if entry['host'] != scheduler['host']:
+      return True
+   try:
+      os.kill(entry['pid'], 0)
+   except ProcessLookupError:
+      return False
+   except PermissionError:
+      return True
+   return True
+
+def update_scheduler_state(scheduler, update):
+   """
+   Function that applies 'update' (function of the state dictionary, returns a value) to the scheduler state, while holding an exclusive lock on the token pool
+   Entries of runs that are no longer alive (e.g. killed) are removed before the update
+   """
+   lock = open(scheduler['lock_file'], 'a')
+   fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+   try:
+      state = {'seq': 0, 'holders': {}, 'waiting': {}}
+      if os.path.exists(scheduler['state_file']):
+         f = open(scheduler['state_file'], 'r')
+         try:
+            state = json.load(f)
+         except ValueError:
+            pass
+         f.close()
+      for group in ['holders', 'waiting']:
+         for token in list(state[group].keys()):
+            if not is_process_alive(scheduler, state[group][token]):
+               del state[group][token]
+      result = update(state)
+      tmp_state_file = scheduler['state_file'] + '.' + str(os.getpid()) + '.tmp'
+      f = open(tmp_state_file, 'w')
+      json.dump(state, f, indent = 1, sort_keys = True)
+      f.close()
+      os.replace(tmp_state_file, scheduler['state_file'])
+   finally:
+      fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+      lock.close()
+   return result
+
+def acquire_slots(scheduler, stage_label, num_cpus, memory_mb, logger):
+   """
+   Function that waits until 'num_cpus' CPU slots and 'memory_mb' MB memory are available from the host-wide scheduler (capped at its capacity), and acquires them
+   A request is granted when it fits in the free capacity that remains after the requests of all runs waiting ahead of it (higher priority, or same priority and earlier)
+   Returns a token for release_slots (None without scheduler)
+   """
+   if scheduler is None:
+      return None
+   num_cpus = max(1, min(num_cpus, scheduler['cpu_slots']))
+   if scheduler['memory_mb'] > 0:
+      memory_mb = min(memory_mb, scheduler['memory_mb'])
+   else:
+      memory_mb = 0
+   token = str(scheduler['host']) + ':' + str(os.getpid()) + ':' + str(next(scheduler['token_counter']))
+   request = {'host': scheduler['host'], 'pid': os.getpid(), 'sample_id': scheduler['sample_id'], 'stage': stage_label, 'cpus': num_cpus, 'memory_mb': memory_mb, 'priority': scheduler['priority']}
+   scheduler['tokens'].add(token)
+
+   def enqueue(state):
+      state['seq'] += 1
+      state['waiting'][token] = dict(request, seq = state['seq'])
+
+   def try_acquire(state):
+      free_cpus = scheduler['cpu_slots'] - sum(h['cpus'] for h in state['holders'].values())
+      free_memory_mb = scheduler['memory_mb'] - sum(h['memory_mb'] for h in state['holders'].values())
+      if not token in state['waiting']:
+         ## removed as stale (e.g. the state file was lost), queue again
+         enqueue(state)
+      own = state['waiting'][token]
+      for w in state['waiting'].values():
+         if (-w['priority'], w['seq']) < (-own['priority'], own['seq']):
+            free_cpus -= w['cpus']
+            free_memory_mb -= w['memory_mb']
+      if num_cpus <= free_cpus and (scheduler['memory_mb'] == 0 or memory_mb <= free_memory_mb):
+         del state['waiting'][token]
+         state['holders'][token] = own
+         return True
+      return False
+
+   update_scheduler_state(scheduler, enqueue)
+   start = time.time()
+   waiting_logged = False
+   while not update_scheduler_state(scheduler, try_acquire):
+      if not waiting_logged:
+         logger.info('Waiting for ' + str(num_cpus) + ' CPU slot(s) and ' + str(memory_mb) + ' MB memory from the host-wide scheduler (' + str(stage_label) + ')')
+         waiting_logged = True
+      time.sleep(scheduler_poll_interval)
+   if waiting_logged:
+      logger.info('Acquired ' + str(num_cpus) + ' CPU slot(s) and ' + str(memory_mb) + ' MB memory after ' + str(int(time.time() - start)) + ' seconds (' + str(stage_label) + ')')
+   return token
+
+def release_slots(scheduler, token):
+   """
+   Function that returns the slots of an acquired token (or of a waiting request) to the host-wide scheduler
+   """
+   if scheduler is None or token is None:
+      return
+
+   def release(state):
+      state['holders'].pop(token, None)
+      state['waiting'].pop(token, None)
+
+   update_scheduler_state(scheduler, release)
+   scheduler['tokens'].discard(token)
+
+def release_all_slots(scheduler):
+   """
+   Function that releases all slots still held (or waited for) by this gvanno run, called when gvanno.py exits
+   """
+   for token in list(scheduler['tokens']):
+      release_slots(scheduler, token)
+
+def docker_to_host_path(docker_path, host_directories):
+   """
+   Function that maps a file in the Docker output directory (/workdir/output) or input directory (/workdir/input_vcf) to the corresponding file on the host
+   """
+   if docker_path.startswith('/workdir/input_vcf/'):
+      return os.path.join(host_directories['input_vcf_dir_host'], os.path.relpath(docker_path, '/workdir/input_vcf'))
+   return os.path.join(host_directories['output_dir_host'], os.path.relpath(docker_path, '/workdir/output'))
+
+def file_checksum(fname):
+   sha256 = hashlib.sha256()
+   f = open(fname, 'rb')
+   for block in iter(lambda: f.read(1024 * 1024), b''):
+      sha256.update(block)
+   f.close()
+   return sha256.hexdigest()
+
+def init_checkpoint(manifest_file, stages, host_directories, resume, logger):
+   """
+   Function that sets up stage-level checkpointing of the workflow. 'stages' is a list (in run order) of stage definitions, each with a name,
+   input/output files (Docker paths) and the settings (configuration values, tool versions) that the stage results depend on
+   A manifest (JSON) with input checksums, settings and output checksums is written to 'manifest_file' after each completed stage
+   With resume, the last stage that is still valid (and preceded by consistent stages only, see is_stage_chain_consistent) is identified,
+   and this and all preceding stages are skipped
+   """
+   checkpoint = {}
+   checkpoint['manifest_file'] = manifest_file
+   checkpoint['manifest'] = {'stages': {}}
+   checkpoint['stages'] = {}
+   checkpoint['host_directories'] = host_directories
+   checkpoint['checksums'] = {}
+   checkpoint['skip'] = []
+   for stage in stages:
+      checkpoint['stages'][stage['name']] = stage
+
+   if resume is True:
+      manifest = None
+      if os.path.exists(manifest_file):
+         f = open(manifest_file, 'r')
+         try:
+            manifest = json.load(f)
+         except ValueError:
+            logger.warning('Manifest from previous run (' + str(manifest_file) + ') cannot be parsed, running all stages')
+         f.close()
+      if not manifest is None:
+         checkpoint['manifest'] = manifest
+         i = len(stages) - 1
+         while i >= 0:
+            if is_stage_reusable(checkpoint, stages[i]['name']) and is_stage_chain_consistent(checkpoint, stages, i):
+               checkpoint['skip'] = [stage['name'] for stage in stages[:i + 1]]
+               break
+            i = i - 1
+         if len(checkpoint['skip']) > 0:
+            logger.info('Resuming run - stages completed in previous run: ' + ', '.join(checkpoint['skip']))
+         else:
+            logger.info('Resuming run - no valid stages found in previous run, running all stages')
+      elif not os.path.exists(manifest_file):
+         logger.warning('No manifest from previous run found (' + str(manifest_file) + '), running all stages')
+   write_manifest(checkpoint)
+   return checkpoint
+
+def write_manifest(checkpoint):
+   ## written to a temporary file first, such that an interrupted write never leaves a truncated manifest
+   tmp_manifest_file = checkpoint['manifest_file'] + '.tmp'
+   f = open(tmp_manifest_file, 'w')
+   json.dump(checkpoint['manifest'], f, indent = 3, sort_keys = True)
+   f.close()
+   os.replace(tmp_manifest_file, checkpoint['manifest_file'])
+
+def get_checksum(checkpoint, docker_path):
+   """
+   Function that returns the checksum of a file (Docker path), or None if the file does not exist. Checksums are memoized on file size and modification time
+   """
+   host_path = docker_to_host_path(docker_path, checkpoint['host_directories'])
+   if not os.path.exists(host_path):
+      return None
+   file_stat = os.stat(host_path)
+   key = (host_path, file_stat.st_size, file_stat.st_mtime)
+   if not key in checkpoint['checksums']:
+      checkpoint['checksums'][key] = file_checksum(host_path)
+   return checkpoint['checksums'][key]
+
+def is_stage_consistent(checkpoint, stage_name):
+   """
+   Function that checks that a stage recorded in the manifest was run with the current settings on the current inputs
+   Inputs that no longer exist (intermediate files removed at the end of a run) are accepted if they were produced, with the same checksum, by a consistent upstream stage
+   """
+   entry = checkpoint['manifest']['stages'].get(stage_name)
+   if entry is None or not stage_name in checkpoint['stages']:
+      return False
+   stage = checkpoint['stages'][stage_name]
+   if entry['settings'] != stage['settings'] or sorted(entry['inputs'].keys()) != sorted(stage['inputs']):
+      return False
+   for fname in entry['inputs']:
+      checksum = get_checksum(checkpoint, fname)
+      if checksum is None:
+         producer_found = False
+         for upstream_stage in checkpoint['manifest']['stages']:
+            if upstream_stage != stage_name and checkpoint['manifest']['stages'][upstream_stage]['outputs'].get(fname) == entry['inputs'][fname]:
+               if is_stage_consistent(checkpoint, upstream_stage):
+                  producer_found = True
+         if producer_found is False:
+            return False
+      elif checksum != entry['inputs'][fname]:
+         return False
+   return True
+
+def is_stage_chain_consistent(checkpoint, stages, stage_index):
+   """
+   Function that checks that all stages up to (and including) 'stage_index' are consistent with the current run, back to the input VCF (first stage),
+   and that every input recorded for a stage is the output recorded by the upstream stage that produced it (i.e. the stages ran on each other's results)
+   """
+   for j in range(stage_index + 1):
+      if not is_stage_consistent(checkpoint, stages[j]['name']):
+         return False
+      entry = checkpoint['manifest']['stages'][stages[j]['name']]
+      for upstream_stage in stages[:j]:
+         upstream_outputs = checkpoint['manifest']['stages'][upstream_stage['name']]['outputs']
+         for fname in entry['inputs']:
+            if fname in upstream_outputs and upstream_outputs[fname] != entry['inputs'][fname]:
+               return False
+   return True
+
+def is_stage_reusable(checkpoint, stage_name):
+   """
+   Function that checks that a stage recorded in the manifest is consistent with the current run, and that all its outputs are still in place
+   """
+   if not is_stage_consistent(checkpoint, stage_name):
+      return False
+   entry = checkpoint['manifest']['stages'][stage_name]
+   if sorted(entry['outputs'].keys()) != sorted(checkpoint['stages'][stage_name]['outputs']):
+      return False
+   for fname in entry['outputs']:
+      if get_checksum(checkpoint, fname) != entry['outputs'][fname]:
+         return False
+   return True
+
+def stage_skipped(checkpoint, stage_name, logger):
+   if checkpoint is None or not stage_name in checkpoint['skip']:
+      return False
+   logger.info('Skipping stage \'' + str(stage_name) + '\' - results from previous run are still valid (--resume)')
+   return True
+
+def record_stage(checkpoint, stage_name):
+   """
+   Function that records a completed stage (settings, input and output checksums) in the run manifest
+   """
+   if checkpoint is None:
+      return
+   stage = checkpoint['stages'][stage_name]
+   entry = {}
+   entry['settings'] = stage['settings']
+   entry['inputs'] = {}
+   entry['outputs'] = {}
+   for fname in stage['inputs']:
+      entry['inputs'][fname] = get_checksum(checkpoint, fname)
+   for fname in stage['outputs']:
+      entry['outputs'][fname] = get_checksum(checkpoint, fname)
+   checkpoint['manifest']['stages'][stage_name] = entry
+   write_manifest(checkpoint)
+
+def run_gvanno(host_directories, docker_image_version, config_options, sample_id, genome_assembly, gvanno_version, docker_session = False, resume = False):
    """
    Main function to run the gvanno workflow using Docker
    """
@@ -291,90 +984,182 @@ def run_gvanno(host_directories, docker_image_version, config_options, sample_id
    docker_command_run2 = "docker run --rm -t -u " + str(uid) + " -v=" + str(host_directories['base_dir_host']) + ":/data -v=" + str(host_directories['output_dir_host']) + ":/workdir/output -w=/workdir " + str(docker_image_version) + " sh -c \""
    docker_command_run_end = '\"'
 
+   ## one long-lived container for all workflow steps, avoiding container start-up (and volume mounting) per command
+   docker_session_id = None
+   if docker_session is True:
+      docker_command_session = "docker run -d --rm -u " + str(uid) + " -v=" + str(host_directories['base_dir_host']) + ":/data -v=" + str(host_directories['output_dir_host']) + ":/workdir/output -w=/workdir/output " + str(docker_image_version) + " sleep infinity"
+      if host_directories['input_vcf_dir_host'] != 'NA':
+         docker_command_session = "docker run -d --rm -u " + str(uid) + " -v=" + str(host_directories['base_dir_host']) + ":/data -v=" + str(vepdb_dir_host) + ":/usr/local/share/vep/data -v=" + str(host_directories['input_vcf_dir_host']) + ":/workdir/input_vcf -v=" + str(host_directories['input_conf_dir_host']) + ":/workdir/input_conf -v=" + str(host_directories['output_dir_host']) + ":/workdir/output -w=/workdir/output " + str(docker_image_version) + " sleep infinity"
+      docker_session_id = start_docker_session(docker_command_session, logger)
+      docker_command_run1 = "docker exec -t " + str(docker_session_id) + " sh -c \""
+      docker_command_run2 = docker_command_run1
+
+   
+   ## Define input, output and temporary file names
+   output_vcf = os.path.join(output_dir, str(sample_id) + '_gvanno_' + str(genome_assembly) + '.vcf.gz')
+   output_tsv = os.path.join(output_dir, str(sample_id) + '_gvanno_'  + str(genome_assembly) + '.tsv')
+   output_pass_vcf = os.path.join(output_dir, str(sample_id) + '_gvanno_pass_' + str(genome_assembly) + '.vcf.gz')
+   output_pass_tsv = os.path.join(output_dir, str(sample_id) + '_gvanno_pass_' + str(genome_assembly) + '.tsv')
+   input_vcf_gvanno_ready = os.path.join(output_dir, re.sub(r'(\.vcf$|\.vcf\.gz$)','.gvanno_ready.vcf.gz',host_directories['input_vcf_basename_host']))
+   vep_vcf = re.sub(r'\.vcf\.gz$','.vep.vcf.gz',input_vcf_gvanno_ready)
+   vep_vcfanno_vcf = re.sub(r'\.vcf\.gz$','.vep.vcfanno.vcf.gz',input_vcf_gvanno_ready)
+   vep_vcfanno_annotated_vcf = re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.vcf.gz',input_vcf_gvanno_ready)
+   vep_vcfanno_annotated_pass_vcf = re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.pass.vcf.gz',input_vcf_gvanno_ready)
+   vcf2tsv_options = "--compress"
+   vcf2tsv_output_specs = " --keep_rejected_calls " + str(output_tsv) + " --output_spec " + str(output_pass_tsv) + ":pass"
+   vcf2tsv_outputs = [output_tsv + '.gz', output_pass_tsv + '.gz']
+   if config_options['other']['columnar_output'] != 'none':
+      columnar_suffix = '.' + str(config_options['other']['columnar_output'])
+      output_columnar = re.sub(r'\.tsv$',columnar_suffix,output_tsv)
+      output_pass_columnar = re.sub(r'\.tsv$',columnar_suffix,output_pass_tsv)
+      vcf2tsv_options = vcf2tsv_options + " --columnar_format " + str(config_options['other']['columnar_output'])
+      vcf2tsv_output_specs = vcf2tsv_output_specs + " --columnar_output " + str(output_pass_columnar) + ":pass --columnar_output " + str(output_columnar) + ":all"
+      vcf2tsv_outputs.extend([output_columnar, output_pass_columnar])
+
+   ## Workflow stages (checkpointed in the run manifest), STEP 1-3 are checkpointed as a single stage when run on shards, cache misses or as a stream
+   annotation_stage = 'summarise'
+   if config_options['other']['n_shards'] > 1 or config_options['other']['annotation_cache'] == 1 or config_options['other']['annotation_streaming'] == 1:
+      annotation_stage = 'annotate'
+   tool_versions = {'gvanno_version': gvanno_version, 'db_version': db_version, 'vep_version': vep_version, 'docker_image': docker_image_version}
+   stages = []
+   stages.append({'name': 'validate', 'inputs': [input_vcf_docker], 'outputs': [input_vcf_gvanno_ready, input_vcf_gvanno_ready + '.tbi'],
+                  'settings': dict(tool_versions, genome_assembly = genome_assembly, vcf_validation = config_options['other']['vcf_validation'])})
+   vep_settings = dict(tool_versions, genome_assembly = genome_assembly, n_vep_forks = config_options['other']['n_vep_forks'], buffer_size = config_options['other']['buffer_size'],
+                       lof_prediction = config_options['other']['lof_prediction'], vep_skip_intergenic = config_options['other']['vep_skip_intergenic'])
+   summarise_outputs = [output_vcf, output_vcf + '.tbi', output_pass_vcf, output_pass_vcf + '.tbi']
+   if annotation_stage == 'annotate':
+      stages.append({'name': 'annotate', 'inputs': [input_vcf_gvanno_ready], 'outputs': summarise_outputs,
+                     'settings': dict(vep_settings, n_vcfanno_proc = config_options['other']['n_vcfanno_proc'], n_shards = config_options['other']['n_shards'], annotation_cache = config_options['other']['annotation_cache'],
+                                      annotation_streaming = config_options['other']['annotation_streaming'])})
+   else:
+      stages.append({'name': 'vep', 'inputs': [input_vcf_gvanno_ready], 'outputs': [vep_vcf, vep_vcf + '.tbi'], 'settings': vep_settings})
+      stages.append({'name': 'vcfanno', 'inputs': [vep_vcf], 'outputs': [vep_vcfanno_vcf, vep_vcfanno_vcf + '.tbi'],
+                     'settings': dict(tool_versions, genome_assembly = genome_assembly, n_vcfanno_proc = config_options['other']['n_vcfanno_proc'])})
+      stages.append({'name': 'summarise', 'inputs': [vep_vcfanno_vcf], 'outputs': summarise_outputs,
+                     'settings': dict(tool_versions, genome_assembly = genome_assembly, lof_prediction = config_options['other']['lof_prediction'])})
+   stages.append({'name': 'vcf2tsv', 'inputs': [output_vcf], 'outputs': vcf2tsv_outputs,
+                  'settings': dict(tool_versions, vcf2tsv_options = vcf2tsv_options)})
+   manifest_file = os.path.join(host_directories['output_dir_host'], str(sample_id) + '_gvanno_' + str(genome_assembly) + '.manifest.json')
+   checkpoint = init_checkpoint(manifest_file, stages, host_directories, resume, logger)
+   scheduler = init_scheduler(config_options, sample_id, getlogger('gvanno-scheduler'))
    
    ## verify VCF and CNA segment file
    logger = getlogger('gvanno-validate-input')
    logger.info("STEP 0: Validate input data")
-   vcf_validate_command = str(docker_command_run1) + "gvanno_validate_input.py " + str(data_dir) + " " + str(input_vcf_docker) + " " + str(input_conf_docker) + " " + str(genome_assembly) + docker_command_run_end
+   reference_fasta = os.path.join(vep_dir, "homo_sapiens", str(vep_version) + "_" + str(vep_assembly), "Homo_sapiens." + str(vep_assembly) + ".dna.primary_assembly.fa.gz")
+   vcf_validate_command = str(docker_command_run1) + "gvanno_validate_input.py --reference_fasta " + str(reference_fasta) + " --num_validation_processes " + str(config_options['other']['n_vcf_validation_proc']) + " --validation_max_errors " + str(config_options['other']['vcf_validation_max_errors']) + " --bgzf_threads " + str(config_options['other']['n_bgzf_threads']) + " " + str(data_dir) + " " + str(input_vcf_docker) + " " + str(input_conf_docker) + " " + str(genome_assembly) + docker_command_run_end
 
-   check_subprocess(vcf_validate_command)
-   logger.info('Finished')
+   if not stage_skipped(checkpoint, 'validate', logger):
+      slots = acquire_slots(scheduler, 'validate', max(config_options['other']['n_vcf_validation_proc'], config_options['other']['n_bgzf_threads']), validate_rss_mb, logger)
+      check_subprocess(vcf_validate_command)
+      release_slots(scheduler, slots)
+      record_stage(checkpoint, 'validate')
+      logger.info('Finished')
    
    if not input_vcf_docker == 'None':
       
-      ## Define input, output and temporary file names
-      output_vcf = os.path.join(output_dir, str(sample_id) + '_gvanno_' + str(genome_assembly) + '.vcf.gz')
-      output_tsv = os.path.join(output_dir, str(sample_id) + '_gvanno_'  + str(genome_assembly) + '.tsv')
-      output_pass_vcf = os.path.join(output_dir, str(sample_id) + '_gvanno_pass_' + str(genome_assembly) + '.vcf.gz')
-      output_pass_tsv = os.path.join(output_dir, str(sample_id) + '_gvanno_pass_' + str(genome_assembly) + '.tsv')
-      input_vcf_gvanno_ready = os.path.join(output_dir, re.sub(r'(\.vcf$|\.vcf\.gz$)','.gvanno_ready.vcf.gz',host_directories['input_vcf_basename_host']))
-      vep_vcf = re.sub(r'(\.vcf$|\.vcf\.gz$)','.vep.vcf',input_vcf_gvanno_ready)
-      vep_vcfanno_vcf = re.sub(r'(\.vcf$|\.vcf\.gz$)','.vep.vcfanno.vcf',input_vcf_gvanno_ready)
-      vep_vcfanno_annotated_vcf = re.sub(r'\.vcfanno','.vcfanno.annotated',vep_vcfanno_vcf) + '.gz'
-      vep_vcfanno_annotated_pass_vcf = re.sub(r'\.vcfanno','.vcfanno.annotated.pass',vep_vcfanno_vcf) + '.gz'
-      
-      fasta_assembly = os.path.join(vep_dir, "homo_sapiens", str(vep_version) + "_" + str(vep_assembly), "Homo_sapiens." + str(vep_assembly) + ".dna.primary_assembly.fa.gz")
-      pick_order = "biotype,canonical,appris,tsl,ccds,rank,length"
-      vep_flags = "--hgvs --dont_skip --failed 1 --af --af_1kg --af_gnomad --variant_class --regulatory --domains --symbol --protein --ccds --uniprot --appris --biotype --canonical --gencode_basic --cache --numbers --total_length --allele_number --no_escape --xref_refseq"
-      vep_options = "--vcf --quiet --check_ref --flag_pick_allele --pick_order " + pick_order + " --force_overwrite --species homo_sapiens --assembly " + str(vep_assembly) + " --offline --fork " + str(config_options['other']['n_vep_forks']) + " " + str(vep_flags) + " --dir /usr/local/share/vep/data"
-      if config_options['other']['vep_skip_intergenic'] == 1:
-         vep_options = vep_options + " --no_intergenic"
-      if config_options['other']['lof_prediction'] == 1:
-         vep_options = vep_options + " --plugin LoF"
-      vep_main_command = str(docker_command_run1) + "vep --input_file " + str(input_vcf_gvanno_ready) + " --output_file " + str(vep_vcf) + " " + str(vep_options) + " --fasta " + str(fasta_assembly) + docker_command_run_end
-      vep_bgzip_command = docker_command_run1 + "bgzip -f -c " + str(vep_vcf) + " > " + str(vep_vcf) + ".gz" + docker_command_run_end
-      vep_tabix_command = str(docker_command_run1) + "tabix -f -p vcf " + str(vep_vcf) + ".gz" + docker_command_run_end
-      logger = getlogger('gvanno-vep')
-   
-      print()
-      if config_options['other']['lof_prediction'] == 1:
-         logger.info("STEP 1: Basic variant annotation with Variant Effect Predictor (" + str(vep_version) + ", GENCODE " + str(gencode_version) + ", " + str(genome_assembly) + ") including loss-of-function prediction")
-      else:
-         logger.info("STEP 1: Basic variant annotation with Variant Effect Predictor (" + str(vep_version) + ", GENCODE " + str(gencode_version) + ", " + str(genome_assembly) + ")")
-      check_subprocess(vep_main_command)
-      check_subprocess(vep_bgzip_command)
-      check_subprocess(vep_tabix_command)
-      logger.info("Finished")
-      #return
+      if not stage_skipped(checkpoint, annotation_stage, getlogger('gvanno-' + str(annotation_stage))):
+         annotation_cache_db = os.path.join(data_dir, 'data', str(genome_assembly), 'annotation_cache', 'gvanno_annotation_cache.sqlite')
+         ## the cache key also includes the version of the cached payload (set by gvanno_cache.py in the Docker image, along with the code that adds the INFO tags)
+         annotation_bundle_version = 'gvanno=' + str(gvanno_version) + ';' + str(db_version) + ';vep=' + str(vep_version)
+         annotation_cache_options = " --lof_prediction " + str(config_options['other']['lof_prediction']) + " --vep_skip_intergenic " + str(config_options['other']['vep_skip_intergenic'])
 
-      ## vcfanno command
-      print()
-      logger = getlogger('gvanno-vcfanno')
-      logger.info("STEP 2: Clinical/functional variant annotations with gvanno-vcfanno (ClinVar, dbNSFP, GWAS catalog, UniProtKB, cancerhotspots.org)")
-      gvanno_vcfanno_command = str(docker_command_run2) + "gvanno_vcfanno.py --num_processes "  + str(config_options['other']['n_vcfanno_proc']) + " --dbnsfp --clinvar --uniprot --gvanno_xref --gwas --cancer_hotspots " + str(vep_vcf) + ".gz " + str(vep_vcfanno_vcf) + " " + os.path.join(data_dir, "data", str(genome_assembly)) + docker_command_run_end
-      check_subprocess(gvanno_vcfanno_command)
-      logger.info("Finished")
-      #return
+         ## STEP 1-3 are run on the gvanno-ready VCF, or on the variants not found in the annotation cache
+         annotation_input_vcf = input_vcf_gvanno_ready
+         if config_options['other']['annotation_cache'] == 1:
+            print()
+            logger = getlogger('gvanno-cache')
+            logger.info("Looking up variants in annotation cache (" + str(annotation_cache_db) + ")")
+            cache_split_command = str(docker_command_run2) + "gvanno_cache.py split " + str(input_vcf_gvanno_ready) + " " + str(annotation_cache_db) + " " + str(genome_assembly) + " '" + str(annotation_bundle_version) + "'" + annotation_cache_options + docker_command_run_end
+            check_subprocess(cache_split_command)
+            logger.info("Finished")
+            annotation_input_vcf = re.sub(r'\.vcf\.gz$','.cache_miss.vcf.gz',input_vcf_gvanno_ready)
+         annotation_output_vcf = re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.vcf.gz',annotation_input_vcf)
+         ## resolve 'auto' VEP/vcfanno settings from the available resources and the number of variants to annotate (not recorded in the run manifest)
+         num_variants = get_indexed_variant_count(docker_to_host_path(annotation_input_vcf, host_directories) + '.tbi')
+         chain_config_options = get_resource_plan(config_options, num_variants, config_options['other']['n_shards'], getlogger('gvanno-resources'))
+         annotation_output_pass_vcf = re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.pass.vcf.gz',annotation_input_vcf)
 
-      ## summarise command
-      print()
-      logger = getlogger("gvanno-summarise")
-      logger.info("STEP 3: Gene annotations with gvanno-summarise")
-      gvanno_summarise_command = str(docker_command_run2) + "gvanno_summarise.py " + str(vep_vcfanno_vcf) + ".gz " + os.path.join(data_dir, "data", str(genome_assembly)) + " " + str(config_options['other']['lof_prediction']) + docker_command_run_end
-      check_subprocess(gvanno_summarise_command)
-      logger.info("Finished")
-      
-      create_output_vcf_command1 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_vcf) + ' ' + str(output_vcf) + "\""
-      create_output_vcf_command2 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_vcf) + '.tbi ' + str(output_vcf) + '.tbi' + "\""
-      create_output_vcf_command3 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_pass_vcf) + ' ' + str(output_pass_vcf) + "\""
-      create_output_vcf_command4 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_pass_vcf) + '.tbi ' + str(output_pass_vcf) + '.tbi' + "\""
-      clean_command = str(docker_command_run2) + 'rm -f ' + str(vep_vcf) + '* ' + str(vep_vcfanno_annotated_vcf) + ' ' + str(vep_vcfanno_annotated_pass_vcf) + '* ' + str(vep_vcfanno_vcf) + '* ' +  str(input_vcf_gvanno_ready) + "* "  + docker_command_run_end
-      check_subprocess(create_output_vcf_command1)
-      check_subprocess(create_output_vcf_command2)
-      check_subprocess(create_output_vcf_command3)
-      check_subprocess(create_output_vcf_command4)
-      check_subprocess(clean_command)
+         shard_vcfs = []
+         if config_options['other']['n_shards'] > 1:
+            ## split the input VCF into shards with approximately the same number of variants, and run STEP 1-3 on each shard in parallel
+            print()
+            logger = getlogger('gvanno-shard')
+            logger.info("Splitting input VCF into " + str(config_options['other']['n_shards']) + " shards with approximately the same number of variants")
+            shard_split_command = str(docker_command_run1) + "gvanno_shard.py split " + str(annotation_input_vcf) + " " + str(config_options['other']['n_shards']) + docker_command_run_end
+            check_subprocess(shard_split_command)
+            shard_list_file = os.path.join(host_directories['output_dir_host'], re.sub(r'\.vcf\.gz$','.shards.tsv',os.path.basename(annotation_input_vcf)))
+            f = open(shard_list_file,'r')
+            for line in f:
+               shard_vcfs.append(line.rstrip().split('\t')[0])
+            f.close()
+            ## only non-empty shards are listed (none for an input without variants, e.g. when all variants are found in the annotation cache)
+            if len(shard_vcfs) < 2:
+               logger.info("Input VCF split into " + str(len(shard_vcfs)) + " non-empty shard(s), annotating it without sharding")
+
+         if len(shard_vcfs) > 1:
+            run_annotation_shards(shard_vcfs, docker_command_run1, docker_command_run2, docker_command_run_end, chain_config_options, genome_assembly, vep_assembly, gencode_version, scheduler, logger)
+
+            logger.info("Merging annotated shards")
+            shard_annotated_vcfs = [re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.vcf.gz',v) for v in shard_vcfs]
+            shard_annotated_pass_vcfs = [re.sub(r'\.vcf\.gz$','.vep.vcfanno.annotated.pass.vcf.gz',v) for v in shard_vcfs]
+            shard_merge_command = str(docker_command_run2) + "gvanno_shard.py merge " + re.sub(r'\.gz$','',annotation_output_vcf) + " " + " ".join(shard_annotated_vcfs) + docker_command_run_end
+            shard_merge_pass_command = str(docker_command_run2) + "gvanno_shard.py merge " + re.sub(r'\.gz$','',annotation_output_pass_vcf) + " " + " ".join(shard_annotated_pass_vcfs) + docker_command_run_end
+            check_subprocess(shard_merge_command)
+            check_subprocess(shard_merge_pass_command)
+            logger.info("Finished")
+         else:
+            ## STEP 1-3 are checkpointed individually only when run on the full gvanno-ready VCF (otherwise as the single 'annotate' stage, recorded below)
+            chain_checkpoint = None
+            if annotation_stage == 'summarise':
+               chain_checkpoint = checkpoint
+            run_annotation_chain(annotation_input_vcf, docker_command_run1, docker_command_run2, docker_command_run_end, chain_config_options, genome_assembly, vep_assembly, gencode_version, checkpoint = chain_checkpoint, scheduler = scheduler)
+
+         if config_options['other']['annotation_cache'] == 1:
+            ## merge cached annotations with the newly annotated variants (in position order), and store new annotations in the cache
+            print()
+            logger = getlogger('gvanno-cache')
+            logger.info("Merging cached and new variant annotations")
+            cache_merge_command = str(docker_command_run2) + "gvanno_cache.py merge " + str(input_vcf_gvanno_ready) + " " + str(annotation_cache_db) + " " + str(genome_assembly) + " '" + str(annotation_bundle_version) + "'" + annotation_cache_options + " --max_size_mb " + str(config_options['other']['annotation_cache_max_mb']) + " --annotated_vcf " + str(annotation_output_vcf) + " --out_vcf " + re.sub(r'\.gz$','',vep_vcfanno_annotated_vcf) + docker_command_run_end
+            check_subprocess(cache_merge_command)
+            logger.info("Finished")
+
+         if not docker_session_id is None:
+            ## the output directory is mounted from the host, move output files in-process
+            os.rename(docker_to_host_path(vep_vcfanno_annotated_vcf, host_directories), docker_to_host_path(output_vcf, host_directories))
+            os.rename(docker_to_host_path(vep_vcfanno_annotated_vcf + '.tbi', host_directories), docker_to_host_path(output_vcf + '.tbi', host_directories))
+            os.rename(docker_to_host_path(vep_vcfanno_annotated_pass_vcf, host_directories), docker_to_host_path(output_pass_vcf, host_directories))
+            os.rename(docker_to_host_path(vep_vcfanno_annotated_pass_vcf + '.tbi', host_directories), docker_to_host_path(output_pass_vcf + '.tbi', host_directories))
+         else:
+            create_output_vcf_command1 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_vcf) + ' ' + str(output_vcf) + "\""
+            create_output_vcf_command2 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_vcf) + '.tbi ' + str(output_vcf) + '.tbi' + "\""
+            create_output_vcf_command3 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_pass_vcf) + ' ' + str(output_pass_vcf) + "\""
+            create_output_vcf_command4 = str(docker_command_run2) + 'mv ' + str(vep_vcfanno_annotated_pass_vcf) + '.tbi ' + str(output_pass_vcf) + '.tbi' + "\""
+            check_subprocess(create_output_vcf_command1)
+            check_subprocess(create_output_vcf_command2)
+            check_subprocess(create_output_vcf_command3)
+            check_subprocess(create_output_vcf_command4)
+         record_stage(checkpoint, annotation_stage)
+
+      ## clean up intermediate files
+      if not docker_session_id is None:
+         for intermediate_file in glob.glob(docker_to_host_path(re.sub(r'\.vcf\.gz$','.',input_vcf_gvanno_ready), host_directories) + '*'):
+            os.remove(intermediate_file)
+      else:
+         clean_command = str(docker_command_run2) + 'rm -f ' + re.sub(r'\.vcf\.gz$','.',input_vcf_gvanno_ready) + '*' + docker_command_run_end
+         check_subprocess(clean_command)
       
       print()
       logger = getlogger("gvanno-vcf2tsv")
       logger.info("STEP 4: Converting VCF to TSV with https://github.com/sigven/vcf2tsv")
-      gvanno_vcf2tsv_command_pass = str(docker_command_run2) + "vcf2tsv.py " + str(output_pass_vcf) + " --compress " + str(output_pass_tsv) + docker_command_run_end
-      gvanno_vcf2tsv_command_all = str(docker_command_run2) + "vcf2tsv.py " + str(output_vcf) + " --compress --keep_rejected " + str(output_tsv) + docker_command_run_end
-      logger.info("Conversion of VCF variant data to records of tab-separated values - PASS variants only")
-      check_subprocess(gvanno_vcf2tsv_command_pass)
-      logger.info("Conversion of VCF variant data to records of tab-separated values - PASS and non-PASS variants)")
-      check_subprocess(gvanno_vcf2tsv_command_all)
-      logger.info("Finished")
+      gvanno_vcf2tsv_command = str(docker_command_run2) + "vcf2tsv.py " + str(output_vcf) + " " + str(vcf2tsv_options) + str(vcf2tsv_output_specs) + docker_command_run_end
+      if not stage_skipped(checkpoint, 'vcf2tsv', logger):
+         logger.info("Conversion of VCF variant data to records of tab-separated values - PASS variants only, and PASS and non-PASS variants")
+         slots = acquire_slots(scheduler, 'vcf2tsv', 1, vcf2tsv_rss_mb, logger)
+         check_subprocess(gvanno_vcf2tsv_command)
+         release_slots(scheduler, slots)
+         record_stage(checkpoint, 'vcf2tsv')
+         logger.info("Finished")
       
       #return
   
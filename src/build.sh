@@ -1,7 +1,6 @@
-cp /Users/sigven/research/software/vcf2tsv/vcf2tsv.py gvanno/
-cp /Users/sigven/research/docker/pcgr/src/pcgr/lib/annoutils.py gvanno/lib/
-tar czvfh gvanno.tgz gvanno/
+tar --exclude=__pycache__ -czvhf gvanno.tgz gvanno/
 echo "Build the Docker Image"
 TAG=`date "+%Y%m%d"`
-docker build -t sigven/gvanno:$TAG --rm=true .
+VERSION=`grep "^gvanno_version" ../gvanno.py | cut -d"'" -f2`
+docker build -t sigven/gvanno:$TAG -t sigven/gvanno:$VERSION --rm=true .
 
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import os
+import re
+import sqlite3
+import time
+import annoutils
+
+logger = annoutils.getlogger('gvanno-cache')
+
+## version of the cached annotation payload (the INFO tags added by gvanno-vcfanno/gvanno-summarise), part of the cache key
+## bump whenever the set (or encoding) of added INFO tags changes, e.g. 2: GVANNO_XREF no longer added (transcript cross-references from a pickled index)
+cache_payload_version = 2
+## number of rows written to the cache per (short) write transaction
+cache_write_batch_size = 10000
+
+
+def __main__():
+   parser = argparse.ArgumentParser(description='Persistent cross-run cache of gvanno variant annotations (SQLite)', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('command', choices = ['split','merge'], help='split: separate cached (hits) and uncached (misses) variants of a gvanno-ready VCF, merge: merge annotated misses with cached hits, and store new annotations in the cache')
+   parser.add_argument('query_vcf', help='Bgzipped and tabix-indexed gvanno-ready VCF file with query variants (SNVs/InDels)')
+   parser.add_argument('cache_db', help='SQLite annotation cache')
+   parser.add_argument('genome_assembly', help='grch37 or grch38')
+   parser.add_argument('bundle_version', help='Version of software/data bundle that produced the annotations (stale annotations are purged)')
+   parser.add_argument('--annotated_vcf', help='Bgzipped VCF with annotated cache misses (merge)')
+   parser.add_argument('--out_vcf', help='Output VCF file with all annotated variants (merge, uncompressed name, will be bgzipped and indexed)')
+   parser.add_argument('--lof_prediction', default=0, type=int, help='VEP LoF prediction setting (0/1)')
+   parser.add_argument('--vep_skip_intergenic', default=0, type=int, help='VEP skip intergenic setting (0/1)')
+   parser.add_argument('--max_size_mb', default=10240, type=int, help='Maximum size of cached annotations (MB), least recently used annotations are evicted')
+   args = parser.parse_args()
+
+   annotation_options = 'lof_prediction=' + str(args.lof_prediction) + ';vep_skip_intergenic=' + str(args.vep_skip_intergenic)
+   cache = open_annotation_cache(args.cache_db, args.genome_assembly, args.bundle_version, annotation_options)
+   if args.command == 'split':
+      split_cached_variants(args.query_vcf, cache)
+   else:
+      if args.annotated_vcf is None or args.out_vcf is None:
+         annoutils.error_message('Merging of cached annotations requires --annotated_vcf and --out_vcf', logger)
+      merge_cached_variants(args.query_vcf, args.annotated_vcf, args.out_vcf, cache)
+      evict_annotations(cache, args.max_size_mb)
+   cache['db'].close()
+
+
+def open_annotation_cache(cache_db, genome_assembly, bundle_version, annotation_options, timeout = 60):
+   """
+   Function that opens (or creates) the SQLite annotation cache. Annotations are keyed on (chrom, pos, ref, alt, assembly, bundle version and payload version, annotation options)
+   Annotations of other bundle/payload versions (e.g. of another gvanno version sharing the cache) are kept, and evicted as least recently used (see evict_annotations)
+   The cache is shared by concurrent gvanno runs: write-ahead logging lets lookups proceed next to writes, and writes are done in short transactions.
+   A cache that remains locked (or is otherwise unusable) is treated as a miss (lookups) or skipped (writes)
+   """
+   if not os.path.isdir(os.path.dirname(os.path.abspath(cache_db))):
+      os.makedirs(os.path.dirname(os.path.abspath(cache_db)))
+   db = sqlite3.connect(cache_db, timeout = timeout)
+   try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('CREATE TABLE IF NOT EXISTS variant_annotation (chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, assembly TEXT, bundle_version TEXT, annotation_options TEXT, payload TEXT, size INTEGER, last_access INTEGER, PRIMARY KEY (chrom, pos, ref, alt, assembly, bundle_version, annotation_options))')
+      db.execute('CREATE INDEX IF NOT EXISTS variant_annotation_last_access ON variant_annotation (last_access)')
+      db.commit()
+   except sqlite3.OperationalError as e:
+      logger.warning('Annotation cache ' + str(cache_db) + ' could not be initialized: ' + str(e))
+
+   cache = {}
+   cache['db'] = db
+   cache['key'] = (genome_assembly, str(bundle_version) + ';payload=' + str(cache_payload_version), annotation_options)
+   cache['lookup_failures'] = 0
+   return cache
+
+
+def lookup_annotation(cache, chrom, pos, ref, alt):
+   """
+   Function that returns the cached annotation payload of a variant (read-only), or None if not cached or if the cache cannot be read
+   """
+   assembly, bundle_version, annotation_options = cache['key']
+   try:
+      row = cache['db'].execute('SELECT payload FROM variant_annotation WHERE chrom = ? AND pos = ? AND ref = ? AND alt = ? AND assembly = ? AND bundle_version = ? AND annotation_options = ?', (chrom, pos, ref, alt, assembly, bundle_version, annotation_options)).fetchone()
+   except sqlite3.OperationalError as e:
+      if cache['lookup_failures'] == 0:
+         logger.warning('Annotation cache lookup failed, treating variant(s) as cache misses: ' + str(e))
+      cache['lookup_failures'] += 1
+      return None
+   if row is None:
+      return None
+   return row[0]
+
+
+def write_annotation_batch(cache, statement, rows):
+   """
+   Function that executes a write statement for a batch of rows in a single short transaction
+   Returns the number of rows written, a batch that cannot be written (e.g. cache locked by another run beyond the timeout) is skipped
+   """
+   if len(rows) == 0:
+      return 0
+   try:
+      cache['db'].executemany(statement, rows)
+      cache['db'].commit()
+   except sqlite3.OperationalError as e:
+      cache['db'].rollback()
+      logger.warning('Skipped writing ' + str(len(rows)) + ' rows to the annotation cache: ' + str(e))
+      return 0
+   return len(rows)
+
+
+def cache_file_names(query_vcf):
+   query_prefix = re.sub(r'\.vcf\.gz$','',query_vcf)
+   cache_files = {}
+   cache_files['miss_vcf'] = query_prefix + '.cache_miss.vcf'
+   cache_files['hit_tsv'] = query_prefix + '.cache_hit.tsv'
+   return cache_files
+
+
+def split_cached_variants(query_vcf, cache):
+   """
+   Function that looks up all variants of the query VCF in the annotation cache
+   1. Variants not in the cache (misses) are written to '<prefix>.cache_miss.vcf.gz' (bgzipped and tabix-indexed on the fly, see annoutils.open_bgzf_writer), to be annotated by STEP 1-3
+   2. Cached annotations (hits) are written to '<prefix>.cache_hit.tsv' (record number and annotation payload)
+   At least one variant is always treated as a miss, so that the annotated VCF header is produced
+   """
+   cache_files = cache_file_names(query_vcf)
+   miss_vcf = annoutils.open_bgzf_writer(cache_files['miss_vcf'] + '.gz', index = 'tbi')
+   hit_tsv = open(cache_files['hit_tsv'], 'w')
+   assembly, bundle_version, annotation_options = cache['key']
+   now = int(time.time())
+   access_update = 'UPDATE variant_annotation SET last_access = ? WHERE chrom = ? AND pos = ? AND ref = ? AND alt = ? AND assembly = ? AND bundle_version = ? AND annotation_options = ?'
+   accessed_rows = []
+
+   num_hits = 0
+   num_misses = 0
+   record_number = 0
+   f = gzip.open(query_vcf, 'rt')
+   try:
+      for line in f:
+         if line.startswith('#'):
+            annoutils.write_bgzf(miss_vcf, line)
+            continue
+         fields = line.rstrip('\n').split('\t', 5)
+         chrom, pos, ref, alt = fields[0], int(fields[1]), fields[3], fields[4]
+         payload = None
+         if num_misses > 0:
+            payload = lookup_annotation(cache, chrom, pos, ref, alt)
+         if payload is None:
+            annoutils.write_bgzf(miss_vcf, line)
+            num_misses += 1
+         else:
+            accessed_rows.append((now, chrom, pos, ref, alt, assembly, bundle_version, annotation_options))
+            if len(accessed_rows) >= cache_write_batch_size:
+               write_annotation_batch(cache, access_update, accessed_rows)
+               accessed_rows = []
+            hit_tsv.write(str(record_number) + '\t' + str(payload) + '\n')
+            num_hits += 1
+         record_number += 1
+      annoutils.close_bgzf_writer(miss_vcf)
+   except (IOError, ValueError) as e:
+      annoutils.error_message('Writing cache misses to ' + str(cache_files['miss_vcf']) + '.gz failed: ' + str(e), logger)
+   f.close()
+   hit_tsv.close()
+   write_annotation_batch(cache, access_update, accessed_rows)
+
+   hit_rate = 0.0
+   if record_number > 0:
+      hit_rate = float(num_hits) / record_number * 100
+   logger.info('Annotation cache: ' + str(num_hits) + ' hits, ' + str(num_misses) + ' misses (hit rate: ' + str(round(hit_rate, 1)) + '%)')
+
+
+def get_annotation_payload(info, query_info_tags):
+   """
+   Function that returns the INFO elements of an annotated record that were added by gvanno (i.e. not defined in the query VCF header)
+   """
+   payload = []
+   for element in info.split(';'):
+      if not element.split('=', 1)[0] in query_info_tags:
+         payload.append(element)
+   return ';'.join(payload)
+
+
+def merge_cached_variants(query_vcf, annotated_vcf, out_vcf, cache):
+   """
+   Function that merges annotated cache misses with cached annotations (hits), in the record order of the query VCF
+   New annotations are stored in the cache, and all/PASS variants are written to bgzipped and tabix-indexed VCF files (as gvanno-summarise, see annoutils.open_bgzf_writer)
+   New annotations are stored in short batched transactions while merging (see write_annotation_batch)
+   """
+   cache_files = cache_file_names(query_vcf)
+   out_pass_vcf = re.sub(r'\.annotated\.vcf$','.annotated.pass.vcf',out_vcf)
+   assembly, bundle_version, annotation_options = cache['key']
+   now = int(time.time())
+   annotation_insert = 'INSERT OR REPLACE INTO variant_annotation VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+   new_rows = []
+
+   query_info_tags = {}
+   annotated = gzip.open(annotated_vcf, 'rt')
+   out = annoutils.open_bgzf_writer(str(out_vcf) + '.gz', index = 'tbi')
+   out_pass = annoutils.open_bgzf_writer(str(out_pass_vcf) + '.gz', index = 'tbi')
+   annotated_line = annotated.readline()
+   header_lines = []
+   while annotated_line.startswith('#'):
+      header_lines.append(annotated_line)
+      annotated_line = annotated.readline()
+   annoutils.write_bgzf(out, ''.join(header_lines))
+   annoutils.write_bgzf(out_pass, ''.join(header_lines))
+
+   hits = open(cache_files['hit_tsv'], 'r')
+   hit_line = hits.readline()
+   num_stored = 0
+   record_number = 0
+   f = gzip.open(query_vcf, 'rt')
+   try:
+      for line in f:
+         if line.startswith('#'):
+            if line.startswith('##INFO=<ID='):
+               query_info_tags[line[11:].split(',', 1)[0]] = 1
+            continue
+         fields = line.rstrip('\n').split('\t')
+         out_line = None
+         if hit_line != '' and int(hit_line.split('\t', 1)[0]) == record_number:
+            payload = hit_line.rstrip('\n').split('\t', 1)[1]
+            if fields[7] == '.' or fields[7] == '':
+               fields[7] = payload
+            elif payload != '':
+               fields[7] = fields[7] + ';' + payload
+            out_line = '\t'.join(fields) + '\n'
+            hit_line = hits.readline()
+         elif annotated_line != '':
+            annotated_fields = annotated_line.rstrip('\n').split('\t')
+            ## variants without VEP consequences are skipped by gvanno-summarise, and hence missing in the annotated VCF
+            if annotated_fields[0] == fields[0] and annotated_fields[1] == fields[1] and annotated_fields[3] == fields[3] and annotated_fields[4] == fields[4]:
+               out_line = annotated_line
+               payload = get_annotation_payload(annotated_fields[7], query_info_tags)
+               new_rows.append((fields[0], int(fields[1]), fields[3], fields[4], assembly, bundle_version, annotation_options, payload, len(payload), now))
+               if len(new_rows) >= cache_write_batch_size:
+                  num_stored += write_annotation_batch(cache, annotation_insert, new_rows)
+                  new_rows = []
+               annotated_line = annotated.readline()
+         record_number += 1
+         if out_line is None:
+            continue
+         annoutils.write_bgzf(out, out_line)
+         filter_value = out_line.split('\t', 7)[6]
+         if filter_value == 'PASS' or filter_value == '.':
+            annoutils.write_bgzf(out_pass, out_line)
+      annoutils.close_bgzf_writer(out)
+      annoutils.close_bgzf_writer(out_pass)
+   except (IOError, ValueError) as e:
+      annoutils.error_message('Writing merged annotations to ' + str(out_vcf) + '.gz failed: ' + str(e), logger)
+   f.close()
+   hits.close()
+   annotated.close()
+   num_stored += write_annotation_batch(cache, annotation_insert, new_rows)
+   logger.info('Stored ' + str(num_stored) + ' new variant annotations in cache')
+
+
+def evict_annotations(cache, max_size_mb):
+   """
+   Function that evicts the least recently used annotations (of any bundle/payload version) when the total size of cached annotations exceeds 'max_size_mb'
+   """
+   db = cache['db']
+   max_size = int(max_size_mb) * 1024 * 1024
+   try:
+      total_size = db.execute('SELECT COALESCE(SUM(size), 0) FROM variant_annotation').fetchone()[0]
+      if total_size <= max_size:
+         return
+      excess_size = total_size - int(max_size * 0.9)
+      evicted_rowids = []
+      for rowid, size in db.execute('SELECT rowid, size FROM variant_annotation ORDER BY last_access'):
+         if excess_size <= 0:
+            break
+         evicted_rowids.append((rowid,))
+         excess_size -= size
+   except sqlite3.OperationalError as e:
+      logger.warning('Skipped eviction of least recently used annotations from cache: ' + str(e))
+      return
+   num_evicted = 0
+   for b in range(0, len(evicted_rowids), cache_write_batch_size):
+      num_evicted += write_annotation_batch(cache, 'DELETE FROM variant_annotation WHERE rowid = ?', evicted_rowids[b:b + cache_write_batch_size])
+   logger.info('Evicted ' + str(num_evicted) + ' least recently used annotations from cache (size limit: ' + str(max_size_mb) + ' MB)')
+
+
+if __name__=="__main__": __main__()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import re
+import annoutils
+
+logger = annoutils.getlogger('gvanno-shard')
+
+
+def __main__():
+   parser = argparse.ArgumentParser(description='Split a gvanno-ready VCF into load-balanced shards, or merge annotated shards back into a single VCF', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   subparsers = parser.add_subparsers(dest='command')
+   parser_split = subparsers.add_parser('split', help='Split a bgzipped and tabix-indexed VCF into shards with approximately the same number of variants')
+   parser_split.add_argument('query_vcf', help='Bgzipped and tabix-indexed input VCF file with query variants (SNVs/InDels)')
+   parser_split.add_argument('num_shards', type=int, help='Number of shards')
+   parser_merge = subparsers.add_parser('merge', help='Merge shards (in the given order) into a single bgzipped and tabix-indexed VCF')
+   parser_merge.add_argument('out_vcf', help='Output VCF file (uncompressed name, will be bgzipped and indexed)')
+   parser_merge.add_argument('shard_vcfs', nargs='+', help='Bgzipped VCF shards, in genomic order')
+   args = parser.parse_args()
+
+   if args.command == 'split':
+      split_vcf(args.query_vcf, args.num_shards)
+   elif args.command == 'merge':
+      merge_vcf_shards(args.out_vcf, args.shard_vcfs)
+   else:
+      parser.print_help()
+
+
+def split_vcf(query_vcf, num_shards):
+   """
+   Function that splits a bgzipped and tabix-indexed VCF file into shards with approximately the same number of variants (region sets are computed from the tabix index)
+   Shards are written as '<prefix>.shard<N>.vcf.gz' (bgzipped and tabix-indexed on the fly, see annoutils.open_bgzf_writer), and listed (in genomic order) in '<prefix>.shards.tsv'
+   """
+   query_prefix = re.sub(r'\.vcf\.gz$','',query_vcf)
+   region_sets = annoutils.get_balanced_regions(query_vcf, num_shards)
+   region_index = annoutils.get_region_set_index(region_sets)
+
+   header_lines = []
+   shard_writers = {}
+   shard_counts = {}
+   f = gzip.open(query_vcf, 'rt')
+   try:
+      for line in f:
+         if line.startswith('#'):
+            header_lines.append(line)
+            continue
+         fields = line.split('\t', 2)
+         shard_index = annoutils.find_region_set(region_index, fields[0], int(fields[1]))
+         if not shard_index in shard_writers:
+            shard_writers[shard_index] = annoutils.open_bgzf_writer(query_prefix + '.shard' + str(shard_index + 1) + '.vcf.gz', index = 'tbi')
+            annoutils.write_bgzf(shard_writers[shard_index], ''.join(header_lines))
+            shard_counts[shard_index] = 0
+         annoutils.write_bgzf(shard_writers[shard_index], line)
+         shard_counts[shard_index] += 1
+      for shard_index in shard_writers:
+         annoutils.close_bgzf_writer(shard_writers[shard_index])
+   except (IOError, ValueError) as e:
+      annoutils.error_message('Splitting ' + str(query_vcf) + ' into shards failed: ' + str(e), logger)
+   f.close()
+
+   shard_list = open(query_prefix + '.shards.tsv', 'w')
+   for shard_index in sorted(shard_writers.keys()):
+      shard_vcf = query_prefix + '.shard' + str(shard_index + 1) + '.vcf'
+      regions = ','.join(str(chrom) + ':' + str(start) + '-' + ('' if end is None else str(end)) for chrom, start, end in region_sets[shard_index])
+      shard_list.write(str(shard_vcf) + '.gz\t' + str(shard_counts[shard_index]) + '\t' + str(regions) + '\n')
+      logger.info('Shard ' + str(shard_index + 1) + ': ' + str(shard_counts[shard_index]) + ' variants (' + str(regions) + ')')
+   shard_list.close()
+
+
+def merge_vcf_shards(out_vcf, shard_vcfs):
+   """
+   Function that concatenates VCF shards (in the given, genomic order) into a single VCF file, keeping the header of the first shard only
+   The merged VCF is written as '<out_vcf>.gz' (bgzipped and tabix-indexed on the fly, see annoutils.open_bgzf_writer)
+   """
+   out = annoutils.open_bgzf_writer(str(out_vcf) + '.gz', index = 'tbi')
+   i = 0
+   try:
+      for shard_vcf in shard_vcfs:
+         f = gzip.open(shard_vcf, 'rt')
+         for line in f:
+            if line.startswith('#') and i > 0:
+               continue
+            annoutils.write_bgzf(out, line)
+         f.close()
+         i = i + 1
+      annoutils.close_bgzf_writer(out)
+   except (IOError, ValueError) as e:
+      annoutils.error_message('Merging shards into ' + str(out_vcf) + '.gz failed: ' + str(e), logger)
+   logger.info('Merged ' + str(len(shard_vcfs)) + ' shards into ' + str(out_vcf) + '.gz')
+
+
+if __name__=="__main__": __main__()
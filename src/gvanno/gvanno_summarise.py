@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import csv
+import concurrent.futures
+import operator
 import re
 import argparse
-from cyvcf2 import VCF, Writer
+from cyvcf2 import VCF
 import gzip
 import os
 import annoutils
@@ -15,32 +17,87 @@ csv.field_size_limit(500 * 1024 * 1024)
 def __main__():
    
    parser = argparse.ArgumentParser(description='Gene annotations from gvanno pipeline (SNVs/InDels)')
-   parser.add_argument('vcf_file', help='VCF file with VEP-annotated query variants (SNVs/InDels)')
+   parser.add_argument('vcf_file', help='VCF file with VEP-annotated query variants (SNVs/InDels), \'-\' to read from standard input')
    parser.add_argument('gvanno_db_dir',help='gvanno data directory')
    parser.add_argument('lof_prediction',default=0,type=int,help='VEP LoF prediction setting (0/1)')
+   parser.add_argument('--output_vcf',help='Output VCF file (uncompressed name, will be bgzipped and indexed), required when reading from standard input (default: <vcf_file prefix>.annotated.vcf)')
+   parser.add_argument('--num_processes',default=1,type=int,help='Number of parallel processes, each summarising a set of regions (with approximately the same number of variants) of a bgzipped and tabix-indexed VCF file')
+   parser.add_argument('--bgzf_threads',default=1,type=int,help='Number of threads (per process) for BGZF decompression of the input VCF and compression of the output VCFs')
    args = parser.parse_args()
 
-   extend_vcf_annotations(args.vcf_file, args.gvanno_db_dir, args.lof_prediction)
+   if args.vcf_file == '-' and args.output_vcf is None:
+      annoutils.error_message('Reading VCF from standard input requires --output_vcf', logger)
+   extend_vcf_annotations(args.vcf_file, args.gvanno_db_dir, args.lof_prediction, args.output_vcf, args.num_processes, args.bgzf_threads)
 
-def extend_vcf_annotations(query_vcf, gvanno_db_directory, lof_prediction = 0):
+def extend_vcf_annotations(query_vcf, gvanno_db_directory, lof_prediction = 0, out_vcf = None, num_processes = 1, bgzf_threads = 1):
    """
    Function that reads VEP/vcfanno-annotated VCF and extends the VCF INFO column with tags from
    1. CSQ elements within the primary transcript consequence picked by VEP, e.g. SYMBOL, Feature, Gene, Consequence etc.
    2. Gene annotations, e.g. known oncogenes/tumor suppressors, curated disease associations (DisGenet), MIM phenotype associations etc
    3. Protein-relevant annotations, e.g. c functional protein features etc.
    4. Variant effect predictions
+   With 'num_processes' > 1 (bgzipped and tabix-indexed query VCF only), sets of regions with approximately the same number of variants
+   are summarised in parallel (see summarise_region_sets)
+   Output VCFs are bgzipped and tabix-indexed on the fly, with 'bgzf_threads' compression threads (see annoutils.open_bgzf_writer)
    """
 
    ## read VEP and PCGR tags to be appended to VCF file
    vcf_infotags_meta = annoutils.read_infotag_file(os.path.join(gvanno_db_directory,'gvanno_infotags.tsv'))
-   out_vcf = re.sub(r'\.vcf(\.gz){0,}$','.annotated.vcf',query_vcf)
+   if out_vcf is None:
+      out_vcf = re.sub(r'\.vcf(\.gz){0,}$','.annotated.vcf',query_vcf)
+   ## all and PASS-only annotated variants are written in the same pass, bgzipped and indexed on the fly
+   out_pass_vcf = re.sub(r'\.vcf$','.pass.vcf',out_vcf)
+   transcript_xref_index = annoutils.load_transcript_xref_index(gvanno_db_directory, logger)
 
-   meta_vep_dbnsfp_info = annoutils.vep_dbnsfp_meta_vcf(query_vcf, vcf_infotags_meta)
+   region_sets = []
+   if num_processes > 1:
+      if query_vcf == '-' or not os.path.exists(str(query_vcf) + '.tbi'):
+         logger.warning('Parallel summary of functional annotations requires a bgzipped and tabix-indexed VCF file - using a single process')
+      else:
+         region_sets = annoutils.get_balanced_regions(query_vcf, num_processes)
+
+   if len(region_sets) > 1:
+      summary_counts = summarise_region_sets(query_vcf, region_sets, vcf_infotags_meta, lof_prediction, transcript_xref_index, out_vcf, out_pass_vcf, bgzf_threads)
+   else:
+      ## the query VCF is opened once (it may be a stream), header metadata is parsed from the same reader
+      vcf, summary = open_summary_vcf(query_vcf, vcf_infotags_meta, lof_prediction, transcript_xref_index, bgzf_threads)
+      w = annoutils.open_bgzf_writer(out_vcf + '.gz', threads = bgzf_threads, index = 'tbi')
+      w_pass = annoutils.open_bgzf_writer(out_pass_vcf + '.gz', threads = bgzf_threads, index = 'tbi')
+      annoutils.write_bgzf(w, vcf.raw_header)
+      annoutils.write_bgzf(w_pass, vcf.raw_header)
+      summary_counts = summarise_records(vcf, summary, lambda rec: annoutils.write_bgzf(w, str(rec)), lambda rec: annoutils.write_bgzf(w_pass, str(rec)))
+      annoutils.close_bgzf_writer(w)
+      annoutils.close_bgzf_writer(w_pass)
+      vcf.close()
+      dbnsfp_cache = annoutils.get_dbnsfp_predictions.cache_info()
+      summary_counts['dbnsfp_cache_hits'] = dbnsfp_cache.hits
+      summary_counts['dbnsfp_cache_misses'] = dbnsfp_cache.misses
+
+   dbnsfp_hit_rate = 0.0
+   if summary_counts['dbnsfp_cache_hits'] + summary_counts['dbnsfp_cache_misses'] > 0:
+      dbnsfp_hit_rate = float(summary_counts['dbnsfp_cache_hits']) / (summary_counts['dbnsfp_cache_hits'] + summary_counts['dbnsfp_cache_misses']) * 100
+   logger.info('dbNSFP prediction cache: ' + str(summary_counts['dbnsfp_cache_hits']) + ' hits, ' + str(summary_counts['dbnsfp_cache_misses']) + ' misses (hit rate: ' + str(round(dbnsfp_hit_rate, 1)) + '%)')
+   logger.info('Number of non-PASS/REJECTED variant calls: ' + str(summary_counts['num_rejected']))
+   logger.info('Number of PASSed variant calls: ' + str(summary_counts['num_pass']))
+   if summary_counts['num_pass'] == 0:
+      logger.warning('There are zero variants with a \'PASS\' filter in the VCF file')
+
+   if not os.path.exists(out_vcf + '.gz') or os.path.getsize(out_vcf + '.gz') == 0:
+      annoutils.error_message('No remaining PASS variants found in query VCF - exiting and skipping STEP 4 (gvanno-writer)', logger)
+
+def open_summary_vcf(query_vcf, vcf_infotags_meta, lof_prediction, transcript_xref_index, bgzf_threads = 1):
+   """
+   Function that opens the query VCF (with 'bgzf_threads' htslib decompression threads, unless read from standard input), adds the gvanno
+   INFO tags to its header, and returns the reader along with the VEP/dbNSFP metadata needed to summarise its records (compiled CSQ extraction, dbNSFP prediction algorithms)
+   """
+   if query_vcf == '-' or bgzf_threads < 2:
+      vcf = VCF(query_vcf)
+   else:
+      vcf = VCF(query_vcf, threads = bgzf_threads)
+   meta_vep_dbnsfp_info = annoutils.vep_dbnsfp_meta_vcf(vcf, vcf_infotags_meta)
    vep_csq_index2fields = meta_vep_dbnsfp_info['vep_csq_index2fields']
    vep_csq_fields2index = meta_vep_dbnsfp_info['vep_csq_fields2index']
-   dbnsfp_prediction_algorithms = meta_vep_dbnsfp_info['dbnsfp_prediction_algorithms']
 
-   vcf = VCF(query_vcf)
    for tag in vcf_infotags_meta:
       if lof_prediction == 0:
          if not tag.startswith('LoF'):
@@ -48,110 +105,178 @@ def extend_vcf_annotations(query_vcf, gvanno_db_directory, lof_prediction = 0):
       else:
          vcf.add_info_to_header({'ID': tag, 'Description': str(vcf_infotags_meta[tag]['description']),'Type':str(vcf_infotags_meta[tag]['type']), 'Number': str(vcf_infotags_meta[tag]['number'])})
 
-   
-   w = Writer(out_vcf, vcf)
+   summary = {}
+   summary['csq_extractor'] = compile_csq_extractor(vep_csq_fields2index, vep_csq_index2fields, transcript_xref_index)
+   summary['dbnsfp_prediction_algorithms'] = meta_vep_dbnsfp_info['dbnsfp_prediction_algorithms']
+   return (vcf, summary)
+
+def summarise_records(records, summary, write_record, write_pass_record, log_suffix = ''):
+   """
+   Function that extends the INFO column of VEP/vcfanno-annotated records (see extend_vcf_annotations), and writes all and PASS-only records
+   Records without VEP consequences (CSQ) are skipped, returns the number of PASS and non-PASS records
+   """
+   csq_extractor = summary['csq_extractor']
+   dbnsfp_prediction_algorithms = summary['dbnsfp_prediction_algorithms']
+   num_rejected = 0
+   num_pass = 0
    current_chrom = None
    num_chromosome_records_processed = 0
-   gvanno_xref_map = {'ENSEMBL_TRANSCRIPT_ID':0, 'ENSEMBL_GENE_ID':1, 'SYMBOL':2, 'ENTREZ_ID':3, 'UNIPROT_ID':4, 'APPRIS':5,'UNIPROT_ACC':6,
-                        'REFSEQ_MRNA':7, 'CORUM_ID':8,'TUMOR_SUPPRESSOR':9,'ONCOGENE':10,'DISGENET_CUI':11,'MIM_PHENOTYPE_ID':12}
-   for rec in vcf:
+   for rec in records:
       all_transcript_consequences = []
       if current_chrom is None:
          current_chrom = str(rec.CHROM)
          num_chromosome_records_processed = 0
       else:
          if str(rec.CHROM) != current_chrom:
-            logger.info('Completed summary of functional annotations for ' + str(num_chromosome_records_processed) + ' variants on chromosome ' + str(current_chrom))
+            logger.info('Completed summary of functional annotations for ' + str(num_chromosome_records_processed) + ' variants on chromosome ' + str(current_chrom) + str(log_suffix))
             current_chrom = str(rec.CHROM)
             num_chromosome_records_processed = 0
-      if rec.INFO.get('CSQ') is None:
+      csq_entries = rec.INFO.get('CSQ')
+      if csq_entries is None:
          alt_allele = ','.join(rec.ALT)
          pos = rec.start + 1
          variant_id = 'g.' + str(rec.CHROM) + ':' + str(pos) + str(rec.REF) + '>' + alt_allele
          logger.warning('Variant record ' + str(variant_id) + ' does not have CSQ tag from Variant Effect Predictor (vep_skip_intergenic in config set to true?)  - variant will be skipped')
          continue
-      gvanno_xref = {}
       num_chromosome_records_processed += 1
-      if not rec.INFO.get('GVANNO_XREF') is None:
-         for transcript_xref in rec.INFO.get('GVANNO_XREF').split(','):
-            xrefs = transcript_xref.split('|')
-            ensembl_transcript_id = str(xrefs[0])
-            gvanno_xref[ensembl_transcript_id] = {}
-            for annotation in gvanno_xref_map.keys():
-               annotation_index = gvanno_xref_map[annotation]
-               if annotation_index > (len(xrefs) - 1):
-                  continue
-               if xrefs[annotation_index] != '':
-                  gvanno_xref[ensembl_transcript_id][annotation] = xrefs[annotation_index]
-      for identifier in ['CSQ','DBNSFP']:
-         if identifier == 'CSQ':
-            num_picks = 0
-            for csq in rec.INFO.get(identifier).split(','):
-               csq_fields =  csq.split('|')
-               if csq_fields[vep_csq_fields2index['PICK']] == "1": ## only consider the primary/picked consequence when expanding with annotation tags
-                  num_picks += 1
-                  j = 0
-                  ## loop over all CSQ elements and set them in the vep_info_tags dictionary (for each alt_allele)
-                  while(j < len(csq_fields)):
-                     if j in vep_csq_index2fields:
-                        if csq_fields[j] != '':
-                           rec.INFO[vep_csq_index2fields[j]] = str(csq_fields[j])
-                           if vep_csq_index2fields[j] == 'Feature':
-                              ensembl_transcript_id = str(csq_fields[j])
-                              if ensembl_transcript_id in gvanno_xref:
-                                 for annotation in gvanno_xref_map.keys():
-                                    if annotation in gvanno_xref[ensembl_transcript_id]:
-                                       if annotation == 'TUMOR_SUPPRESSOR' or annotation == 'ONCOGENE':
-                                          rec.INFO[annotation] = True
-                                       else:
-                                          rec.INFO[annotation] = gvanno_xref[ensembl_transcript_id][annotation]
-                           if vep_csq_index2fields[j] == 'DOMAINS':
-                              domain_identifiers = str(csq_fields[j]).split('&')
-                              for v in domain_identifiers:
-                                 if v.startswith('Pfam_domain'):
-                                    rec.INFO['PFAM_DOMAIN'] = str(re.sub(r'\.[0-9]{1,}$','',re.sub(r'Pfam_domain:','',v)))
-
-                           if vep_csq_index2fields[j] == 'Existing_variation':
-                              var_identifiers = str(csq_fields[j]).split('&')
-                              cosmic_identifiers = []
-                              dbsnp_identifiers = []
-                              for v in var_identifiers:
-                                 if v.startswith('COSM'):
-                                    cosmic_identifiers.append(v)
-                                 if v.startswith('rs'):
-                                    dbsnp_identifiers.append(v)
-                              if len(cosmic_identifiers) > 0:
-                                 rec.INFO['COSMIC_MUTATION_ID'] = '&'.join(cosmic_identifiers)
-                              if len(dbsnp_identifiers) > 0:
-                                 rec.INFO['DBSNPRSID'] = '&'.join(dbsnp_identifiers)
-                           
-                     j = j + 1
-                  annoutils.set_coding_change(rec)
-               symbol = '.'
-               if csq_fields[vep_csq_fields2index['SYMBOL']] != "":
-                  symbol = str(csq_fields[vep_csq_fields2index['SYMBOL']])
-               consequence_entry = str(csq_fields[vep_csq_fields2index['Consequence']]) + ':' + str(symbol) + ':' + str(csq_fields[vep_csq_fields2index['Feature_type']]) + ':' + str(csq_fields[vep_csq_fields2index['Feature']]) + ':' + str(csq_fields[vep_csq_fields2index['BIOTYPE']])
-               all_transcript_consequences.append(consequence_entry)
-
-         if identifier == 'DBNSFP':
-            if not rec.INFO.get('DBNSFP') is None:
-               annoutils.map_variant_effect_predictors(rec, dbnsfp_prediction_algorithms)
+      num_picks = 0
+      for csq in csq_entries.split(','):
+         pick, consequence, symbol, feature_type, feature, biotype = csq_extractor['summary_fields'](csq.split('|', csq_extractor['max_split']))
+         if pick == "1": ## only consider the primary/picked consequence when expanding with annotation tags
+            num_picks += 1
+            set_picked_csq_tags(rec, csq.split('|'), csq_extractor)
+            annoutils.set_coding_change(rec)
+         if symbol == "":
+            symbol = '.'
+         all_transcript_consequences.append(consequence + ':' + symbol + ':' + feature_type + ':' + feature + ':' + biotype)
+
+      if not rec.INFO.get('DBNSFP') is None:
+         annoutils.map_variant_effect_predictors(rec, dbnsfp_prediction_algorithms)
       rec.INFO['VEP_ALL_CONSEQUENCE'] = ','.join(all_transcript_consequences)
-      w.write_record(rec)
-   w.close()
-   logger.info('Completed summary of functional annotations for ' + str(num_chromosome_records_processed) + ' variants on chromosome ' + str(current_chrom))
+      write_record(rec)
+      if rec.FILTER is None or rec.FILTER == 'None':
+         write_pass_record(rec)
+         num_pass += 1
+      else:
+         num_rejected += 1
+   if not current_chrom is None:
+      logger.info('Completed summary of functional annotations for ' + str(num_chromosome_records_processed) + ' variants on chromosome ' + str(current_chrom) + str(log_suffix))
+   return {'num_pass': num_pass, 'num_rejected': num_rejected}
+
+def summarise_region_sets(query_vcf, region_sets, vcf_infotags_meta, lof_prediction, transcript_xref_index, out_vcf, out_pass_vcf, bgzf_threads = 1):
+   """
+   Function that summarises sets of regions of a bgzipped and tabix-indexed VCF in parallel (one process per set, see summarise_region_set),
+   each process writes its records as a BGZF block stream (all and PASS-only), and the streams are merged in genomic order by copying
+   their compressed blocks after the (annotated) VCF header, i.e. records are compressed once. The tabix indices of the streams are merged likewise
+   """
+   ## passed to each worker process with its task (one task per process, the transcript cross-reference index is loaded once and not re-read by the workers)
+   worker_context = {'vcf_infotags_meta': vcf_infotags_meta, 'lof_prediction': lof_prediction, 'transcript_xref_index': transcript_xref_index, 'bgzf_threads': bgzf_threads}
+   logger.info('Summarising functional annotations in ' + str(len(region_sets)) + ' parallel processes (sets of regions with approximately the same number of variants)')
+
+   part_vcfs = []
+   part_pass_vcfs = []
+   executor = concurrent.futures.ProcessPoolExecutor(max_workers = len(region_sets))
+   summary_runs = []
+   i = 1
+   for regions in region_sets:
+      part_vcfs.append(out_vcf + '.part' + str(i) + '.gz')
+      part_pass_vcfs.append(out_pass_vcf + '.part' + str(i) + '.gz')
+      region_set_label = ' (region set ' + str(i) + '/' + str(len(region_sets)) + ')'
+      summary_runs.append(executor.submit(summarise_region_set, query_vcf, regions, part_vcfs[-1], part_pass_vcfs[-1], region_set_label, worker_context))
+      i = i + 1
+   summary_counts = {'num_pass': 0, 'num_rejected': 0, 'dbnsfp_cache_hits': 0, 'dbnsfp_cache_misses': 0}
+   part_indices = []
+   part_pass_indices = []
+   for summary_run in summary_runs:
+      region_set_counts, part_index, part_pass_index = summary_run.result()
+      for c in summary_counts:
+         summary_counts[c] += region_set_counts[c]
+      part_indices.append(part_index)
+      part_pass_indices.append(part_pass_index)
+   executor.shutdown()
+
+   vcf, summary = open_summary_vcf(query_vcf, vcf_infotags_meta, lof_prediction, transcript_xref_index)
+   header = vcf.raw_header
    vcf.close()
+   annoutils.concatenate_bgzf(out_vcf + '.gz', header, part_vcfs, part_indices)
+   annoutils.concatenate_bgzf(out_pass_vcf + '.gz', header, part_pass_vcfs, part_pass_indices)
+   for part_vcf in part_vcfs + part_pass_vcfs:
+      os.remove(part_vcf)
+   return summary_counts
 
-   if os.path.exists(out_vcf):
-      if os.path.getsize(out_vcf) > 0:
-         os.system('bgzip -f ' + str(out_vcf))
-         os.system('tabix -f -p vcf ' + str(out_vcf) + '.gz')
-         annotated_vcf = out_vcf + '.gz'
-         annoutils.write_pass_vcf(annotated_vcf, logger)
-      else:
-         annoutils.error_message('No remaining PASS variants found in query VCF - exiting and skipping STEP 4 (gvanno-writer)', logger)
-   else:
-      annoutils.error_message('No remaining PASS variants found in query VCF - exiting and skipping STEP 4 (gvanno-writer)', logger)
+def summarise_region_set(query_vcf, regions, part_vcf, part_pass_vcf, region_set_label, worker_context):
+   """
+   Function (run in a worker process) that summarises the records of a set of regions (from get_balanced_regions, a record belongs to
+   the region containing its POS), written as BGZF block streams without header and end-of-file block (see annoutils.concatenate_bgzf)
+   'worker_context' holds the INFO tag metadata, lof_prediction, the transcript cross-reference index and the number of BGZF threads
+   Returns the number of PASS/non-PASS records and dbNSFP cache statistics, along with the indices of both streams
+   """
+   bgzf_threads = worker_context['bgzf_threads']
+   vcf, summary = open_summary_vcf(query_vcf, worker_context['vcf_infotags_meta'], worker_context['lof_prediction'], worker_context['transcript_xref_index'], bgzf_threads)
+   w = annoutils.open_bgzf_writer(part_vcf, eof = False, threads = bgzf_threads, index = 'tbi')
+   w_pass = annoutils.open_bgzf_writer(part_pass_vcf, eof = False, threads = bgzf_threads, index = 'tbi')
+   records = (rec for chrom, start, end in regions for rec in vcf(str(chrom) + ':' + str(start) + '-' + ('' if end is None else str(end))) if rec.POS >= start and (end is None or rec.POS <= end))
+   summary_counts = summarise_records(records, summary, lambda rec: annoutils.write_bgzf(w, str(rec)), lambda rec: annoutils.write_bgzf(w_pass, str(rec)), region_set_label)
+   part_index = annoutils.close_bgzf_writer(w, write_index = False)
+   part_pass_index = annoutils.close_bgzf_writer(w_pass, write_index = False)
+   vcf.close()
+   dbnsfp_cache = annoutils.get_dbnsfp_predictions.cache_info()
+   summary_counts['dbnsfp_cache_hits'] = dbnsfp_cache.hits
+   summary_counts['dbnsfp_cache_misses'] = dbnsfp_cache.misses
+   return (summary_counts, part_index, part_pass_index)
+
+def compile_csq_extractor(vep_csq_fields2index, vep_csq_index2fields, transcript_xref_index):
+   """
+   Function that compiles (once per VCF header) the extraction of VEP CSQ elements
+   1. 'summary_fields' - PICK and the elements of VEP_ALL_CONSEQUENCE (Consequence, SYMBOL, Feature_type, Feature, BIOTYPE), extracted from every
+      CSQ entry split up to 'max_split' elements only
+   2. 'picked_fields' - (index, INFO tag, handler) of all CSQ elements set as INFO tags for the picked CSQ entry, handlers derive additional
+      tags from Feature (transcript cross-references, see annoutils.load_transcript_xref_index), DOMAINS (Pfam domain) and Existing_variation (COSMIC/dbSNP identifiers)
+   """
+
+   def set_transcript_xrefs(rec, ensembl_transcript_id):
+      for annotation, value in annoutils.get_transcript_xrefs(transcript_xref_index, ensembl_transcript_id, rec.CHROM, rec.start, rec.end):
+         rec.INFO[annotation] = value
+
+   def set_pfam_domain(rec, domains):
+      for v in domains.split('&'):
+         if v.startswith('Pfam_domain'):
+            rec.INFO['PFAM_DOMAIN'] = str(re.sub(r'\.[0-9]{1,}$','',re.sub(r'Pfam_domain:','',v)))
+
+   def set_variant_identifiers(rec, existing_variation):
+      cosmic_identifiers = []
+      dbsnp_identifiers = []
+      for v in existing_variation.split('&'):
+         if v.startswith('COSM'):
+            cosmic_identifiers.append(v)
+         if v.startswith('rs'):
+            dbsnp_identifiers.append(v)
+      if len(cosmic_identifiers) > 0:
+         rec.INFO['COSMIC_MUTATION_ID'] = '&'.join(cosmic_identifiers)
+      if len(dbsnp_identifiers) > 0:
+         rec.INFO['DBSNPRSID'] = '&'.join(dbsnp_identifiers)
+
+   handlers = {'Feature': set_transcript_xrefs, 'DOMAINS': set_pfam_domain, 'Existing_variation': set_variant_identifiers}
+   summary_indices = [vep_csq_fields2index[tag] for tag in ['PICK','Consequence','SYMBOL','Feature_type','Feature','BIOTYPE']]
+   csq_extractor = {}
+   csq_extractor['summary_fields'] = operator.itemgetter(*summary_indices)
+   csq_extractor['max_split'] = max(summary_indices) + 1
+   csq_extractor['picked_fields'] = [(j, vep_csq_index2fields[j], handlers.get(vep_csq_index2fields[j])) for j in sorted(vep_csq_index2fields.keys())]
+   return csq_extractor
+
+def set_picked_csq_tags(rec, csq_fields, csq_extractor):
+   """
+   Function that sets all (non-empty) CSQ elements of the picked CSQ entry as INFO tags (see compile_csq_extractor)
+   """
+   info = rec.INFO
+   num_fields = len(csq_fields)
+   for j, tag, handler in csq_extractor['picked_fields']:
+      if j >= num_fields:
+         break
+      if csq_fields[j] != '':
+         info[tag] = csq_fields[j]
+         if not handler is None:
+            handler(rec, csq_fields[j])
 
 if __name__=="__main__": __main__()
 
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
 import csv
+import bisect
+import gzip
+import heapq
+import itertools
+import queue
+import shutil
+import threading
 import re
 import argparse
 import os
@@ -10,7 +17,6 @@ import sys
 import annoutils
 import pandas as np
 import toml
-from cyvcf2 import VCF
 
 def __main__():
    
@@ -19,47 +25,162 @@ def __main__():
    parser.add_argument('input_vcf', help='VCF input file with query variants (SNVs/InDels)')
    parser.add_argument('configuration_file', help='Configuration file (TOML-formatted, e.g. gvanno_conf.toml)')
    parser.add_argument('genome_assembly',help='grch37 or grch38')
+   parser.add_argument('--reference_fasta',help='Reference genome FASTA (indexed with samtools faidx, .fai/.gzi), defines the contig order of the gvanno-ready VCF and is used to left-align decomposed multiallelic variants')
+   parser.add_argument('--num_validation_processes',default=1,type=int,help='Number of parallel vcf-validator processes, each validating the VCF header and every N-th block of variant records')
+   parser.add_argument('--validation_max_errors',default=0,type=int,help='Stop VCF validation once this number of errors is reported (0: no limit)')
+   parser.add_argument('--sort_buffer_size',default=1000000,type=int,help='Maximum number of variant records kept in memory when sorting an unsorted input VCF (external merge sort)')
+   parser.add_argument('--bgzf_threads',default=1,type=int,help='Number of threads for BGZF compression of the gvanno-ready VCF')
 
    args = parser.parse_args()
    
-   ret = validate_gvanno_input(args.gvanno_dir, args.input_vcf, args.configuration_file, args.genome_assembly)
+   ret = validate_gvanno_input(args.gvanno_dir, args.input_vcf, args.configuration_file, args.genome_assembly, args.reference_fasta, args.sort_buffer_size, args.num_validation_processes, args.validation_max_errors, args.bgzf_threads)
    if ret != 0:
       sys.exit(-1)
 
-def is_valid_vcf(input_vcf, logger):
+def start_vcf_validator(input_vcf, logger, num_processes = 1, max_errors = 0, block_size = 10000):
    """
-   Function that reads the output file of EBIvariation/vcf-validator and reports potential errors and validation status 
+   Function that starts EBIvariation/vcf-validator as 'num_processes' separate processes, reading the (decompressed) input VCF from standard input (see tee_vcf_lines)
+   With multiple processes, each validator reads the VCF header and every 'num_processes'-th block of 'block_size' variant records
+   Validation stops early once 'max_errors' errors are reported (0: no limit)
    """
-   
-   logger.info('Validating VCF file with EBIvariation/vcf-validator (version 0.6)')
+   logger.info('Validating VCF file with EBIvariation/vcf-validator (version 0.6, ' + str(num_processes) + ' process(es))')
    vcf_validation_output_file = '/workdir/output/' + re.sub(r'(\.vcf$|\.vcf\.gz$)','.vcf_validator_output',os.path.basename(input_vcf))
-   command_v42 = 'vcf_validator --input ' + str(input_vcf) + ' > ' + str(vcf_validation_output_file) + ' 2>&1'
-   if input_vcf.endswith('.gz'):
-      command_v42 = 'bgzip -dc ' + str(input_vcf) + ' | vcf_validator  > ' + str(vcf_validation_output_file) + ' 2>&1'
-   os.system(command_v42)
+   validator = {}
+   validator['input_vcf'] = input_vcf
+   validator['logger'] = logger
+   validator['processes'] = []
+   validator['output_files'] = []
+   validator['output_offsets'] = []
+   validator['num_header_lines'] = 0
+   validator['num_blocks'] = 0
+   validator['block_size'] = block_size
+   validator['num_errors'] = 0
+   validator['max_errors'] = max_errors
+   validator['stopped'] = False
+   validator['discard_files'] = []
+   for i in range(num_processes):
+      output_file = vcf_validation_output_file
+      if num_processes > 1:
+         output_file = vcf_validation_output_file + '.' + str(i + 1)
+      ## started without a shell, such that terminate() (at the error limit, see tee_vcf_lines) stops the validator itself
+      output = open(output_file,'w')
+      validator['processes'].append(subprocess.Popen(['vcf_validator'], stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT, universal_newlines=True))
+      output.close()
+      validator['output_files'].append(output_file)
+      validator['output_offsets'].append(0)
+   return validator
+
+def write_validator_input(validator, lines, process_index = None):
+   """
+   Function that writes lines of the input VCF to a validator process ('process_index'), or to all validator processes
+   """
+   process_indices = range(len(validator['processes'])) if process_index is None else [process_index]
+   for i in process_indices:
+      if validator['processes'][i].stdin.closed:
+         continue
+      try:
+         validator['processes'][i].stdin.write(''.join(lines))
+      except BrokenPipeError: ## validator stopped reading (reported by is_valid_vcf)
+         close_validator_input(validator, i)
+
+def close_validator_input(validator, process_index):
+   try:
+      validator['processes'][process_index].stdin.close()
+   except BrokenPipeError:
+      pass
+
+def is_validation_error(line):
+   return line.startswith('Line ') and not re.search(r' \(warning\)$', line.rstrip())
+
+def count_validation_errors(validator):
+   """
+   Function that counts the errors reported so far by the validator processes (reading new output only)
+   """
+   for i in range(len(validator['output_files'])):
+      if not os.path.exists(validator['output_files'][i]):
+         continue
+      f = open(validator['output_files'][i],'r')
+      f.seek(validator['output_offsets'][i])
+      output = f.read()
+      f.close()
+      complete_output = output[:output.rfind('\n') + 1]
+      validator['output_offsets'][i] += len(complete_output.encode())
+      for line in complete_output.splitlines():
+         if is_validation_error(line):
+            validator['num_errors'] += 1
+   return validator['num_errors']
+
+def get_global_line_number(validator, process_index, line_number):
+   """
+   Function that maps a line number reported by a validator process to the line number of the input VCF
+   (each validator reads the header and every N-th block of variant records, see start_vcf_validator)
+   """
+   num_header_lines = validator['num_header_lines']
+   if line_number <= num_header_lines:
+      return line_number
+   record_index = line_number - num_header_lines - 1
+   block_index = record_index // validator['block_size'] * len(validator['processes']) + process_index
+   return num_header_lines + 1 + block_index * validator['block_size'] + record_index % validator['block_size']
+
+def report_stopped_validation(validator):
+   """
+   Function that reports validation (and exits) if the validator was stopped at its error limit (see tee_vcf_lines)
+   To be called once no other thread writes to the files that are discarded
+   """
+   if not validator is None and validator['stopped']:
+      is_valid_vcf(validator['input_vcf'], validator, validator['logger'], validator['discard_files'])
+
+def is_valid_vcf(input_vcf, validator, logger, discard_files = []):
+   """
+   Function that waits for the EBIvariation/vcf-validator process(es) to finish, and reports potential errors (with line numbers of the input VCF) and validation status
+   Files in 'discard_files' (i.e. output produced concurrently with validation) are removed if the VCF is not valid
+   """
+   for i in range(len(validator['processes'])):
+      close_validator_input(validator, i)
+      validator['processes'][i].wait()
       
    validation_results = {}
-   validation_results['validation_status'] = 0
+   validation_results['validation_status'] = 1
    validation_results['error_messages'] = []
-   if os.path.exists(vcf_validation_output_file):
-      f = open(vcf_validation_output_file,'r')
-      for line in f:
-         if not re.search(r' \(warning\)$|Reading from ',line.rstrip()): ## ignore warnings
-            if line.startswith('Line '):
-               validation_results['error_messages'].append('ERROR: ' + line.rstrip())
-            if 'the input file is valid' in line.rstrip(): ## valid VCF
-               validation_results['validation_status'] = 1
-            if 'the input file is not valid' in line.rstrip():  ## non-valid VCF
-               validation_results['validation_status'] = 0
-      f.close()
-      os.system('rm -f ' + str(vcf_validation_output_file))
-   else:
-      err_msg = str(vcf_validation_output_file) + ' does not exist'
-      return annoutils.error_message(err_msg, logger)
+   for i in range(len(validator['output_files'])):
+      vcf_validation_output_file = validator['output_files'][i]
+      if os.path.exists(vcf_validation_output_file):
+         process_status = 0
+         f = open(vcf_validation_output_file,'r')
+         for line in f:
+            if not re.search(r' \(warning\)$|Reading from ',line.rstrip()): ## ignore warnings
+               if line.startswith('Line '):
+                  line_number = re.match(r'^Line ([0-9]+)', line)
+                  global_line_number = 0
+                  if not line_number is None:
+                     global_line_number = get_global_line_number(validator, i, int(line_number.group(1)))
+                     line = 'Line ' + str(global_line_number) + line[line_number.end():]
+                  error_message = (global_line_number, 'ERROR: ' + line.rstrip())
+                  if not error_message in validation_results['error_messages']: ## header errors are reported by all validators
+                     validation_results['error_messages'].append(error_message)
+               if 'the input file is valid' in line.rstrip(): ## valid VCF
+                  process_status = 1
+               if 'the input file is not valid' in line.rstrip():  ## non-valid VCF
+                  process_status = 0
+         f.close()
+         os.system('rm -f ' + str(vcf_validation_output_file))
+         if process_status == 0:
+            validation_results['validation_status'] = 0
+      else:
+         err_msg = str(vcf_validation_output_file) + ' does not exist'
+         return annoutils.error_message(err_msg, logger)
    
    if validation_results['validation_status'] == 0:
-      error_string_42 = '\n'.join(validation_results['error_messages'])
+      error_messages = sorted(validation_results['error_messages'])
+      if validator['max_errors'] > 0:
+         error_messages = error_messages[:validator['max_errors']]
+      error_string_42 = '\n'.join(message for line_number, message in error_messages)
       validation_status = 'According to the VCF specification, the VCF file (' + str(input_vcf) + ') is NOT valid'
+      if validator['max_errors'] > 0 and validator['num_errors'] >= validator['max_errors']:
+         validation_status = validation_status + ' (validation stopped after ' + str(validator['num_errors']) + ' errors)'
+      for fname in discard_files:
+         if os.path.exists(fname):
+            os.remove(fname)
       err_msg = validation_status + ':\n' + str(error_string_42)
       return annoutils.error_message(err_msg, logger)
    else:
@@ -67,101 +188,468 @@ def is_valid_vcf(input_vcf, logger):
       logger.info(validation_status)
    return 0
 
-def check_existing_vcf_info_tags(input_vcf, gvanno_directory, genome_assembly, logger):
+def check_existing_vcf_info_tags(header_lines, gvanno_directory, genome_assembly, logger):
    
    """
-   Function that compares the INFO tags in the query VCF and the INFO tags generated by gvanno
+   Function that compares the INFO tags in the query VCF (header lines) and the INFO tags generated by gvanno
    If any coinciding tags, an error will be returned
    """
    
    gvanno_infotags_desc = annoutils.read_infotag_file(os.path.join(gvanno_directory,'data',genome_assembly,'gvanno_infotags.tsv'))
          
-   vcf = VCF(input_vcf)
    logger.info('Checking if existing INFO tags of query VCF file coincide with gvanno INFO tags')
    ret = 1
-   for e in vcf.header_iter():
-      header_element = e.info()
-      if 'ID' in header_element.keys() and 'HeaderType' in header_element.keys():
-         if header_element['HeaderType'] == 'INFO':
-            if header_element['ID'] in gvanno_infotags_desc.keys():
-               err_msg = 'INFO tag ' + str(header_element['ID']) + ' in the query VCF coincides with a VCF annotation tag produced by gvanno - please remove or rename this tag in your query VCF'
-               return annoutils.error_message(err_msg, logger)
+   for line in header_lines:
+      if line.startswith('##INFO=<ID='):
+         info_tag = re.split(r'[,>]', line[11:], 1)[0]
+         if info_tag in gvanno_infotags_desc.keys():
+            err_msg = 'INFO tag ' + str(info_tag) + ' in the query VCF coincides with a VCF annotation tag produced by gvanno - please remove or rename this tag in your query VCF'
+            return annoutils.error_message(err_msg, logger)
    
    logger.info('No query VCF INFO tags coincide with gvanno INFO tags')
    return ret
 
-def simplify_vcf(input_vcf, vcf, logger):
-   
+def get_contig_order(reference_fai):
    """
-   Function that performs tre things on the validated input VCF:
-   1. Strip of any genotype data
-   2. If VCF have variants with multiple alternative alleles ("multiallelic", e.g. 'A,T'), these are decomposed into variants with a single alternative allele
-   3. Final VCF file is sorted and indexed (bgzip + tabix)
+   Function that reads the contig order (contig name -> rank) from a FASTA index (.fai) of the reference genome
    """
+   contig_order = {}
+   if not reference_fai is None and os.path.exists(reference_fai):
+      f = open(reference_fai,'r')
+      for line in f:
+         contig = line.split('\t',1)[0]
+         if not contig in contig_order:
+            contig_order[contig] = len(contig_order)
+      f.close()
+   return contig_order
+
+def get_contig_sort_key(chrom, contig_order):
+   """
+   Function that returns a sort key for a contig: contigs in the reference FASTA index come first (in index order),
+   followed by other numeric contigs (numerically), X/Y/M contigs and remaining contigs (lexically)
+   """
+   if chrom in contig_order:
+      return (0, contig_order[chrom], '')
+   if chrom[:1].isdigit():
+      return (1, int(re.match(r'[0-9]+', chrom).group(0)), chrom)
+   if chrom[:1] in ['X','Y','M']:
+      return (2, 0, chrom)
+   return (3, 0, chrom)
+
+def split_allele_values(value, number, allele_index, num_alts):
+   """
+   Function that returns the values of an INFO/FORMAT element for a single alternative allele (1-based 'allele_index') of a multiallelic record,
+   according to its Number in the VCF header (A: one value per alternative allele, R: one value per allele, G: one value per (diploid) genotype)
+   """
+   if number is None or value == '.' or not number in ['A','R','G']:
+      return value
+   values = value.split(',')
+   if number == 'A' and len(values) == num_alts:
+      return values[allele_index - 1]
+   if number == 'R' and len(values) == num_alts + 1:
+      return values[0] + ',' + values[allele_index]
+   if number == 'G' and len(values) == (num_alts + 1) * (num_alts + 2) // 2:
+      het_index = allele_index * (allele_index + 1) // 2
+      return values[0] + ',' + values[het_index] + ',' + values[het_index + allele_index]
+   return value
+
+def split_genotype(genotype, allele_index):
+   """
+   Function that recodes a genotype (GT) of a multiallelic record for a single alternative allele (other alternative alleles become missing, as vt decompose)
+   """
+   alleles = re.split(r'([/|])', genotype)
+   for i in range(0, len(alleles), 2):
+      if alleles[i] == str(allele_index):
+         alleles[i] = '1'
+      elif alleles[i] != '0' and alleles[i] != '.':
+         alleles[i] = '.'
+   return ''.join(alleles)
+
+def decompose_multiallelic_record(line, header_numbers, fasta = None):
+   """
+   Function that decomposes a multiallelic VCF record into one record per alternative allele, splitting INFO/FORMAT values per allele
+   (header_numbers: INFO/FORMAT tag -> Number) and recording the original record in INFO tag OLD_MULTIALLELIC (as vt decompose -s)
+   With an indexed reference FASTA, each decomposed variant is also trimmed and left-aligned
+   """
+   fields = line.rstrip('\n').split('\t')
+   alts = fields[4].split(',')
+   num_alts = len(alts)
+   old_multiallelic = 'OLD_MULTIALLELIC=' + str(fields[0]) + ':' + str(fields[1]) + ':' + str(fields[3]) + '/' + '/'.join(alts)
+   info_elements = []
+   if fields[7] != '.' and fields[7] != '':
+      info_elements = fields[7].split(';')
+   format_tags = []
+   if len(fields) > 8:
+      format_tags = fields[8].split(':')
+
+   decomposed_lines = []
+   for allele_index in range(1, num_alts + 1):
+      info = []
+      for element in info_elements:
+         tag, sep, value = element.partition('=')
+         if sep == '':
+            info.append(element)
+         else:
+            info.append(tag + '=' + split_allele_values(value, header_numbers['INFO'].get(tag), allele_index, num_alts))
+      info.append(old_multiallelic)
+      pos, ref, alt = int(fields[1]), fields[3], alts[allele_index - 1]
+      if not fasta is None:
+         pos, ref, alt = annoutils.left_align_variant(fasta, fields[0], pos, ref, alt)
+      decomposed_fields = [fields[0], str(pos), fields[2], ref, alt, fields[5], fields[6], ';'.join(info)]
+      if len(fields) > 8:
+         decomposed_fields.append(fields[8])
+         for sample_data in fields[9:]:
+            values = sample_data.split(':')
+            for i in range(min(len(values), len(format_tags))):
+               if format_tags[i] == 'GT':
+                  values[i] = split_genotype(values[i], allele_index)
+               else:
+                  values[i] = split_allele_values(values[i], header_numbers['FORMAT'].get(format_tags[i]), allele_index, num_alts)
+            decomposed_fields.append(':'.join(values))
+      decomposed_lines.append('\t'.join(decomposed_fields) + '\n')
+   return decomposed_lines
+
+def normalize_vcf(vcf_lines, output_vcf, contig_order, logger, sort_buffer_size = 1000000, fasta = None, bgzf_threads = 1):
+   """
+   Function that streams the lines of the input VCF ('vcf_lines') once, and writes a sorted VCF (bgzipped and tabix-indexed on the fly, see annoutils.open_bgzf_writer) where
+   1. any 'chr' prefix is stripped from contig names
+   2. multiallelic records are decomposed (and left-aligned with an indexed reference FASTA), see decompose_multiallelic_record
+   Records are written (through a small reorder window, for left-aligned records) while the input is sorted (contig order of 'contig_order', position, ID, REF).
+   If the input is not sorted, the sorted part written so far and chunks of at most 'sort_buffer_size' sorted records (temporary runs) are merged (external merge sort)
+   Records are compressed as a block stream without header, the header (with INFO tag OLD_MULTIALLELIC only if a multiallelic record was decomposed) is written in front
+   of the stream when the output is completed (see annoutils.concatenate_bgzf)
+   Returns the number of decomposed multiallelic records
+   """
+   reorder_window = 1000
+   contig_sort_keys = {}
+   def record_sort_key(line):
+      fields = line.split('\t',5)
+      if not fields[0] in contig_sort_keys:
+         contig_sort_keys[fields[0]] = get_contig_sort_key(fields[0], contig_order)
+      return (contig_sort_keys[fields[0]], int(fields[1]), fields[2], fields[3], line)
+
+   def write_sort_run(buffered_lines):
+      run_fname = output_vcf + '.sort_run' + str(len(sort_runs)) + '.gz'
+      run = gzip.open(run_fname,'wt',compresslevel = 1)
+      run.writelines(sorted(buffered_lines, key = record_sort_key))
+      run.close()
+      sort_runs.append(run_fname)
+
+   header_lines = []
+   header_numbers = {'INFO': {}, 'FORMAT': {}}
+   buffered_lines = []
+   sort_runs = []
+   pending_lines = []
+   pending_keys = []
+   flushed_key = None
+   num_decomposed = 0
+   records_vcf = output_vcf + '.records.gz'
+   writer = annoutils.open_bgzf_writer(records_vcf, eof = False, threads = bgzf_threads, index = 'tbi')
+   for line in vcf_lines:
+      if line.startswith('#'):
+         header_element = re.match(r'^##(INFO|FORMAT)=<ID=([^,>]+),Number=([^,>]+)', line)
+         if not header_element is None:
+            header_numbers[header_element.group(1)][header_element.group(2)] = header_element.group(3)
+         header_lines.append(line)
+         continue
+      if line.startswith('chr'):
+         line = line[3:]
+      if not line.endswith('\n'):
+         line = line + '\n'
+      record_lines = [line]
+      fields = line.split('\t',5)
+      if ',' in fields[4]:
+         logger.warning("Multiallelic site detected:" + str(fields[0]) + '\t' + str(fields[1]) + '\t' + str(fields[3]) + '\t' + str(fields[4]))
+         record_lines = decompose_multiallelic_record(line, header_numbers, fasta)
+         num_decomposed += 1
+      for record_line in record_lines:
+         if writer is None:
+            buffered_lines.append(record_line)
+            if len(buffered_lines) >= sort_buffer_size:
+               write_sort_run(buffered_lines)
+               buffered_lines = []
+            continue
+         key = record_sort_key(record_line)
+         if not flushed_key is None and key < flushed_key:
+            ## input is not sorted - records written so far become the first (sorted) run
+            logger.info('Input VCF is not sorted - sorting variant records (external merge sort, ' + str(sort_buffer_size) + ' records per run)')
+            annoutils.write_bgzf(writer, ''.join(pending_lines))
+            annoutils.close_bgzf_writer(writer, write_index = False)
+            writer = None
+            os.rename(records_vcf, output_vcf + '.sort_run.gz')
+            sort_runs.append(output_vcf + '.sort_run.gz')
+            buffered_lines.append(record_line)
+            continue
+         if len(pending_keys) == 0 or not key < pending_keys[-1]:
+            pending_lines.append(record_line)
+            pending_keys.append(key)
+         else:
+            i = bisect.bisect_right(pending_keys, key)
+            pending_lines.insert(i, record_line)
+            pending_keys.insert(i, key)
+         if len(pending_lines) >= 2 * reorder_window:
+            annoutils.write_bgzf(writer, ''.join(pending_lines[:reorder_window]))
+            flushed_key = pending_keys[reorder_window - 1]
+            del pending_lines[:reorder_window]
+            del pending_keys[:reorder_window]
+
+   if writer is None:
+      if len(buffered_lines) > 0:
+         write_sort_run(buffered_lines)
+         buffered_lines = []
+      run_files = [gzip.open(run_fname,'rt') for run_fname in sort_runs]
+      runs = [(line for line in run if not line.startswith('#')) for run in run_files]
+      merged_records = heapq.merge(*runs, key = record_sort_key)
+      writer = annoutils.open_bgzf_writer(records_vcf, eof = False, threads = bgzf_threads, index = 'tbi')
+      for merged_lines in iter(lambda: list(itertools.islice(merged_records, reorder_window)), []):
+         annoutils.write_bgzf(writer, ''.join(merged_lines))
+      for run in run_files:
+         run.close()
+      for run_fname in sort_runs:
+         os.remove(run_fname)
+      logger.info('Merged ' + str(len(sort_runs)) + ' sorted runs')
+   else:
+      annoutils.write_bgzf(writer, ''.join(pending_lines))
+   records_index = annoutils.close_bgzf_writer(writer, write_index = False)
+
+   if num_decomposed > 0 and not 'OLD_MULTIALLELIC' in header_numbers['INFO']:
+      old_multiallelic_header = '##INFO=<ID=OLD_MULTIALLELIC,Number=1,Type=String,Description="Original chr:pos:ref/alt encoding of decomposed multiallelic variant">\n'
+      if len(header_lines) > 0 and header_lines[-1].startswith('#CHROM'):
+         header_lines.insert(len(header_lines) - 1, old_multiallelic_header)
+      else:
+         header_lines.append(old_multiallelic_header)
+   annoutils.concatenate_bgzf(output_vcf, ''.join(header_lines), [records_vcf], [records_index])
+   os.remove(records_vcf)
+   return num_decomposed
+
+def has_gvanno_ready_layout(input_vcf):
+   """
+   Function that checks whether the input VCF is bgzipped (BGZF) with an up-to-date tabix index, i.e. whether it can be re-used as is if gvanno-ready (see is_gvanno_ready)
+   """
+   if not input_vcf.endswith('.gz') or not os.path.exists(input_vcf + '.tbi'):
+      return False
+   if os.path.getmtime(input_vcf + '.tbi') < os.path.getmtime(input_vcf):
+      return False
+   f = open(input_vcf,'rb')
+   bgzf_header = f.read(16)
+   f.close()
+   return len(bgzf_header) == 16 and bgzf_header[:4] == b'\x1f\x8b\x08\x04' and bgzf_header[12:14] == b'BC'
+
+def is_gvanno_ready(vcf_lines, contig_order, logger, max_read_lines = 1000000):
+   """
+   Function that checks whether the variant records of the input VCF ('vcf_lines') are already gvanno-ready, i.e.
+   no 'chr' prefix in contig names, no multiallelic records, and sorted as normalize_vcf would sort them
+   Returns the status and the lines read from 'vcf_lines' (to be normalized if the VCF is not gvanno-ready), or None if more than 'max_read_lines' lines were read
+   """
+   contig_sort_keys = {}
+   previous_key = None
+   read_lines = []
+   for line in vcf_lines:
+      if not read_lines is None:
+         read_lines.append(line)
+         if len(read_lines) > max_read_lines:
+            read_lines = None
+      if line.startswith('#'):
+         continue
+      fields = line.split('\t',5)
+      if fields[0].startswith('chr') or ',' in fields[4]:
+         return (False, read_lines)
+      if not fields[0] in contig_sort_keys:
+         contig_sort_keys[fields[0]] = get_contig_sort_key(fields[0], contig_order)
+      key = (contig_sort_keys[fields[0]], int(fields[1]), fields[2], fields[3])
+      if not previous_key is None and key < previous_key:
+         return (False, read_lines)
+      previous_key = key
+   logger.info('Input VCF is already sorted, biallelic and without \'chr\' prefix - re-using bgzipped file and tabix index')
+   return (True, None)
+
+def tee_vcf_lines(vcf_lines, validator = None):
+   """
+   Generator that yields the lines of the input VCF, while feeding them (header lines to all, blocks of variant records in turn) to the VCF validator process(es)
+   Once the error limit of the validator is reached, the validator processes are stopped, and so is the generator (without reading the remaining lines),
+   validation is then to be reported by the caller (see report_stopped_validation)
+   """
+   batch = []
+   for line in vcf_lines:
+      if not validator is None:
+         if line.startswith('#') and validator['num_blocks'] == 0 and len(batch) == 0:
+            validator['num_header_lines'] += 1
+            write_validator_input(validator, [line])
+         else:
+            batch.append(line)
+            if len(batch) >= validator['block_size']:
+               write_validator_input(validator, batch, validator['num_blocks'] % len(validator['processes']))
+               validator['num_blocks'] += 1
+               batch = []
+               if validator['max_errors'] > 0 and validator['num_blocks'] % len(validator['processes']) == 0:
+                  if count_validation_errors(validator) >= validator['max_errors']:
+                     for process in validator['processes']:
+                        process.terminate()
+                     validator['stopped'] = True
+                     return
+      yield line
+   if not validator is None:
+      if len(batch) > 0:
+         write_validator_input(validator, batch, validator['num_blocks'] % len(validator['processes']))
+         validator['num_blocks'] += 1
+      for i in range(len(validator['processes'])):
+         close_validator_input(validator, i)
+
+def normalize_vcf_concurrently(vcf_lines, output_vcf, contig_order, logger, sort_buffer_size = 1000000, fasta = None, bgzf_threads = 1, batch_size = 10000, validator = None):
+   """
+   Function that runs normalize_vcf in a separate thread, fed (through a bounded queue) with batches of lines read by the calling thread,
+   such that decompression (and validation) of the input VCF overlaps with normalization
+   If the validator stopped at its error limit, validation is reported (and the output discarded) once the normalizer has finished
+   """
+   line_batches = queue.Queue(maxsize = 64)
+   result = {}
+
+   def queued_lines():
+      while True:
+         batch = line_batches.get()
+         if batch is None:
+            return
+         for line in batch:
+            yield line
+
+   def normalize():
+      try:
+         result['num_decomposed'] = normalize_vcf(queued_lines(), output_vcf, contig_order, logger, sort_buffer_size, fasta, bgzf_threads)
+      except (IOError, ValueError) as e:
+         result['error'] = str(e)
+
+   def put_batch(batch):
+      while True:
+         try:
+            line_batches.put(batch, timeout = 1)
+            return
+         except queue.Full:
+            if not normalizer.is_alive():
+               annoutils.error_message('Normalization of input VCF failed', logger)
+
+   normalizer = threading.Thread(target = normalize)
+   normalizer.daemon = True
+   normalizer.start()
+   batch = []
+   for line in vcf_lines:
+      batch.append(line)
+      if len(batch) >= batch_size:
+         put_batch(batch)
+         batch = []
+   put_batch(batch)
+   put_batch(None)
+   normalizer.join()
+   report_stopped_validation(validator)
+   if not 'num_decomposed' in result:
+      annoutils.error_message('Normalization of input VCF failed' + (': ' + str(result['error']) if 'error' in result else ''), logger)
+   return result['num_decomposed']
+
+def reuse_gvanno_ready_vcf(input_vcf, input_vcf_gvanno_ready, logger):
+   """
+   Function that re-uses a gvanno-ready input VCF and its tabix index (without decompression/recompression), as hard links if the input and output
+   directories are on the same file system, otherwise as plain copies. Note that in the gvanno Docker container the input (/workdir/input_vcf) and output
+   (/workdir/output) directories are separate mounts, hence the files are copied. Symbolic links are not used, as later workflow steps do not mount the input directory
+   """
+   linked = True
+   for suffix in ['', '.tbi']:
+      if os.path.exists(input_vcf_gvanno_ready + suffix):
+         os.remove(input_vcf_gvanno_ready + suffix)
+      try:
+         os.link(input_vcf + suffix, input_vcf_gvanno_ready + suffix)
+      except OSError:
+         shutil.copyfile(input_vcf + suffix, input_vcf_gvanno_ready + suffix)
+         linked = False
+   if linked:
+      logger.info('Linked gvanno-ready input VCF and tabix index to ' + str(input_vcf_gvanno_ready))
+   else:
+      logger.info('Copied gvanno-ready input VCF and tabix index to ' + str(input_vcf_gvanno_ready))
+
+def simplify_vcf(input_vcf, gvanno_directory, genome_assembly, logger, reference_fasta = None, sort_buffer_size = 1000000, validator = None, bgzf_threads = 1):
    
-   input_vcf_gvanno_ready = '/workdir/output/' + re.sub(r'(\.vcf$|\.vcf\.gz$)','.gvanno_ready.tmp.vcf',os.path.basename(input_vcf))
-   input_vcf_gvanno_ready_decomposed = '/workdir/output/' + re.sub(r'(\.vcf$|\.vcf\.gz$)','.gvanno_ready.vcf',os.path.basename(input_vcf))
-   
-   multiallelic_alt = 0
-   for rec in vcf:
-      POS = rec.start + 1
-      alt = ",".join(str(n) for n in rec.ALT)
-      if len(rec.ALT) > 1:
-         logger.warning("Multiallelic site detected:" + str(rec.CHROM) + '\t' + str(POS) + '\t' + str(rec.REF) + '\t' + str(alt))
-         multiallelic_alt = 1
+   """
+   Function that reads the input VCF once (decompressed lines are also fed to the VCF validator, if any, see tee_vcf_lines), and
+   1. Checks that no INFO annotation tags in the query VCF coincides with those generated by gvanno
+   2. Strips of any 'chr' prefix in contig names
+   3. If VCF have variants with multiple alternative alleles ("multiallelic", e.g. 'A,T'), these are decomposed into variants with a single alternative allele (and left-aligned)
+   4. Final VCF file is sorted (contig order of the reference genome), bgzipped and tabix-indexed (on the fly, see normalize_vcf)
+   An input VCF that is already gvanno-ready is re-used as is (see is_gvanno_ready), otherwise 2-4 are performed by a concurrent normalizer (see normalize_vcf_concurrently)
+   """
    
-   command_vcf_sample_free1 = 'egrep \'^#\' ' + str(input_vcf) + ' > ' + str(input_vcf_gvanno_ready)
-   command_vcf_sample_free2 = 'egrep -v \'^#\' ' + str(input_vcf) + ' | sed \'s/^chr//\' | egrep \'^[0-9]\' | sort -k1,1n -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
-   command_vcf_sample_free3 = 'egrep -v \'^#\' ' + str(input_vcf) + ' | sed \'s/^chr//\' | egrep -v \'^[0-9]\' | egrep \'^[XYM]\' | sort -k1,1 -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
-   command_vcf_sample_free4 = 'egrep -v \'^#\' ' + str(input_vcf) + ' | sed \'s/^chr//\' | egrep -v \'^[0-9]\' | egrep -v \'^[XYM]\' | sort -k1,1 -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
-   if input_vcf.endswith('.gz'):
-      command_vcf_sample_free1 = 'bgzip -dc ' + str(input_vcf) + ' | egrep \'^#\' > ' + str(input_vcf_gvanno_ready)
-      command_vcf_sample_free2 = 'bgzip -dc ' + str(input_vcf) + ' | egrep -v \'^#\' | sed \'s/^chr//\' | egrep \'^[0-9]\' | sort -k1,1n -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
-      command_vcf_sample_free3 = 'bgzip -dc ' + str(input_vcf) + ' | egrep -v \'^#\' | sed \'s/^chr//\' | egrep -v \'^[0-9]\' | egrep \'^[XYM]\' | sort -k1,1 -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
-      command_vcf_sample_free4 = 'bgzip -dc ' + str(input_vcf) + ' | egrep -v \'^#\' | sed \'s/^chr//\' | egrep -v \'^[0-9]\' | egrep -v \'^[XYM]\' | sort -k1,1 -k2,2n -k3,3 -k4,4 >> ' + str(input_vcf_gvanno_ready)
+   input_vcf_gvanno_ready = '/workdir/output/' + re.sub(r'(\.vcf$|\.vcf\.gz$)','.gvanno_ready.vcf.gz',os.path.basename(input_vcf))
+   if not validator is None:
+      validator['discard_files'] = [input_vcf_gvanno_ready, input_vcf_gvanno_ready + '.tbi']
    
-   os.system(command_vcf_sample_free1)
-   os.system(command_vcf_sample_free2)
-   os.system(command_vcf_sample_free3)
-   os.system(command_vcf_sample_free4)
-
-   if multiallelic_alt == 1:
-      logger.info('Decomposing multi-allelic sites in input VCF file using \'vt decompose\'')
-      command_decompose = 'vt decompose -s ' + str(input_vcf_gvanno_ready) + ' > ' + str(input_vcf_gvanno_ready_decomposed) + ' 2> /workdir/output/decompose.log'
-      os.system(command_decompose)
+   fasta = None
+   if not reference_fasta is None:
+      fasta = annoutils.open_indexed_fasta(reference_fasta)
+   contig_order = {}
+   if fasta is None:
+      logger.warning('Indexed reference FASTA (' + str(reference_fasta) + ') not found - contigs are ordered numerically/lexically, and decomposed multiallelic variants are not left-aligned')
    else:
-      command_copy = 'cp ' + str(input_vcf_gvanno_ready) + ' ' + str(input_vcf_gvanno_ready_decomposed)
-      os.system(command_copy)
-   os.system('bgzip -f ' + str(input_vcf_gvanno_ready_decomposed))
-   os.system('tabix -p vcf ' + str(input_vcf_gvanno_ready_decomposed) + '.gz')
-   os.system('rm -f ' + str(input_vcf_gvanno_ready) + ' /workdir/output/decompose.log')
+      contig_order = get_contig_order(str(reference_fasta) + '.fai')
+
+   f = gzip.open(input_vcf,'rt') if input_vcf.endswith('.gz') else open(input_vcf,'r')
+   vcf_lines = tee_vcf_lines(f, validator)
+   header_lines = []
+   for line in vcf_lines:
+      header_lines.append(line)
+      if not line.startswith('##'):
+         break
+   check_existing_vcf_info_tags(header_lines, gvanno_directory, genome_assembly, logger)
 
-def validate_gvanno_input(gvanno_directory, input_vcf, configuration_file, genome_assembly):
+   if has_gvanno_ready_layout(input_vcf):
+      (gvanno_ready, read_lines) = is_gvanno_ready(vcf_lines, contig_order, logger, sort_buffer_size)
+      if gvanno_ready:
+         for line in vcf_lines: ## remaining lines are still read by the VCF validator
+            pass
+         f.close()
+         report_stopped_validation(validator)
+         reuse_gvanno_ready_vcf(input_vcf, input_vcf_gvanno_ready, logger)
+         return input_vcf_gvanno_ready
+      if read_lines is None:
+         ## too many lines read before the first record that is not gvanno-ready, read the input VCF again (without validation)
+         for line in vcf_lines:
+            pass
+         f.close()
+         report_stopped_validation(validator)
+         f = gzip.open(input_vcf,'rt')
+         vcf_lines = f
+      else:
+         ## normalize the lines read so far, and the remaining lines of the same read
+         vcf_lines = itertools.chain(header_lines, read_lines, vcf_lines)
+   else:
+      vcf_lines = itertools.chain(header_lines, vcf_lines)
+
+   num_decomposed = normalize_vcf_concurrently(vcf_lines, input_vcf_gvanno_ready, contig_order, logger, sort_buffer_size, fasta, bgzf_threads, validator = validator)
+   f.close()
+   if num_decomposed > 0:
+      logger.info('Decomposed ' + str(num_decomposed) + ' multi-allelic sites in input VCF file')
+   return input_vcf_gvanno_ready
+
+def validate_gvanno_input(gvanno_directory, input_vcf, configuration_file, genome_assembly, reference_fasta = None, sort_buffer_size = 1000000, num_validation_processes = 1, validation_max_errors = 0, bgzf_threads = 1):
    """
    Function that reads the input file to gvanno (VCF file) and performs the following checks:
    1. Check that VCF file is properly formatted (according to EBIvariation/vcf-validator - VCF v4.2)
    2. Check that no INFO annotation tags in the query VCF coincides with those generated by gvanno
-   3. Check that if VCF have variants with multiple alternative alleles (e.g. 'A,T') run vt decompose
+   3. Check that if VCF have variants with multiple alternative alleles (e.g. 'A,T'), these are decomposed (and left-aligned)
    4. Any genotype data from VCF input file is stripped, and the resulting VCF file is sorted and indexed (bgzip + tabix) 
+   Validation runs concurrently with 2-4, on the same (single) read of the input VCF - the gvanno-ready VCF is discarded if the input VCF is not valid
    """
    logger = annoutils.getlogger('gvanno-validate-input')
    config_options = annoutils.read_config_options(configuration_file, gvanno_directory, genome_assembly, logger, wflow = 'gvanno')
 
    
    if not input_vcf == 'None':
+      validator = None
       if config_options['other']['vcf_validation']:
-         valid_vcf = is_valid_vcf(input_vcf, logger)
-         if valid_vcf == -1:
-            return -1
+         validator = start_vcf_validator(input_vcf, logger, num_validation_processes, validation_max_errors)
       else:
          logger.info('Skipping validation of VCF file - as defined in configuration file (vcf_validation = false)')
-      tag_check = check_existing_vcf_info_tags(input_vcf, gvanno_directory, genome_assembly, logger)
-      if tag_check == -1:
-         return -1
-      
-      vcf = VCF(input_vcf)
-      
-      simplify_vcf(input_vcf, vcf, logger)
+      input_vcf_gvanno_ready = simplify_vcf(input_vcf, gvanno_directory, genome_assembly, logger, reference_fasta, sort_buffer_size, validator, bgzf_threads)
+      if not validator is None:
+         valid_vcf = is_valid_vcf(input_vcf, validator, logger, validator['discard_files'])
+         if valid_vcf == -1:
+            return -1
    
    return 0
    
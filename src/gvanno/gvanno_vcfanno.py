@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
 import argparse
-from cyvcf2 import VCF
+import gzip
 import random
 import annoutils
 import os
 import re
 import sys
+import subprocess
+import threading
+import shutil
 
 logger = annoutils.getlogger('gvanno-vcfanno')
 
@@ -23,14 +26,28 @@ def __main__():
    parser.add_argument("--gvanno_xref",action = "store_true", help="Annotate VCF with transcript annotations from gvanno (protein complexes, disease associations, etc)")
    parser.add_argument("--gwas",action = "store_true", help="Annotate VCF with against known loci associated with cancer, as identified from genome-wide association studies (GWAS)")
    parser.add_argument("--cancer_hotspots",action = "store_true", help="Annotate VCF with mutation hotspots from cancerhotspots.org")
+   parser.add_argument("--stream",action = "store_true", help="Read query VCF from standard input (query_vcf = '-') and write annotated VCF to standard output (out_vcf is then only used to name temporary files)")
+   parser.add_argument('--bgzf_threads', default=1, type=int, help="Number of threads for BGZF compression of the annotated VCF")
 
    
    args = parser.parse_args()
-   query_info_tags = get_vcf_info_tags(args.query_vcf)
    vcfheader_file = args.out_vcf + '.tmp.' + str(random.randrange(0,10000000)) + '.header.txt'
    conf_fname = args.out_vcf + '.tmp.conf.toml'
-   print_vcf_header(args.query_vcf, vcfheader_file, chromline_only = False)
-   run_vcfanno(args.num_processes, args.query_vcf, query_info_tags, vcfheader_file, args.gvanno_db_dir, conf_fname, args.out_vcf, args.clinvar, args.dbnsfp, args.uniprot, args.gvanno_xref,args.gwas, args.cancer_hotspots)
+   if args.stream is True:
+      ## standard output carries the annotated VCF - log to standard error
+      for handler in logger.handlers:
+         handler.stream = sys.stderr
+      query_header_lines = read_vcf_header_stream(sys.stdin.buffer)
+   else:
+      ## only the header of the (bgzipped) query VCF is decompressed
+      f = gzip.open(args.query_vcf, 'rb')
+      query_header_lines = read_vcf_header_stream(f)
+      f.close()
+   query_info_tags = get_vcf_info_tags_header(query_header_lines)
+   f = open(vcfheader_file, 'wb')
+   f.write(b''.join(l for l in query_header_lines if not l.startswith(b'#CHROM')))
+   f.close()
+   run_vcfanno(args.num_processes, args.query_vcf, query_info_tags, vcfheader_file, args.gvanno_db_dir, conf_fname, args.out_vcf, args.clinvar, args.dbnsfp, args.uniprot, args.gvanno_xref,args.gwas, args.cancer_hotspots, query_header_lines, stream = args.stream, bgzf_threads = args.bgzf_threads)
 
 
 def prepare_vcfanno_configuration(vcfanno_data_directory, conf_fname, vcfheader_file, logger, datasource_info_tags, query_info_tags, datasource):
@@ -40,9 +57,11 @@ def prepare_vcfanno_configuration(vcfanno_data_directory, conf_fname, vcfheader_
    append_to_conf_file(datasource, datasource_info_tags, vcfanno_data_directory, conf_fname)
    append_to_vcf_header(vcfanno_data_directory, datasource, vcfheader_file)
 
-def run_vcfanno(num_processes, query_vcf, query_info_tags, vcfheader_file, gvanno_db_directory, conf_fname, output_vcf, clinvar, dbnsfp, uniprot, gvanno_xref,gwas, cancer_hotspots):
+def run_vcfanno(num_processes, query_vcf, query_info_tags, vcfheader_file, gvanno_db_directory, conf_fname, output_vcf, clinvar, dbnsfp, uniprot, gvanno_xref,gwas, cancer_hotspots, query_header_lines, stream = False, bgzf_threads = 1):
    """
    Function that annotates a VCF file with vcfanno against a user-defined set of germline and somatic VCF files
+   The annotated VCF (vcfanno output with the gvanno header, i.e. the header lines of 'vcfheader_file' and the #CHROM line of 'query_header_lines') is
+   bgzipped and tabix-indexed while vcfanno runs. With 'stream', the query VCF body is read from standard input (header already consumed), and the annotated VCF is written to standard output
    """
    clinvar_info_tags = ["CLINVAR_MSID","CLINVAR_PMID","CLINVAR_CLNSIG","CLINVAR_VARIANT_ORIGIN","CLINVAR_CONFLICTED","CLINVAR_MEDGEN_CUI","CLINVAR_MEDGEN_CUI_SOMATIC","CLINVAR_CLNSIG_SOMATIC","CLINVAR_PMID_SOMATIC","CLINVAR_ALLELE_ID","CLINVAR_HGVSP"]
    dbnsfp_info_tags = ["DBNSFP"]
@@ -64,19 +83,81 @@ def run_vcfanno(num_processes, query_vcf, query_info_tags, vcfheader_file, gvann
    if gwas is True:
       prepare_vcfanno_configuration(gvanno_db_directory, conf_fname, vcfheader_file, logger, gwas_info_tags, query_info_tags, "gwas")
 
-   out_vcf_vcfanno_unsorted1 = output_vcf + '.tmp.unsorted.1'
+   if stream is True:
+      run_vcfanno_stream(num_processes, query_header_lines, vcfheader_file, conf_fname, output_vcf)
+      return 0
+
+   f = open(vcfheader_file, 'rb')
+   vcf_header = f.read() + b''.join(l for l in query_header_lines if l.startswith(b'#CHROM'))
+   f.close()
    query_prefix = re.sub('\.vcf.gz$','',query_vcf)
-   print_vcf_header(query_vcf, vcfheader_file, chromline_only = True)
-   command1 = "vcfanno -p=" + str(num_processes) + " " + str(conf_fname) + " " + str(query_vcf) + " > " + str(out_vcf_vcfanno_unsorted1) + " 2> " + str(query_prefix) + '.vcfanno.log'
-   os.system(command1)
-   
-   os.system('cat ' + str(vcfheader_file) + ' > ' + str(output_vcf))
-   os.system('cat ' + str(out_vcf_vcfanno_unsorted1) + ' | grep -v \'^#\' >> ' + str(output_vcf))
+   vcfanno_log_fname = str(query_prefix) + '.vcfanno.log'
+   vcfanno_log = open(vcfanno_log_fname, 'w')
+   vcfanno_proc = subprocess.Popen(['vcfanno', '-p=' + str(num_processes), str(conf_fname), str(query_vcf)], stdout = subprocess.PIPE, stderr = vcfanno_log)
+
+   ## the header of the vcfanno output is replaced, and annotated records are bgzipped and indexed as vcfanno writes them
+   writer = annoutils.open_bgzf_writer(str(output_vcf) + '.gz', threads = bgzf_threads, index = 'tbi')
+   annoutils.write_bgzf(writer, vcf_header.decode())
+   for lines in iter(lambda: vcfanno_proc.stdout.readlines(annoutils.bgzf_block_size), []):
+      annoutils.write_bgzf(writer, b''.join(line for line in lines if not line.startswith(b'#')).decode())
+   annoutils.close_bgzf_writer(writer)
+   vcfanno_log.close()
    os.system('rm -f ' + str(output_vcf) + '.tmp*')
-   os.system('bgzip -f ' + str(output_vcf))
-   os.system('tabix -f -p vcf ' + str(output_vcf) + '.gz')
+   if vcfanno_proc.wait() != 0:
+      annoutils.error_message('vcfanno failed (exit code ' + str(vcfanno_proc.returncode) + ') - see ' + str(vcfanno_log_fname), logger)
    return 0
    
+def run_vcfanno_stream(num_processes, query_header_lines, vcfheader_file, conf_fname, output_vcf):
+   """
+   Function that runs vcfanno on a query VCF read from standard input, and writes the annotated VCF (with the gvanno header) to standard output
+   The query VCF is fed to vcfanno in a separate thread, while the vcfanno output is read and its header replaced
+   """
+   f = open(vcfheader_file, 'rb')
+   vcf_header = f.read() + b''.join(l for l in query_header_lines if l.startswith(b'#CHROM'))
+   f.close()
+   vcfanno_log_fname = re.sub(r'(\.vcfanno)?\.vcf$','',output_vcf) + '.vcfanno.log'
+   vcfanno_log = open(vcfanno_log_fname, 'w')
+   vcfanno_proc = subprocess.Popen(['vcfanno', '-p=' + str(num_processes), str(conf_fname), '-'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = vcfanno_log)
+
+   def feed_query_vcf():
+      try:
+         vcfanno_proc.stdin.write(b''.join(query_header_lines))
+         shutil.copyfileobj(sys.stdin.buffer, vcfanno_proc.stdin, 1024 * 1024)
+      finally:
+         vcfanno_proc.stdin.close()
+
+   feeder = threading.Thread(target = feed_query_vcf)
+   feeder.start()
+   out = sys.stdout.buffer
+   out.write(vcf_header)
+   for line in vcfanno_proc.stdout:
+      if not line.startswith(b'#'):
+         out.write(line)
+   out.flush()
+   feeder.join()
+   vcfanno_log.close()
+   os.system('rm -f ' + str(output_vcf) + '.tmp*')
+   if vcfanno_proc.wait() != 0:
+      annoutils.error_message('vcfanno failed (exit code ' + str(vcfanno_proc.returncode) + ') - see ' + str(vcfanno_log_fname), logger)
+
+def read_vcf_header_stream(stream):
+   """
+   Function that reads the header lines (up to and including the #CHROM line) of a VCF from a (binary) stream
+   """
+   header_lines = []
+   for line in iter(stream.readline, b''):
+      header_lines.append(line)
+      if line.startswith(b'#CHROM'):
+         break
+   return header_lines
+
+def get_vcf_info_tags_header(header_lines):
+   info_tags = {}
+   for line in header_lines:
+      if line.startswith(b'##INFO=<ID='):
+         info_tags[line[11:].split(b',')[0].decode()] = 1
+   return info_tags
+
 def append_to_vcf_header(gvanno_db_directory, datasource, vcfheader_file):
    """
    Function that appends the VCF header information for a given 'datasource' (containing INFO tag formats/descriptions, and datasource version)
@@ -109,22 +190,4 @@ def append_to_conf_file(datasource, datasource_info_tags, gvanno_db_directory, c
    fh.close()
    return
 
-def get_vcf_info_tags(vcffile):
-   vcf = VCF(vcffile)
-   info_tags = {}
-   for e in vcf.header_iter():
-      header_element = e.info()
-      if 'ID' in header_element.keys() and 'HeaderType' in header_element.keys():
-         if header_element['HeaderType'] == 'INFO':
-            info_tags[str(header_element['ID'])] = 1
-   
-   return info_tags
-
-
-def print_vcf_header(query_vcf, vcfheader_file, chromline_only = False):
-   if chromline_only == True:
-      os.system('bgzip -dc ' + str(query_vcf) + ' | egrep \'^#\' | egrep \'^#CHROM\' >> ' + str(vcfheader_file))
-   else:
-      os.system('bgzip -dc ' + str(query_vcf) + ' | egrep \'^#\' | egrep -v \'^#CHROM\' > ' + str(vcfheader_file))
-
 if __name__=="__main__": __main__()
@@ -2,14 +2,41 @@
 
 import os,re,sys
 import csv
+import collections
+import concurrent.futures
+import functools
+import struct
+import bisect
+import mmap
+import zlib
 import logging
 import gzip
+import pickle
+import shutil
 import toml
-from cyvcf2 import VCF, Writer
+try:
+   from cyvcf2 import VCF, Writer
+except ImportError:
+   ## annoutils is also imported by gvanno.py on the host (see read_tabix_index), where cyvcf2 is not required
+   VCF = Writer = None
 
 
 csv.field_size_limit(500 * 1024 * 1024)
+## transcript annotations (INFO tags) of the gvanno_xref BED file (column 4, '|'-separated), by index
+gvanno_xref_map = {'ENSEMBL_TRANSCRIPT_ID':0, 'ENSEMBL_GENE_ID':1, 'SYMBOL':2, 'ENTREZ_ID':3, 'UNIPROT_ID':4, 'APPRIS':5,'UNIPROT_ACC':6,
+                   'REFSEQ_MRNA':7, 'CORUM_ID':8,'TUMOR_SUPPRESSOR':9,'ONCOGENE':10,'DISGENET_CUI':11,'MIM_PHENOTYPE_ID':12}
+coding_csq_pattern = re.compile(r"^(stop_|start_lost|frameshift_|missense_|splice_donor|splice_acceptor|protein_altering|inframe_)")
+wes_csq_pattern = re.compile(r"^(stop_|start_lost|frameshift_|missense_|splice_donor|splice_acceptor|inframe_|protein_altering|synonymous)")
+## INFO tags of dbNSFP effect predictions (EFFECT_PREDICTIONS), per algorithm
+dbnsfp_algorithm_tags = {'sift':'SIFT_DBNSFP','sift4g':'SIFT4G_DBNSFP','provean':'PROVEAN_DBNSFP','m-cap':'M_CAP_DBNSFP','mutpred':'MUTPRED_DBNSFP','metalr':'META_LR_DBNSFP',
+                         'fathmm':'FATHMM_DBNSFP','fathmm_mkl_coding':'FATHMM_MKL_DBNSFP','mutationtaster':'MUTATIONTASTER_DBNSFP','mutationassessor':'MUTATIONASSESSOR_DBNSFP',
+                         'deogen2':'DEOGEN2_DBNSFP','primateai':'PRIMATEAI_DBNSFP','splice_site_rf':'SPLICE_SITE_RF_DBNSFP','splice_site_ada':'SPLICE_SITE_ADA_DBNSFP'}
 threeLettertoOneLetterAA = {'Ala':'A','Arg':'R','Asn':'N','Asp':'D','Cys':'C','Glu':'E','Gln':'Q','Gly':'G','His':'H','Ile':'I','Leu':'L','Lys':'K', 'Met':'M','Phe':'F','Pro':'P','Ser':'S','Thr':'T','Trp':'W','Tyr':'Y','Val':'V','Ter':'X'}
+three_letter_aa_pattern = re.compile(r'([A-Z][a-z]{2})')
+frameshift_stop_pattern = re.compile(r'[A-Z]{1}fsX([0-9]{1,}|\?)')
+## BGZF (SAM/BAM specification): maximum uncompressed data per block (as htslib), and the empty end-of-file block
+bgzf_block_size = 65280
+bgzf_eof_block = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
 
 def read_infotag_file(vcf_info_tags_tsv):
@@ -42,32 +69,29 @@ def error_message(message, logger):
 
 
 
-def write_pass_vcf(annotated_vcf, logger):
+def write_pass_vcf(annotated_vcf, logger, bgzf_threads = 1):
    
    out_vcf = re.sub(r'\.annotated\.vcf\.gz$','.annotated.pass.vcf',annotated_vcf)
-   vcf = VCF(annotated_vcf)
-   w = Writer(out_vcf, vcf)
+   vcf = VCF(annotated_vcf, threads = bgzf_threads)
+   w = open_bgzf_writer(out_vcf + '.gz', threads = bgzf_threads, index = 'tbi')
+   write_bgzf(w, vcf.raw_header)
 
    num_rejected = 0
    num_pass = 0
    for rec in vcf:
       if rec.FILTER is None or rec.FILTER == 'None':
-         w.write_record(rec)
+         write_bgzf(w, str(rec))
          num_pass += 1
       else:
          num_rejected +=1
 
    vcf.close()
-   w.close()
+   close_bgzf_writer(w)
    
    logger.info('Number of non-PASS/REJECTED variant calls: ' + str(num_rejected))
    logger.info('Number of PASSed variant calls: ' + str(num_pass))
    if num_pass == 0:
       logger.warning('There are zero variants with a \'PASS\' filter in the VCF file')
-      os.system('bgzip -dc ' + str(annotated_vcf) + ' egrep \'^#\' > ' + str(out_vcf))
-   #else:
-   os.system('bgzip -f ' + str(out_vcf))
-   os.system('tabix -f -p vcf ' + str(out_vcf) + '.gz')
 
    return
 
@@ -223,27 +247,36 @@ def read_config_options(configuration_file, base_dir, genome_assembly, logger, w
    return config_options
 
 
+@functools.lru_cache(maxsize = 65536)
 def threeToOneAA(aa_change):
-	
-   for three_letter_aa in threeLettertoOneLetterAA.keys():
-      aa_change = aa_change.replace(three_letter_aa,threeLettertoOneLetterAA[three_letter_aa])
-
-   aa_change = re.sub(r'[A-Z]{1}fsX([0-9]{1,}|\?)','fs',aa_change)
+   """
+   Function that translates three-letter amino acid codes of a protein change (HGVSp) to one-letter codes (in a single pass), memoized per protein change
+   """
+   aa_change_elements = three_letter_aa_pattern.split(aa_change)
+   for i in range(1, len(aa_change_elements), 2):
+      aa_change_elements[i] = threeLettertoOneLetterAA.get(aa_change_elements[i], aa_change_elements[i])
+   aa_change = ''.join(aa_change_elements)
+   if 'fsX' in aa_change:
+      aa_change = frameshift_stop_pattern.sub('fs',aa_change)
    return aa_change
 
 def map_variant_effect_predictors(rec, algorithms):
     
-   dbnsfp_predictions = map_dbnsfp_predictions(str(rec.INFO.get('DBNSFP')), algorithms)
-   if rec.INFO.get('Gene') is None or rec.INFO.get('Consequence') is None:
+   info = rec.INFO
+   dbnsfp_predictions = get_dbnsfp_predictions(str(info.get('DBNSFP')), tuple(algorithms))
+   gene = info.get('Gene')
+   consequence = info.get('Consequence')
+   if gene is None or consequence is None:
       return
-   gene_id = str(rec.INFO.get('Gene'))
-   consequence = str(rec.INFO.get('Consequence'))
+   gene_id = str(gene)
+   consequence = str(consequence)
      
    dbnsfp_key = ''
 
    found_key = 0
-   if not rec.INFO.get('HGVSp_short') is None and not rec.INFO.get('HGVSp_short') == '.':
-      aa_change = str(rec.INFO.get('HGVSp_short'))
+   hgvsp_short = info.get('HGVSp_short')
+   if not hgvsp_short is None and not hgvsp_short == '.':
+      aa_change = str(hgvsp_short)
       dbnsfp_key = gene_id + ':' + str(aa_change)
       if dbnsfp_key in dbnsfp_predictions:
          found_key = 1
@@ -253,36 +286,29 @@ def map_variant_effect_predictors(rec, algorithms):
 
    if dbnsfp_key != '':
       if dbnsfp_key in dbnsfp_predictions:
-         rec.INFO['EFFECT_PREDICTIONS'] = dbnsfp_predictions[dbnsfp_key]
-         for algo_pred in rec.INFO['EFFECT_PREDICTIONS'].split('&'):
-            if algo_pred.startswith('sift:'):
-               rec.INFO['SIFT_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('sift4g:'):
-               rec.INFO['SIFT4G_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('provean:'):
-               rec.INFO['PROVEAN_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('m-cap:'):
-               rec.INFO['M_CAP_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('mutpred:'):
-               rec.INFO['MUTPRED_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('metalr:'):
-               rec.INFO['META_LR_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('fathmm:'):
-               rec.INFO['FATHMM_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('fathmm_mkl_coding:'):
-               rec.INFO['FATHMM_MKL_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('mutationtaster:'):
-               rec.INFO['MUTATIONTASTER_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('mutationassessor:'):
-               rec.INFO['MUTATIONASSESSOR_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('deogen2:'):
-               rec.INFO['DEOGEN2_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('primateai:'):
-               rec.INFO['PRIMATEAI_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('splice_site_rf:'):
-               rec.INFO['SPLICE_SITE_RF_DBNSFP'] = str(algo_pred.split(':')[1])
-            if algo_pred.startswith('splice_site_ada:'):
-               rec.INFO['SPLICE_SITE_ADA_DBNSFP'] = str(algo_pred.split(':')[1])
+         effect_predictions, algorithm_predictions = dbnsfp_predictions[dbnsfp_key]
+         info['EFFECT_PREDICTIONS'] = effect_predictions
+         for tag, prediction in algorithm_predictions:
+            info[tag] = prediction
+
+
+@functools.lru_cache(maxsize = 8192)
+def get_dbnsfp_predictions(dbnsfp_tag, algorithms):
+   """
+   Function that returns the effect predictions of map_dbnsfp_predictions (key -> (EFFECT_PREDICTIONS, [(INFO tag, prediction)]), see dbnsfp_algorithm_tags),
+   memoized (least recently used entries are evicted) on the raw DBNSFP string and the (tuple of) algorithms, as neighbouring variants often carry identical DBNSFP strings
+   The returned dictionary is shared between calls, and should not be modified
+   """
+   dbnsfp_predictions = {}
+   effect_predictions = map_dbnsfp_predictions(dbnsfp_tag, algorithms)
+   for k in effect_predictions:
+      algorithm_predictions = []
+      for algo_pred in effect_predictions[k].split('&'):
+         algo, sep, prediction = algo_pred.partition(':')
+         if sep != '' and algo in dbnsfp_algorithm_tags:
+            algorithm_predictions.append((dbnsfp_algorithm_tags[algo], str(prediction.split(':')[0])))
+      dbnsfp_predictions[k] = (effect_predictions[k], algorithm_predictions)
+   return dbnsfp_predictions
 
 
 def detect_reserved_info_tag(tag, tag_name, logger):
@@ -296,71 +322,88 @@ def detect_reserved_info_tag(tag, tag_name, logger):
       err_msg = 'Custom INFO tag (' + str(tag_name) + ') needs another name - ' + str(tag) + ' is a reserved field in the VCF specification (FORMAT)'
       return error_message(err_msg, logger)
 
+@functools.lru_cache(maxsize = 4096)
+def get_consequence_status(consequence):
+   """
+   Function that classifies a VEP consequence (e.g. 'missense_variant&splice_region_variant') as coding/noncoding (CODING_STATUS)
+   and exonic/nonexonic (EXONIC_STATUS), memoized per distinct consequence
+   """
+   coding_status = 'noncoding'
+   exonic_status = 'nonexonic'
+   if coding_csq_pattern.match(consequence):
+      coding_status = 'coding'
+   if wes_csq_pattern.match(consequence):
+      exonic_status = 'exonic'
+   return (coding_status, exonic_status)
+
 def set_coding_change(rec):
-   
-   rec.INFO['CODING_STATUS'] = 'noncoding'
-   rec.INFO['EXONIC_STATUS'] = 'nonexonic'
-   
-   coding_csq_pattern = r"^(stop_|start_lost|frameshift_|missense_|splice_donor|splice_acceptor|protein_altering|inframe_)"
-   wes_csq_pattern = r"^(stop_|start_lost|frameshift_|missense_|splice_donor|splice_acceptor|inframe_|protein_altering|synonymous)"
-   if re.match(coding_csq_pattern, str(rec.INFO.get('Consequence'))):
-      rec.INFO['CODING_STATUS'] = 'coding'
-   
-   if re.match(wes_csq_pattern, str(rec.INFO.get('Consequence'))):
-      rec.INFO['EXONIC_STATUS'] = 'exonic'
-
-
-   for m in ['HGVSp_short','CDS_CHANGE']:
-      rec.INFO[m] = '.'
-   if not rec.INFO.get('HGVSc') is None:
-      if rec.INFO.get('HGVSc') != '.':
-         if 'splice_acceptor_variant' in rec.INFO.get('Consequence') or 'splice_donor_variant' in rec.INFO.get('Consequence'):
-            key = str(rec.INFO.get('Consequence')) + ':' + str(rec.INFO.get('HGVSc'))
-            rec.INFO['CDS_CHANGE'] = key
-   if rec.INFO.get('Amino_acids') is None or rec.INFO.get('Protein_position') is None or rec.INFO.get('Consequence') is None:
-      return
-   if not rec.INFO.get('Protein_position') is None:
-      if rec.INFO.get('Protein_position').startswith('-'):
-         return
+   """
+   Function that sets CODING_STATUS, EXONIC_STATUS, HGVSp_short, CDS_CHANGE and AMINO_ACID_START/END of the picked VEP consequence,
+   each tag is written once (every INFO update is encoded by htslib)
+   """
+   info = rec.INFO
+   consequence = info.get('Consequence')
+   hgvsc = info.get('HGVSc')
+   amino_acids = info.get('Amino_acids')
+   protein_position_info = info.get('Protein_position')
+
+   coding_status, exonic_status = get_consequence_status(str(consequence))
+   info['CODING_STATUS'] = coding_status
+   info['EXONIC_STATUS'] = exonic_status
 
    protein_change = '.'
-   if '/' in rec.INFO.get('Protein_position'):
-      protein_position = str(rec.INFO.get('Protein_position').split('/')[0])
+   cds_change = '.'
+   amino_acid_start = None
+   amino_acid_end = None
+   valid_hgvsc = not hgvsc is None and hgvsc != '.'
+   if valid_hgvsc:
+      if 'splice_acceptor_variant' in consequence or 'splice_donor_variant' in consequence:
+         cds_change = str(consequence) + ':' + str(hgvsc)
+   if amino_acids is None or protein_position_info is None or consequence is None or protein_position_info.startswith('-'):
+      info['HGVSp_short'] = protein_change
+      info['CDS_CHANGE'] = cds_change
+      return
+
+   if '/' in protein_position_info:
+      protein_position = str(protein_position_info.split('/')[0])
       if '-' in protein_position:
          if protein_position.split('-')[0].isdigit():
-            rec.INFO['AMINO_ACID_START'] = protein_position.split('-')[0]
+            amino_acid_start = protein_position.split('-')[0]
          if protein_position.split('-')[1].isdigit():
-            rec.INFO['AMINO_ACID_END'] = protein_position.split('-')[1]
+            amino_acid_end = protein_position.split('-')[1]
       else:
          if protein_position.isdigit():
-            rec.INFO['AMINO_ACID_START'] = protein_position
-            rec.INFO['AMINO_ACID_END'] = protein_position
+            amino_acid_start = protein_position
+            amino_acid_end = protein_position
    
-   if not rec.INFO.get('HGVSp') is None:
-      if rec.INFO.get('HGVSp') != '.':
-         if ':' in rec.INFO.get('HGVSp'):
-            protein_identifier = str(rec.INFO.get('HGVSp').split(':')[0])
-            if protein_identifier.startswith('ENSP'):
-               protein_change_VEP = str(rec.INFO.get('HGVSp').split(':')[1])
-               protein_change = threeToOneAA(protein_change_VEP)
+   hgvsp = info.get('HGVSp')
+   if not hgvsp is None:
+      if hgvsp != '.':
+         if ':' in hgvsp:
+            hgvsp_elements = hgvsp.split(':')
+            if hgvsp_elements[0].startswith('ENSP'):
+               protein_change = threeToOneAA(str(hgvsp_elements[1]))
   
-   if 'synonymous_variant' in rec.INFO.get('Consequence'):
-      protein_change = 'p.' + str(rec.INFO.get('Amino_acids')) + str(protein_position) + str(rec.INFO.get('Amino_acids'))
-      if 'stop_lost' in str(rec.INFO.get('Consequence')) and '/' in str(rec.INFO.get('Amino_acids')):
-         protein_change = 'p.X' + str(protein_position) + str(rec.INFO.get('Amino_acids')).split('/')[1]
+   if 'synonymous_variant' in consequence:
+      protein_change = 'p.' + str(amino_acids) + str(protein_position) + str(amino_acids)
+      if 'stop_lost' in str(consequence) and '/' in str(amino_acids):
+         protein_change = 'p.X' + str(protein_position) + str(amino_acids).split('/')[1]
     
-   rec.INFO['HGVSp_short'] = protein_change
-   exon_number = 'NA'
-   if not rec.INFO.get('EXON') is None:
-      if rec.INFO.get('EXON') != '.':
-         if '/' in rec.INFO.get('EXON'):
-            exon_number = str(rec.INFO.get('EXON')).split('/')[0]
-  
-   if not rec.INFO.get('HGVSc') is None:
-      if rec.INFO.get('HGVSc') != '.':
-         if protein_change != '.':
-            key = str(rec.INFO.get('Consequence')) + ':' + str(rec.INFO.get('HGVSc')) + ':exon' + str(exon_number) + ':' + str(protein_change)
-            rec.INFO['CDS_CHANGE'] = key
+   if valid_hgvsc and protein_change != '.':
+      exon_number = 'NA'
+      exon = info.get('EXON')
+      if not exon is None:
+         if exon != '.':
+            if '/' in exon:
+               exon_number = str(exon).split('/')[0]
+      cds_change = str(consequence) + ':' + str(hgvsc) + ':exon' + str(exon_number) + ':' + str(protein_change)
+
+   info['HGVSp_short'] = protein_change
+   info['CDS_CHANGE'] = cds_change
+   if not amino_acid_start is None:
+      info['AMINO_ACID_START'] = amino_acid_start
+   if not amino_acid_end is None:
+      info['AMINO_ACID_END'] = amino_acid_end
 
    return
 
@@ -428,11 +471,16 @@ def map_dbnsfp_predictions(dbnsfp_tag, algorithms):
 
 
 def vep_dbnsfp_meta_vcf(query_vcf, info_tags_wanted):
+   """
+   Function that parses the CSQ (VEP) and DBNSFP header elements of a VCF, 'query_vcf' being either a file name or an opened cyvcf2 VCF object (e.g. reading from a stream)
+   """
    vep_to_pcgr_af = {'gnomAD_AMR_AF':'AMR_AF_GNOMAD','gnomAD_AFR_AF':'AFR_AF_GNOMAD','gnomAD_EAS_AF':'EAS_AF_GNOMAD','gnomAD_NFE_AF':'NFE_AF_GNOMAD','gnomAD_AF':'GLOBAL_AF_GNOMAD',
                      'gnomAD_SAS_AF':'SAS_AF_GNOMAD','gnomAD_OTH_AF':'OTH_AF_GNOMAD','gnomAD_ASJ_AF':'ASJ_AF_GNOMAD','gnomAD_FIN_AF':'FIN_AF_GNOMAD','AFR_AF':'AFR_AF_1KG',
                      'AMR_AF':'AMR_AF_1KG','SAS_AF':'SAS_AF_1KG','EUR_AF':'EUR_AF_1KG','EAS_AF':'EAS_AF_1KG', 'AF':'GLOBAL_AF_1KG'}
 
-   vcf = VCF(query_vcf)
+   vcf = query_vcf
+   if not isinstance(query_vcf, VCF):
+      vcf = VCF(query_vcf)
    vep_csq_index2fields = {}
    vep_csq_fields2index = {}
    dbnsfp_prediction_algorithms = []
@@ -467,4 +515,603 @@ def vep_dbnsfp_meta_vcf(query_vcf, info_tags_wanted):
    vep_dbnsfp_meta_info['vep_csq_fields2index'] = vep_csq_fields2index
    vep_dbnsfp_meta_info['dbnsfp_prediction_algorithms'] = dbnsfp_prediction_algorithms
 
-   return vep_dbnsfp_meta_info
\ No newline at end of file
+   return vep_dbnsfp_meta_info
+
+def load_transcript_xref_index(gvanno_db_directory, logger):
+   """
+   Function that loads the transcript cross-reference index of the gvanno_xref BED file (gvanno_xref/gvanno_xref.bed.gz), i.e.
+   Ensembl transcript ID -> BED records ((chrom, 0-based start, end, transcript annotations ((INFO tag, value), see gvanno_xref_map)))
+   The index is built once from the BED file, and stored (pickled) next to it as gvanno_xref.index.pickle (if the data directory is writable)
+   """
+   xref_bed = os.path.join(gvanno_db_directory, 'gvanno_xref', 'gvanno_xref.bed.gz')
+   xref_index_file = os.path.join(gvanno_db_directory, 'gvanno_xref', 'gvanno_xref.index.pickle')
+   if not os.path.exists(xref_bed):
+      logger.warning('Transcript cross-reference file ' + str(xref_bed) + ' not found - transcript annotations are skipped')
+      return {}
+   if os.path.exists(xref_index_file) and os.path.getmtime(xref_index_file) >= os.path.getmtime(xref_bed):
+      f = open(xref_index_file, 'rb')
+      xref_index = pickle.load(f)
+      f.close()
+      return xref_index
+
+   logger.info('Building transcript cross-reference index from ' + str(xref_bed))
+   xref_annotations = sorted(gvanno_xref_map.items(), key = lambda annotation: annotation[1])
+   xref_index = {}
+   f = gzip.open(xref_bed, 'rt')
+   for line in f:
+      if line.startswith('#') or line.startswith('track'):
+         continue
+      fields = line.rstrip('\n').split('\t')
+      if len(fields) < 4:
+         continue
+      xrefs = fields[3].split('|')
+      annotations = []
+      for annotation, annotation_index in xref_annotations:
+         if annotation_index < len(xrefs) and xrefs[annotation_index] != '':
+            if annotation == 'TUMOR_SUPPRESSOR' or annotation == 'ONCOGENE':
+               annotations.append((annotation, True))
+            else:
+               annotations.append((annotation, xrefs[annotation_index]))
+      chrom = re.sub(r'^chr', '', fields[0])
+      xref_index[xrefs[0]] = xref_index.get(xrefs[0], ()) + ((chrom, int(fields[1]), int(fields[2]), tuple(annotations)),)
+   f.close()
+
+   xref_index_tmp = xref_index_file + '.' + str(os.getpid()) + '.tmp'
+   try:
+      f = open(xref_index_tmp, 'wb')
+      pickle.dump(xref_index, f, pickle.HIGHEST_PROTOCOL)
+      f.close()
+      os.rename(xref_index_tmp, xref_index_file)
+   except (IOError, OSError):
+      logger.info('Data directory is not writable - transcript cross-reference index is not stored')
+   return xref_index
+
+
+def get_transcript_xrefs(xref_index, transcript_id, chrom, start, end):
+   """
+   Function that returns the annotations of a transcript (see load_transcript_xref_index) from the (last) BED record of the transcript that overlaps the variant (0-based, half-open), as vcfanno would
+   """
+   annotations = ()
+   for interval_chrom, interval_start, interval_end, interval_annotations in xref_index.get(transcript_id, ()):
+      if interval_chrom == chrom and interval_start < end and start < interval_end:
+         annotations = interval_annotations
+   return annotations
+
+
+def read_tabix_index(tbi_file):
+   """
+   Function that reads a tabix index (.tbi) and returns one entry per indexed sequence (in index order), with
+   1. the sequence name
+   2. the number of mapped records (from the pseudo-bin of the index)
+   3. the linear index, i.e. virtual file offsets of the first record overlapping each 16kb window
+   4. the virtual file offset at the end of the sequence
+   """
+   fh = gzip.open(tbi_file, 'rb')
+   data = fh.read()
+   fh.close()
+   magic, n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<4s8i', data, 0)
+   if magic != b'TBI\x01':
+      raise IOError('File ' + str(tbi_file) + ' is not a tabix index')
+   offset = 36
+   names = data[offset:offset + l_nm].split(b'\x00')
+   offset += l_nm
+
+   tabix_index = []
+   i = 0
+   while i < n_ref:
+      n_mapped = 0
+      off_end = 0
+      n_bin = struct.unpack_from('<i', data, offset)[0]
+      offset += 4
+      b = 0
+      while b < n_bin:
+         bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+         offset += 8
+         if bin_id == 37450: ## pseudo-bin: (off_beg, off_end), (n_mapped, n_unmapped)
+            off_end = struct.unpack_from('<Q', data, offset + 8)[0]
+            n_mapped = struct.unpack_from('<Q', data, offset + 16)[0]
+         offset += 16 * n_chunk
+         b = b + 1
+      n_intv = struct.unpack_from('<i', data, offset)[0]
+      offset += 4
+      linear_index = list(struct.unpack_from('<' + str(n_intv) + 'Q', data, offset))
+      offset += 8 * n_intv
+      tabix_index.append({'name': names[i].decode(), 'n_mapped': n_mapped, 'off_end': off_end, 'linear_index': linear_index})
+      i = i + 1
+
+   return tabix_index
+
+
+def get_balanced_regions(query_vcf, num_regions):
+   """
+   Function that partitions a bgzipped and tabix-indexed VCF into (at most) 'num_regions' contiguous sets of regions with
+   approximately the same number of variants. Variant counts are taken from the tabix index (per sequence), and are
+   distributed across the 16kb windows of each sequence according to the compressed size of each window (linear index)
+   Each set of regions is a list of (chrom, start, end) tuples (1-based, inclusive, end = None means end of sequence),
+   and every record belongs to exactly one set based on its position (POS)
+   """
+   window_size = 16384
+   windows = []
+   for seq in read_tabix_index(str(query_vcf) + '.tbi'):
+      if seq['n_mapped'] == 0:
+         continue
+      linear_index = seq['linear_index']
+      if len(linear_index) == 0:
+         windows.append((seq['name'], 0, True, float(seq['n_mapped'])))
+         continue
+      coffsets = [voffset >> 16 for voffset in linear_index] + [seq['off_end'] >> 16]
+      window_bytes = [max(coffsets[w + 1] - coffsets[w], 0) for w in range(len(linear_index))]
+      total_bytes = sum(window_bytes)
+      for w in range(len(linear_index)):
+         if total_bytes > 0:
+            weight = float(seq['n_mapped']) * window_bytes[w] / total_bytes
+         else:
+            weight = float(seq['n_mapped']) / len(linear_index)
+         windows.append((seq['name'], w, w == len(linear_index) - 1, weight))
+
+   total_weight = sum(w[3] for w in windows)
+   num_regions = max(1, min(int(num_regions), len(windows)))
+   region_sets = []
+   current_set = []
+   cumulative_weight = 0.0
+   for chrom, w, last_window, weight in windows:
+      if len(current_set) > 0 and len(region_sets) < num_regions - 1 and cumulative_weight >= total_weight * (len(region_sets) + 1) / num_regions:
+         region_sets.append(current_set)
+         current_set = []
+      start = 1 if w == 0 else w * window_size + 1
+      end = None if last_window else (w + 1) * window_size
+      if len(current_set) > 0 and current_set[-1][0] == chrom and current_set[-1][2] == start - 1:
+         current_set[-1] = (chrom, current_set[-1][1], end)
+      else:
+         current_set.append((chrom, start, end))
+      cumulative_weight += weight
+   if len(current_set) > 0:
+      region_sets.append(current_set)
+
+   return region_sets
+
+
+def get_region_set_index(region_sets):
+   """
+   Function that returns a lookup (chrom -> sorted region start positions and corresponding set index) for a list of region sets, to be used with find_region_set
+   """
+   region_index = {}
+   i = 0
+   for region_set in region_sets:
+      for chrom, start, end in region_set:
+         if not chrom in region_index:
+            region_index[chrom] = ([], [])
+         region_index[chrom][0].append(start)
+         region_index[chrom][1].append(i)
+      i = i + 1
+   return region_index
+
+
+def find_region_set(region_index, chrom, pos):
+   """
+   Function that returns the index of the region set that a variant (chrom, 1-based pos) belongs to
+   """
+   starts, set_indices = region_index[chrom]
+   return set_indices[max(bisect.bisect_right(starts, pos) - 1, 0)]
+
+
+def open_indexed_fasta(fasta_file):
+   """
+   Function that opens a FASTA file indexed with samtools faidx (.fai) for random access through a memory map
+   Bgzipped FASTA files (.gz) also require the BGZF block index (.gzi), blocks are decompressed on demand (and cached)
+   Returns None if the FASTA file or its index is missing
+   """
+   if not os.path.exists(str(fasta_file)) or not os.path.exists(str(fasta_file) + '.fai'):
+      return None
+   fasta = {}
+   fasta['contigs'] = {}
+   f = open(str(fasta_file) + '.fai', 'r')
+   for line in f:
+      name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+      fasta['contigs'][name] = (int(length), int(offset), int(line_bases), int(line_width))
+   f.close()
+   fh = open(str(fasta_file), 'rb')
+   fasta['mmap'] = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+   fh.close()
+   fasta['compressed_offsets'] = None
+   if str(fasta_file).endswith('.gz'):
+      if not os.path.exists(str(fasta_file) + '.gzi'):
+         return None
+      fh = open(str(fasta_file) + '.gzi', 'rb')
+      data = fh.read()
+      fh.close()
+      num_entries = struct.unpack_from('<Q', data, 0)[0]
+      entries = struct.unpack_from('<' + str(2 * num_entries) + 'Q', data, 8)
+      fasta['compressed_offsets'] = [0] + list(entries[0::2])
+      fasta['uncompressed_offsets'] = [0] + list(entries[1::2])
+      fasta['blocks'] = {}
+   return fasta
+
+
+def read_bgzf_block(fasta, compressed_offset):
+   """
+   Function that decompresses the BGZF block at 'compressed_offset' of a (memory-mapped) bgzipped FASTA, returns (data, compressed block size)
+   """
+   if compressed_offset in fasta['blocks']:
+      return fasta['blocks'][compressed_offset]
+   block_size = struct.unpack_from('<H', fasta['mmap'], compressed_offset + 16)[0] + 1
+   data = zlib.decompress(fasta['mmap'][compressed_offset + 18:compressed_offset + block_size - 8], -15)
+   if len(fasta['blocks']) >= 64:
+      fasta['blocks'].clear()
+   fasta['blocks'][compressed_offset] = (data, block_size)
+   return (data, block_size)
+
+
+def compress_bgzf_block(data):
+   """
+   Function that compresses (at most 'bgzf_block_size' bytes of) data into a single BGZF block
+   """
+   deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+   compressed_data = deflate.compress(data) + deflate.flush()
+   header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed_data) + 25)
+   return header + compressed_data + struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def open_bgzf_writer(bgzf_file, eof = True, threads = 1, index = None):
+   """
+   Function that opens a BGZF (bgzip-compatible) writer, text written with write_bgzf is compressed in blocks of 'bgzf_block_size' bytes
+   1. 'threads' > 1: blocks are compressed by a pool of threads (zlib releases the GIL), and written in order
+   2. 'index' ('tbi' or 'csi'): a tabix/CSI index of the VCF records is built while writing (see close_bgzf_writer), records must be sorted
+   Without the end-of-file block ('eof' = False), the file is a BGZF block stream to be concatenated with others (see concatenate_bgzf)
+   """
+   writer = {}
+   writer['bgzf_file'] = bgzf_file
+   writer['fh'] = open(bgzf_file, 'wb')
+   writer['buffer'] = bytearray()
+   writer['eof'] = eof
+   writer['executor'] = None
+   writer['pending_blocks'] = collections.deque()
+   writer['max_pending_blocks'] = 4 * threads
+   if threads > 1:
+      writer['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+   ## compressed offset of each block, to translate uncompressed offsets (of indexed records) into virtual file offsets
+   writer['block_offsets'] = []
+   writer['compressed_size'] = 0
+   writer['uncompressed_size'] = 0
+   writer['index'] = None
+   if not index is None:
+      writer['index'] = new_bgzf_index(index)
+   return writer
+
+
+def write_bgzf(writer, text):
+   """
+   Function that writes text to a BGZF writer, full blocks are compressed as the buffer fills up
+   VCF records (complete lines) are added to the index of the writer, if any
+   """
+   data = text.encode()
+   if not writer['index'] is None:
+      line_start = 0
+      while line_start < len(data):
+         line_end = data.find(b'\n', line_start) + 1
+         if line_end == 0:
+            line_end = len(data)
+         if data[line_start] != 35: ## '#'
+            add_bgzf_index_record(writer['index'], data, line_start, line_end, writer['uncompressed_size'] + line_start)
+         line_start = line_end
+   writer['uncompressed_size'] += len(data)
+   writer['buffer'].extend(data)
+   if len(writer['buffer']) >= bgzf_block_size:
+      data = writer['buffer']
+      num_full_blocks = len(data) // bgzf_block_size
+      for b in range(num_full_blocks):
+         write_bgzf_block(writer, bytes(data[b * bgzf_block_size:(b + 1) * bgzf_block_size]))
+      writer['buffer'] = data[num_full_blocks * bgzf_block_size:]
+
+
+def write_bgzf_block(writer, data):
+   """
+   Function that compresses a block of data (in the thread pool of the writer, if any), and writes compressed blocks in order
+   """
+   if writer['executor'] is None:
+      write_compressed_bgzf_block(writer, compress_bgzf_block(data))
+      return
+   writer['pending_blocks'].append(writer['executor'].submit(compress_bgzf_block, data))
+   while len(writer['pending_blocks']) > writer['max_pending_blocks']:
+      write_compressed_bgzf_block(writer, writer['pending_blocks'].popleft().result())
+
+
+def write_compressed_bgzf_block(writer, block):
+   writer['block_offsets'].append(writer['compressed_size'])
+   writer['fh'].write(block)
+   writer['compressed_size'] += len(block)
+
+
+def close_bgzf_writer(writer, write_index = True):
+   """
+   Function that compresses the remaining buffer of a BGZF writer, and closes it (with the end-of-file block if requested)
+   Returns the index of the written records (virtual file offsets, see new_bgzf_index), written as '<bgzf_file>.tbi/.csi' if 'write_index' is set
+   """
+   data = writer['buffer']
+   for b in range(0, len(data), bgzf_block_size):
+      write_bgzf_block(writer, bytes(data[b:b + bgzf_block_size]))
+   writer['buffer'] = bytearray()
+   while len(writer['pending_blocks']) > 0:
+      write_compressed_bgzf_block(writer, writer['pending_blocks'].popleft().result())
+   if not writer['executor'] is None:
+      writer['executor'].shutdown()
+   if writer['eof']:
+      writer['fh'].write(bgzf_eof_block)
+   writer['fh'].close()
+
+   index = writer['index']
+   if index is None:
+      return None
+   block_offsets = writer['block_offsets']
+   def virtual_offset(uncompressed_offset):
+      if uncompressed_offset >= writer['uncompressed_size']:
+         return writer['compressed_size'] << 16
+      b = uncompressed_offset // bgzf_block_size
+      return (block_offsets[b] << 16) | (uncompressed_offset % bgzf_block_size)
+   for ref in index['refs']:
+      for chunks in ref['bins'].values():
+         for chunk in chunks:
+            chunk[0] = virtual_offset(chunk[0])
+            chunk[1] = virtual_offset(chunk[1])
+      for w in ref['linear']:
+         ref['linear'][w] = virtual_offset(ref['linear'][w])
+      ref['off_beg'] = virtual_offset(ref['off_beg'])
+      ref['off_end'] = virtual_offset(ref['off_end'])
+   if write_index:
+      write_bgzf_index(index, writer['bgzf_file'] + '.' + index['format'])
+   return index
+
+
+def new_bgzf_index(index_format):
+   """
+   Function that returns an empty index of VCF records (tabix: 'tbi', or 'csi'), with 16kb windows (linear index) and a binning
+   scheme of 5 (tbi, positions < 2^29) or 6 (csi, positions < 2^32) levels. Every sequence ('refs', in order of appearance) holds
+   the chunks of each bin, the first record offset of each window, and the number and offsets of all its records (pseudo-bin)
+   """
+   if not index_format in ['tbi','csi']:
+      raise ValueError('Unknown index format ' + str(index_format) + ' (expecting \'tbi\' or \'csi\')')
+   index = {}
+   index['format'] = index_format
+   index['min_shift'] = 14
+   index['n_lvls'] = 5 if index_format == 'tbi' else 6
+   index['refs'] = []
+   index['ref_names'] = set()
+   index['last_beg'] = -1
+   return index
+
+
+def add_bgzf_index_record(index, data, line_start, line_end, uncompressed_beg):
+   """
+   Function that adds a VCF record (data[line_start:line_end]) to an index (uncompressed offsets, translated into virtual offsets by close_bgzf_writer)
+   The record spans POS to POS + len(REF) - 1, or the END position of its INFO column (as tabix). Columns are located in place, as INFO may be large
+   """
+   uncompressed_end = uncompressed_beg + line_end - line_start
+   tabs = []
+   t = line_start - 1
+   while len(tabs) < 8:
+      t = data.find(b'\t', t + 1, line_end)
+      if t == -1:
+         break
+      tabs.append(t)
+   if len(tabs) < 7:
+      raise IOError('Cannot index VCF record with less than 8 columns: ' + str(data[line_start:min(line_end, line_start + 200)]))
+   info_end = tabs[7] if len(tabs) == 8 else line_end - (1 if data[line_end - 1] == 10 else 0)
+   chrom = data[line_start:tabs[0]]
+   beg = int(data[tabs[0] + 1:tabs[1]]) - 1
+   end = beg + max(tabs[3] - tabs[2] - 1, 1)
+   i = data.find(b'END=', tabs[6] + 1, info_end)
+   while i != -1:
+      if i == tabs[6] + 1 or data[i - 1] == 59: ## ';'
+         value_end = data.find(b';', i, info_end)
+         end = max(int(data[i + 4:info_end if value_end == -1 else value_end]), beg + 1)
+         break
+      i = data.find(b'END=', i + 4, info_end)
+   if end > 1 << (index['min_shift'] + 3 * index['n_lvls']):
+      raise IOError('Cannot index VCF record beyond position ' + str(1 << (index['min_shift'] + 3 * index['n_lvls'])) + ' in ' + str(index['format']) + ' format: ' + str(data[line_start:min(line_end, line_start + 200)]))
+
+   refs = index['refs']
+   if len(refs) == 0 or refs[-1]['name'] != chrom:
+      if chrom in index['ref_names']:
+         raise IOError('Cannot index VCF that is not sorted (records of sequence ' + str(chrom.decode()) + ' are not contiguous)')
+      index['ref_names'].add(chrom)
+      refs.append({'name': chrom, 'bins': {}, 'linear': {}, 'n_mapped': 0, 'off_beg': uncompressed_beg, 'off_end': uncompressed_end})
+      index['last_beg'] = -1
+   elif beg < index['last_beg']:
+      raise IOError('Cannot index VCF that is not sorted (position ' + str(beg + 1) + ' after ' + str(index['last_beg'] + 1) + ' on sequence ' + str(chrom.decode()) + ')')
+   index['last_beg'] = beg
+   ref = refs[-1]
+   ref['n_mapped'] += 1
+   ref['off_end'] = uncompressed_end
+
+   bin_id = reg2bin(beg, end, index['min_shift'], index['n_lvls'])
+   if not bin_id in ref['bins']:
+      ref['bins'][bin_id] = [[uncompressed_beg, uncompressed_end]]
+   else:
+      chunks = ref['bins'][bin_id]
+      if chunks[-1][1] == uncompressed_beg:
+         chunks[-1][1] = uncompressed_end
+      else:
+         chunks.append([uncompressed_beg, uncompressed_end])
+   linear = ref['linear']
+   for w in range(beg >> index['min_shift'], ((end - 1) >> index['min_shift']) + 1):
+      if not w in linear:
+         linear[w] = uncompressed_beg
+
+
+def reg2bin(beg, end, min_shift, n_lvls):
+   """
+   Function that returns the smallest bin (UCSC/SAM binning scheme) containing the interval 'beg' - 'end' (0-based, half-open)
+   """
+   end -= 1
+   shift = min_shift
+   t = ((1 << (3 * n_lvls + 3)) - 1) // 7
+   level = n_lvls
+   while level > 0:
+      t -= 1 << (3 * level)
+      if beg >> shift == end >> shift:
+         return t + (beg >> shift)
+      level -= 1
+      shift += 3
+   return 0
+
+
+def write_bgzf_index(index, index_file):
+   """
+   Function that writes an index of VCF records (virtual file offsets) as a tabix (.tbi) or CSI (.csi) file (BGZF-compressed)
+   Chunks of a bin that end and start in the same BGZF block are merged, and empty windows of the linear index are
+   set to the offset of the preceding window (tbi). For csi, each bin holds the linear offset of its first window.
+   """
+   min_shift = index['min_shift']
+   n_lvls = index['n_lvls']
+   pseudo_bin = ((1 << (3 * n_lvls + 3)) - 1) // 7 + 1
+   names = b''.join(ref['name'] + b'\x00' for ref in index['refs'])
+   ## tabix configuration: VCF format (2), sequence/begin/end columns (1/2/0), meta character '#', lines to skip (0)
+   tabix_conf = struct.pack('<6i', 2, 1, 2, 0, ord('#'), 0) + struct.pack('<i', len(names)) + names
+   data = []
+   if index['format'] == 'tbi':
+      data.append(b'TBI\x01' + struct.pack('<i', len(index['refs'])) + tabix_conf)
+   else:
+      data.append(b'CSI\x01' + struct.pack('<3i', min_shift, n_lvls, len(tabix_conf)) + tabix_conf + struct.pack('<i', len(index['refs'])))
+   for ref in index['refs']:
+      linear_index = []
+      if len(ref['linear']) > 0:
+         linear_index = [0] * (max(ref['linear'].keys()) + 1)
+         previous_offset = 0
+         for w in range(len(linear_index)):
+            previous_offset = ref['linear'].get(w, previous_offset)
+            linear_index[w] = previous_offset
+      data.append(struct.pack('<i', len(ref['bins']) + 1))
+      for bin_id in sorted(ref['bins'].keys()):
+         chunks = []
+         for chunk in sorted(ref['bins'][bin_id]):
+            if len(chunks) > 0 and chunks[-1][1] >> 16 == chunk[0] >> 16:
+               chunks[-1][1] = max(chunks[-1][1], chunk[1])
+            else:
+               chunks.append([chunk[0], chunk[1]])
+         if index['format'] == 'tbi':
+            data.append(struct.pack('<Ii', bin_id, len(chunks)))
+         else:
+            level = 0
+            while bin_id >= ((1 << (3 * level + 3)) - 1) // 7:
+               level += 1
+            bottom_window = (bin_id - ((1 << (3 * level)) - 1) // 7) << (3 * (n_lvls - level))
+            loffset = linear_index[bottom_window] if bottom_window < len(linear_index) else 0
+            data.append(struct.pack('<IQi', bin_id, loffset, len(chunks)))
+         data.append(b''.join(struct.pack('<2Q', chunk[0], chunk[1]) for chunk in chunks))
+      if index['format'] == 'tbi':
+         data.append(struct.pack('<Ii2Q2Q', pseudo_bin, 2, ref['off_beg'], ref['off_end'], ref['n_mapped'], 0))
+         data.append(struct.pack('<i', len(linear_index)) + struct.pack('<' + str(len(linear_index)) + 'Q', *linear_index))
+      else:
+         data.append(struct.pack('<IQi2Q2Q', pseudo_bin, 0, 2, ref['off_beg'], ref['off_end'], ref['n_mapped'], 0))
+   data.append(struct.pack('<Q', 0))
+   writer = open_bgzf_writer(index_file + '.tmp')
+   writer['buffer'].extend(b''.join(data))
+   close_bgzf_writer(writer)
+   os.rename(index_file + '.tmp', index_file)
+
+
+def concatenate_bgzf(out_file, header, bgzf_streams, indices = None):
+   """
+   Function that writes a BGZF file from a (text) header and BGZF block streams (without end-of-file blocks, see open_bgzf_writer),
+   the compressed blocks of each stream are copied as is (in the given order), i.e. without decompression and recompression
+   The indices of the streams (see close_bgzf_writer), if given, are merged (virtual offsets shifted to the start of each stream) and written as '<out_file>.tbi/.csi'
+   """
+   writer = open_bgzf_writer(out_file, eof = False)
+   write_bgzf(writer, header)
+   close_bgzf_writer(writer)
+   stream_offsets = []
+   out = open(out_file, 'ab')
+   for bgzf_stream in bgzf_streams:
+      stream_offsets.append(out.tell())
+      fh = open(bgzf_stream, 'rb')
+      shutil.copyfileobj(fh, out, 1024 * 1024)
+      fh.close()
+   out.write(bgzf_eof_block)
+   out.close()
+
+   if indices is None:
+      return
+   merged_index = new_bgzf_index(indices[0]['format'])
+   for stream_index, stream_offset in zip(indices, stream_offsets):
+      shift = stream_offset << 16
+      for ref in stream_index['refs']:
+         if len(merged_index['refs']) == 0 or merged_index['refs'][-1]['name'] != ref['name']:
+            if ref['name'] in merged_index['ref_names']:
+               raise IOError('Cannot merge indices of BGZF streams that are not sorted (records of sequence ' + str(ref['name'].decode()) + ' are not contiguous)')
+            merged_index['ref_names'].add(ref['name'])
+            merged_index['refs'].append({'name': ref['name'], 'bins': {}, 'linear': {}, 'n_mapped': 0, 'off_beg': ref['off_beg'] + shift, 'off_end': 0})
+         merged_ref = merged_index['refs'][-1]
+         for bin_id in ref['bins']:
+            merged_ref['bins'].setdefault(bin_id, []).extend([[chunk[0] + shift, chunk[1] + shift] for chunk in ref['bins'][bin_id]])
+         for w in ref['linear']:
+            if not w in merged_ref['linear']:
+               merged_ref['linear'][w] = ref['linear'][w] + shift
+         merged_ref['n_mapped'] += ref['n_mapped']
+         merged_ref['off_end'] = ref['off_end'] + shift
+   write_bgzf_index(merged_index, out_file + '.' + merged_index['format'])
+
+
+def fetch_fasta_sequence(fasta, chrom, start, end):
+   """
+   Function that returns the (upper case) reference sequence of a contig between 'start' and 'end' (0-based, half-open) from an indexed FASTA
+   Returns None if the contig is not in the FASTA index
+   """
+   if not chrom in fasta['contigs']:
+      return None
+   length, offset, line_bases, line_width = fasta['contigs'][chrom]
+   start = max(0, start)
+   end = min(end, length)
+   if start >= end:
+      return ''
+   file_start = offset + (start // line_bases) * line_width + start % line_bases
+   file_end = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+   if fasta['compressed_offsets'] is None:
+      sequence = fasta['mmap'][file_start:file_end]
+   else:
+      i = bisect.bisect_right(fasta['uncompressed_offsets'], file_start) - 1
+      compressed_offset = fasta['compressed_offsets'][i]
+      uncompressed_offset = fasta['uncompressed_offsets'][i]
+      chunks = []
+      while uncompressed_offset < file_end:
+         data, block_size = read_bgzf_block(fasta, compressed_offset)
+         if block_size <= 28 and len(data) == 0:
+            break
+         chunks.append(data[max(file_start - uncompressed_offset, 0):file_end - uncompressed_offset])
+         uncompressed_offset += len(data)
+         compressed_offset += block_size
+      sequence = b''.join(chunks)
+   return sequence.replace(b'\n', b'').replace(b'\r', b'').decode().upper()
+
+
+def left_align_variant(fasta, chrom, pos, ref, alt):
+   """
+   Function that trims and left-aligns a (biallelic) variant against the reference genome (as vt normalize)
+   Variants with non-nucleotide alleles (e.g. symbolic, '*'), or on contigs not in the FASTA, are returned unchanged
+   """
+   if ref == alt or re.match(r'^[ACGTN]+$', ref.upper()) is None or re.match(r'^[ACGTN]+$', alt.upper()) is None:
+      return (pos, ref, alt)
+   if not chrom in fasta['contigs']:
+      return (pos, ref, alt)
+   variant = (pos, ref, alt)
+   ref = ref.upper()
+   alt = alt.upper()
+   while True:
+      if len(ref) > 0 and len(alt) > 0 and ref[-1] == alt[-1]:
+         ref = ref[:-1]
+         alt = alt[:-1]
+      elif len(ref) == 0 or len(alt) == 0:
+         if pos <= 1:
+            break
+         pos = pos - 1
+         base = fetch_fasta_sequence(fasta, chrom, pos - 1, pos)
+         ref = base + ref
+         alt = base + alt
+      else:
+         break
+   if len(ref) == 0 or len(alt) == 0:
+      return variant
+   while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:
+      ref = ref[1:]
+      alt = alt[1:]
+      pos = pos + 1
+   return (pos, ref, alt)
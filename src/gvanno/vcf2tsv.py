@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+import gzip
 from cyvcf2 import VCF, Writer
 import numpy as np
 import re
 import subprocess
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = None
 
 version = '0.3.3'
 
@@ -16,13 +22,113 @@ def __main__():
    parser.add_argument("--skip_info_data",action = "store_true", help="Skip printing of data in INFO column")
    parser.add_argument("--skip_genotype_data", action="store_true", help="Skip printing of genotype_data (FORMAT columns)")
    parser.add_argument("--keep_rejected_calls", action="store_true", help="Print data for rejected calls")
+   parser.add_argument("--skip_hom_ref_calls", action="store_true", help="Skip printing of homozygous reference sample genotypes (0/0)")
    parser.add_argument("--print_data_type_header", action="store_true", help="Print a header line with data types of VCF annotations")
-   parser.add_argument("--compress", action="store_true", help="Compress TSV file with gzip")
+   parser.add_argument("--compress", action="store_true", help="Compress TSV file(s) with gzip")
+   parser.add_argument("--output_spec", action="append", type=parse_output_spec, default=[], help="Additional output TSV file, written in the same pass over the VCF, as <out_tsv>:<pass|all> (non-rejected calls only, or all calls) - may be given multiple times")
+   parser.add_argument("--columnar_output", action="append", type=parse_output_spec, default=[], help="Columnar output file (typed columns from the VCF header), written in the same pass over the VCF, as <out_file>:<pass|all> - may be given multiple times")
+   parser.add_argument("--columnar_format", choices=['parquet','arrow'], default='parquet', help="Format of columnar output files (Parquet, or Arrow IPC file)")
+   parser.add_argument("--columnar_batch_size", default=65536, type=int, help="Number of rows per record batch (row group) in columnar output files")
    args = parser.parse_args()
+   if len(args.columnar_output) > 0 and pa is None:
+      parser.error('columnar output requires the pyarrow module')
    
-   vcf2tsv(args.query_vcf, args.out_tsv, args.skip_info_data, args.skip_genotype_data, args.keep_rejected_calls, args.compress, args.print_data_type_header)
+   vcf2tsv(args.query_vcf, args.out_tsv, args.skip_info_data, args.skip_genotype_data, args.keep_rejected_calls, args.compress, args.print_data_type_header, args.output_spec,
+           args.columnar_output, args.columnar_format, args.columnar_batch_size, args.skip_hom_ref_calls)
          
 
+def parse_output_spec(output_spec):
+   """
+   Parses an output specification (<out_tsv>:<pass|all>) into a tuple (out_tsv, keep_rejected_calls)
+   """
+   out_tsv, sep, mode = output_spec.rpartition(':')
+   if out_tsv == '' or not mode in ['pass','all']:
+      raise argparse.ArgumentTypeError('output specification \'' + str(output_spec) + '\' is not formatted as <out_tsv>:<pass|all>')
+   return (out_tsv, mode == 'all')
+
+def write_tsv_line(tsv_outputs, line, rejected):
+   """
+   Writes a (formatted) TSV line to all outputs, rejected calls only to outputs that keep them
+   """
+   for out, keep_rejected_calls in tsv_outputs:
+      if keep_rejected_calls or not rejected:
+         out.write(line)
+
+
+def write_output_line(tsv_outputs, columnar_outputs, line_elements, num_record_elements, record_values, rejected):
+   """
+   Writes an output line (one per variant or sample genotype) to all TSV and columnar outputs, rejected calls only to outputs that keep them
+   Columnar rows consist of the typed variant-level values and the sample-level elements of the line
+   """
+   write_tsv_line(tsv_outputs, '\t'.join(line_elements) + '\n', rejected)
+   if len(columnar_outputs) > 0:
+      append_columnar_row(columnar_outputs, record_values + [None if e == '.' else e for e in line_elements[num_record_elements:]], rejected)
+
+
+def get_columnar_converter(column_type, column_number):
+   """
+   Returns the Arrow type of an INFO column and a function converting its (parsed, formatted) value into a typed value
+   Single-valued Flag/Integer/Float columns are typed, all other columns are kept as (formatted) strings
+   """
+   if column_type == 'Flag':
+      return (pa.bool_(), lambda value, formatted: not value is None)
+   if column_type == 'Integer' and column_number == '1':
+      return (pa.int64(), lambda value, formatted: value if isinstance(value,int) else None)
+   if column_type == 'Float' and column_number == '1':
+      return (pa.float64(), lambda value, formatted: value if isinstance(value,float) else None)
+   return (pa.string(), lambda value, formatted: None if formatted == '.' else formatted)
+
+def open_columnar_output(out_file, columnar_format, schema, keep_rejected_calls, batch_size):
+   columnar_output = {}
+   columnar_output['schema'] = schema
+   columnar_output['format'] = columnar_format
+   columnar_output['keep_rejected_calls'] = keep_rejected_calls
+   columnar_output['batch_size'] = batch_size
+   columnar_output['columns'] = [[] for field in schema]
+   columnar_output['num_rows'] = 0
+   if columnar_format == 'parquet':
+      columnar_output['writer'] = pq.ParquetWriter(out_file, schema, compression = 'snappy')
+   else:
+      columnar_output['sink'] = pa.OSFile(out_file, 'wb')
+      try:
+         columnar_output['writer'] = pa.ipc.new_file(columnar_output['sink'], schema, options = pa.ipc.IpcWriteOptions(compression = 'lz4'))
+      except (AttributeError, TypeError):
+         ## pyarrow versions without compressed IPC files
+         columnar_output['writer'] = pa.RecordBatchFileWriter(columnar_output['sink'], schema)
+   return columnar_output
+
+def append_columnar_row(columnar_outputs, row, rejected):
+   for columnar_output in columnar_outputs:
+      if columnar_output['keep_rejected_calls'] or not rejected:
+         for column, value in zip(columnar_output['columns'], row):
+            column.append(value)
+         columnar_output['num_rows'] += 1
+         if columnar_output['num_rows'] == columnar_output['batch_size']:
+            flush_columnar_output(columnar_output)
+
+def flush_columnar_output(columnar_output):
+   """
+   Writes the buffered rows of a columnar output as a typed record batch (Parquet row group)
+   """
+   if columnar_output['num_rows'] == 0:
+      return
+   schema = columnar_output['schema']
+   arrays = [pa.array(column, type = field.type) for column, field in zip(columnar_output['columns'], schema)]
+   batch = pa.RecordBatch.from_arrays(arrays, [field.name for field in schema])
+   if columnar_output['format'] == 'parquet':
+      columnar_output['writer'].write_table(pa.Table.from_batches([batch]))
+   else:
+      columnar_output['writer'].write_batch(batch)
+   columnar_output['columns'] = [[] for field in schema]
+   columnar_output['num_rows'] = 0
+
+def close_columnar_output(columnar_output):
+   flush_columnar_output(columnar_output)
+   columnar_output['writer'].close()
+   if 'sink' in columnar_output:
+      columnar_output['sink'].close()
+
+
 def check_subprocess(command):
    try:
       output = subprocess.check_output(str(command), stderr=subprocess.STDOUT, shell=True)
@@ -33,10 +139,105 @@ def check_subprocess(command):
       exit(0)
 
 
-def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejected_calls, compress, print_data_type_header):
+NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+def to_ascii(value):
+   if NON_ASCII.search(value) is None:
+      return value
+   return value.encode('ascii','ignore').decode('ascii')
+
+def compile_info_plan(info_columns_header, column_types):
+   """
+   Compiles a list of (INFO tag, formatter) for the sorted INFO columns, where the formatter of each column (chosen once by its type in the VCF header)
+   converts a parsed INFO value (single lookup per record) into a TSV value. INFO tags of other types are not printed
+   """
+   info_plan = []
+   for info_field in sorted(info_columns_header):
+      info_formatter = get_info_formatter(info_field, column_types[info_field])
+      if not info_formatter is None:
+         info_plan.append((info_field, info_formatter))
+   return info_plan
+
+def get_info_formatter(info_field, column_type):
+   
+   if column_type == 'Flag':
+      def format_flag(value, fixed_fields_string, alt):
+         if value is None:
+            return 'False'
+         return 'True'
+      return format_flag
+
+   if column_type == 'Float':
+      def format_float(value, fixed_fields_string, alt):
+         if type(value) is list or type(value) is tuple:
+            return ",".join(str(n) for n in value)
+         if value is None:
+            return '.'
+         if not isinstance(value,float):
+            print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'Float\', yet parsed as other type:' + str(type(value)))
+            if not ',' in str(alt):
+               print('Warning: Multiple values in INFO tag for single ALT allele (VCF multiallelic sites not decomposed properly?):' + str(fixed_fields_string) + '\t' + str(info_field) + '=' + str(value))
+            return '.'
+         return "{0:.7f}".format(value)
+      return format_float
+
+   if column_type == 'String' or column_type == 'Character':
+      def format_string(value, fixed_fields_string, alt):
+         if type(value) is list or type(value) is tuple:
+            return ",".join(str(n) for n in value)
+         if value is None:
+            return '.'
+         if isinstance(value,str):
+            return to_ascii(value)
+         print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'' + str(column_type) + '\', yet parsed as other type:' + str(type(value)))
+         return '.'
+      return format_string
+
+   if column_type == 'Integer':
+      def format_integer(value, fixed_fields_string, alt):
+         if type(value) is list or type(value) is tuple:
+            return ",".join(str(n) for n in value)
+         if value is None:
+            return '.'
+         if isinstance(value,int):
+            return str(value)
+         print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'Integer\', yet parsed as other type:' + str(type(value)))
+         return re.sub('\(|\)', '', value.encode('ascii','ignore').decode('ascii'))
+      return format_integer
+
+   return None
+
+def format_sample_column(sample_dat, column_type, num_samples):
+   """
+   Formats the values of a FORMAT tag for all samples of a record (array from cyvcf2), as a list of strings
+   Multi-valued entries are comma-separated, single values are printed for Integer and String tags only
+   """
+   if sample_dat is None:
+      return ['.'] * num_samples
+   if sample_dat.ndim > 1 and sample_dat.shape[1] > 1:
+      return [','.join(str(e) for e in sample_values) for sample_values in sample_dat.tolist()]
+   if column_type == 'String':
+      if sample_dat.ndim == 1:
+         return [str(e) for e in sample_dat.tolist()]
+      return [str(sample_values) for sample_values in sample_dat]
+   if column_type == 'Integer':
+      return [str(e) for e in sample_dat.reshape(-1).tolist()]
+   return ['.'] * sample_dat.shape[0]
+
+def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejected_calls, compress, print_data_type_header, output_specs = [], columnar_specs = [], columnar_format = 'parquet', columnar_batch_size = 65536, skip_hom_ref_calls = False):
    
    vcf = VCF(query_vcf, gts012 = True)
-   out = open(out_tsv,'w')
+   ## all output TSV files are filled from a single pass over the VCF (each line is formatted once), compressed on the fly
+   output_files = [(out_tsv, keep_rejected_calls)]
+   output_files.extend(output_specs)
+   tsv_outputs = []
+   for output_fname, output_keep_rejected_calls in output_files:
+      if compress is True:
+         tsv_outputs.append((gzip.open(output_fname + '.gz', 'wt', compresslevel = 6), output_keep_rejected_calls))
+      else:
+         tsv_outputs.append((open(output_fname, 'w'), output_keep_rejected_calls))
+   output_files.extend(columnar_specs)
+   keep_rejected_calls = any(output_keep_rejected_calls for output_fname, output_keep_rejected_calls in output_files)
    
    fixed_columns_header = ['CHROM','POS','ID','REF','ALT','QUAL','FILTER']
    fixed_columns_header_type = ['String','Integer','String','String','String','Float','String']
@@ -45,6 +246,7 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
    format_columns_header = []
    sample_columns_header = []
    column_types = {}
+   column_numbers = {}
    gt_present_header = 0
    
    if len(samples) > 0:
@@ -55,6 +257,7 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
       if 'ID' in header_element.keys() and 'HeaderType' in header_element.keys():
          if header_element['HeaderType'] == 'INFO' or header_element['HeaderType'] == 'FORMAT':
             column_types[header_element['ID']] = header_element['Type']
+            column_numbers[header_element['ID']] = header_element.get('Number')
          if header_element['HeaderType'] == 'INFO':
             if skip_info_data is False:
                info_columns_header.append(header_element['ID'])
@@ -80,7 +283,7 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
          else:
             header_line = '\t'.join(fixed_columns_header)
             
-   out.write('#https://github.com/sigven/vcf2tsv version=' + str(version) + '\n')
+   write_tsv_line(tsv_outputs, '#https://github.com/sigven/vcf2tsv version=' + str(version) + '\n', False)
    if print_data_type_header is True:
       header_tags = header_line.rstrip().split('\t')
       header_types = []
@@ -88,10 +291,39 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
          if h in column_types:
             header_types.append(str(column_types[h]))
       header_line_type = '\t'.join(fixed_columns_header_type) + '\t' + '\t'.join(header_types)
-      out.write('#' + str(header_line_type) + '\n')
-      out.write(str(header_line) + '\n')
+      write_tsv_line(tsv_outputs, '#' + str(header_line_type) + '\n', False)
+      write_tsv_line(tsv_outputs, str(header_line) + '\n', False)
    else:
-      out.write(str(header_line) + '\n')
+      write_tsv_line(tsv_outputs, str(header_line) + '\n', False)
+   
+   ## column plan, compiled once from the header: sorted INFO columns with a formatter per column type
+   info_plan = compile_info_plan(info_columns_header, column_types)
+   format_columns_sorted = sorted(format_columns_header)
+   
+   ## genotype labels (by cyvcf2 gt_types: 0=HOM_REF, 1=HET, 2=HOM_ALT, 3=UNKNOWN), and sample print order (sorted by sample name)
+   gt_labels = np.array(['./.','./.','./.','./.'], dtype=object)
+   if gt_present_header == 1:
+      gt_labels = np.array(['0/0','0/1','1/1','./.'], dtype=object)
+   sample_order = np.array(sorted(range(len(samples)), key = lambda i: samples[i]), dtype=np.int64)
+   sample_order_mask = np.ones(len(samples), dtype=bool)
+   
+   ## columnar outputs: typed variant-level columns (fixed and INFO), and sample-level columns (as in TSV lines)
+   columnar_outputs = []
+   if len(columnar_specs) > 0:
+      columnar_fields = [pa.field('CHROM', pa.string()), pa.field('POS', pa.int64()), pa.field('ID', pa.string()), pa.field('REF', pa.string()),
+                         pa.field('ALT', pa.string()), pa.field('QUAL', pa.float64()), pa.field('FILTER', pa.string())]
+      info_converters = []
+      for info_field, info_formatter in info_plan:
+         column_arrow_type, column_converter = get_columnar_converter(column_types[info_field], column_numbers[info_field])
+         columnar_fields.append(pa.field(info_field, column_arrow_type))
+         info_converters.append(column_converter)
+      if len(sample_columns_header) > 0 and skip_genotype_data is False:
+         for sample_column in sample_columns_header + format_columns_sorted + ['GT']:
+            columnar_fields.append(pa.field(sample_column, pa.string()))
+      columnar_schema = pa.schema(columnar_fields)
+      for output_fname, output_keep_rejected_calls in columnar_specs:
+         columnar_outputs.append(open_columnar_output(output_fname, columnar_format, columnar_schema, output_keep_rejected_calls, columnar_batch_size))
+   record_values = None
    
    for rec in vcf:
       rec_id = '.'
@@ -110,100 +342,39 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
       fixed_fields_string = str(rec.CHROM) + '\t' + str(pos) + '\t' + str(rec_id) + '\t' + str(rec.REF) + '\t' + str(alt) + '\t' + str(rec_qual) + '\t' + str(rec_filter)
       
       
-      if not 'PASS' in rec_filter and not keep_rejected_calls:
+      rec_rejected = not 'PASS' in rec_filter
+      if rec_rejected and not keep_rejected_calls:
          continue
       
-      variant_info = rec.INFO
       vcf_info_data = []
       if skip_info_data is False:
-         for info_field in sorted(info_columns_header):
-            if column_types[info_field] == 'Flag':
-               if variant_info.get(info_field) is None:
-                  vcf_info_data.append('False')
-               else:
-                  vcf_info_data.append('True')
-            elif column_types[info_field] == 'Float' or column_types[info_field] == 'Integer' or column_types[info_field] == 'String' or column_types[info_field] == 'Character':
-               if type(variant_info.get(info_field)) is list or type(variant_info.get(info_field)) is tuple:
-                  vcf_info_data.append(",".join(str(n) for n in variant_info.get(info_field)))
-               else:
-                  if variant_info.get(info_field) is None:
-                     vcf_info_data.append('.')
-                  else:
-                     if column_types[info_field] == 'Float':
-                        if not isinstance(variant_info.get(info_field),float):
-                           print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'Float\', yet parsed as other type:' + str(type(variant_info.get(info_field))))
-                           if not ',' in str(alt):
-                              print('Warning: Multiple values in INFO tag for single ALT allele (VCF multiallelic sites not decomposed properly?):' + str(fixed_fields_string) + '\t' + str(info_field) + '=' + str(variant_info.get(info_field)))
-                           vcf_info_data.append('.')
-                        else:
-                           val = str("{0:.7f}".format(variant_info.get(info_field)))
-                           vcf_info_data.append(val)
-                     else:
-                        if column_types[info_field] == 'String' or column_types[info_field] == 'Character':
-                           if isinstance(variant_info.get(info_field),str):
-                              #print(str(info_field) + '\t' + variant_info.get(info_field).encode('ascii','ignore').rstrip().decode('ascii'))
-                              vcf_info_data.append(variant_info.get(info_field).encode('ascii','ignore').decode('ascii'))
-                           else:
-                              vcf_info_data.append('.')
-                              if column_types[info_field] == 'String':
-                                    print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'String\', yet parsed as other type:' + str(type(variant_info.get(info_field))))
-                              if column_types[info_field] == 'Character':
-                                    print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'Character\', yet parsed as other type:' + str(type(variant_info.get(info_field))))
-                        else:
-                           if isinstance(variant_info.get(info_field),int):
-                              vcf_info_data.append(str(variant_info.get(info_field)))
-                           else:
-                              print('vcf2tsv.py WARNING:\tINFO tag ' + str(info_field) + ' is defined in the VCF header as type \'Integer\', yet parsed as other type:' + str(type(variant_info.get(info_field))))
-                              vcf_info_data.append(re.sub('\(|\)', '', variant_info.get(info_field).encode('ascii','ignore').decode('ascii')))
+         variant_info_get = rec.INFO.get
+         info_values = [variant_info_get(info_field) for info_field, info_formatter in info_plan]
+         for (info_field, info_formatter), value in zip(info_plan, info_values):
+            vcf_info_data.append(info_formatter(value, fixed_fields_string, alt))
+      if len(columnar_outputs) > 0:
+         record_values = [str(rec.CHROM), pos, rec.ID, str(rec.REF), str(alt), rec.QUAL, rec_filter]
+         if skip_info_data is False:
+            record_values.extend(column_converter(value, formatted) for column_converter, value, formatted in zip(info_converters, info_values, vcf_info_data))
 
       #print(str(vcf_info_data))
-      #dictionary, with sample names as keys, values being genotype data (dictionary with format tags as keys)
-      vcf_sample_genotype_data = {}
+      ## genotype data as whole-record columns (one value per sample), and the (sorted) samples for which a line is printed
+      format_value_columns = []
       if len(samples) > 0 and skip_genotype_data is False:
-         gt_cyvcf = rec.gt_types
-         i = 0
-         while i < len(samples):
-            vcf_sample_genotype_data[samples[i]] = {}
-            gt = './.'
-            if gt_present_header == 1:
-               if gt_cyvcf[i] == 0:
-                  gt = '0/0'
-               if gt_cyvcf[i] == 1:
-                  gt = '0/1'
-               if gt_cyvcf[i] == 2:
-                  gt = '1/1'
-            vcf_sample_genotype_data[samples[i]]['GT'] = gt
-            i = i + 1
-               
-      for format_tag in sorted(format_columns_header):
-         if len(samples) > 0 and skip_genotype_data is False:
-            sample_dat = rec.format(format_tag)
-            if sample_dat is None:
-               k = 0
-               while k < len(samples):
-                  if samples[k] in vcf_sample_genotype_data:
-                     vcf_sample_genotype_data[samples[k]][format_tag] = '.'
-                  k = k + 1               
-               continue
-            dim = sample_dat.shape
-            j = 0
-            ## sample-wise
-            while j < dim[0]:
-               if sample_dat[j].size > 1:
-                  d = ','.join(str(e) for e in np.ndarray.tolist(sample_dat[j]))
-                  if samples[j] in vcf_sample_genotype_data:
-                     vcf_sample_genotype_data[samples[j]][format_tag] = d
-               else:
-                  d = '.'
-                  if column_types[format_tag] == 'String':
-                     d = str(sample_dat[j])
-                  if column_types[format_tag] == 'Integer':
-                     d = str(sample_dat[j][0])
-                  if samples[j] in vcf_sample_genotype_data:
-                     vcf_sample_genotype_data[samples[j]][format_tag] = d
-               j = j + 1
+         gt_types = rec.gt_types
+         gt_column = gt_labels[gt_types]
+         sample_mask = sample_order_mask.copy()
+         if keep_rejected_calls is False:
+            sample_mask &= (gt_column != './.')
+         if skip_hom_ref_calls is True:
+            sample_mask &= (gt_column != '0/0')
+         sample_indices = sample_order[sample_mask[sample_order]]
+         for format_tag in format_columns_sorted:
+            format_column = format_sample_column(rec.format(format_tag), column_types[format_tag], len(samples))
+            if skip_info_data is False:
+               format_column = [to_ascii(v) for v in format_column]
+            format_value_columns.append(format_column)
       
-      #print(str(vcf_sample_genotype_data))
       tsv_elements = []
       tsv_elements.append(fixed_fields_string)
       if skip_info_data is False:
@@ -211,66 +382,36 @@ def vcf2tsv(query_vcf, out_tsv, skip_info_data, skip_genotype_data, keep_rejecte
             if len(sample_columns_header) > 0:
                tsv_elements.append("\t".join(str(n) for n in vcf_info_data))
                ## one line per sample variant
-               for s in sorted(vcf_sample_genotype_data.keys()):
-                  sample = s
-                  line_elements = []
-                  line_elements.extend(tsv_elements)
-                  line_elements.append(sample)
-                  gt_tag = '.'
-                  for tag in sorted(vcf_sample_genotype_data[sample].keys()):
-                     if tag != 'GT':
-                        line_elements.append(vcf_sample_genotype_data[sample][tag].encode('ascii','ignore').decode('ascii'))
-                     else:
-                        gt_tag = vcf_sample_genotype_data[sample][tag].encode('ascii','ignore').decode('ascii')
-                  line_elements.append(gt_tag)
-                  if gt_tag == './.' or gt_tag == '.':
-                     if keep_rejected_calls:
-                        out.write('\t'.join(line_elements) + '\n')
-                  else:
-                     out.write("\t".join(str(n) for n in line_elements) + '\n')
-                    
+               for j in sample_indices:
+                  line_elements = tsv_elements + [samples[j]] + [format_column[j] for format_column in format_value_columns] + [gt_column[j]]
+                  write_output_line(tsv_outputs, columnar_outputs, line_elements, len(tsv_elements), record_values, rec_rejected or gt_column[j] == './.')
             else:
                tsv_elements.append("\t".join(str(n) for n in vcf_info_data))
                line_elements = []
                line_elements.extend(tsv_elements)
-               out.write('\t'.join(line_elements) + '\n')
+               write_output_line(tsv_outputs, columnar_outputs, line_elements, len(tsv_elements), record_values, rec_rejected)
          else:
             tsv_elements.append("\t".join(str(n) for n in vcf_info_data))
             line_elements = []
             line_elements.extend(tsv_elements)
-            out.write('\t'.join(line_elements) + '\n')
+            write_output_line(tsv_outputs, columnar_outputs, line_elements, len(tsv_elements), record_values, rec_rejected)
       else:
          if skip_genotype_data is False:
             if len(sample_columns_header) > 0:
                ## one line per sample variant
-               for s in sorted(vcf_sample_genotype_data.keys()):
-                  sample = s
-                  line_elements = []
-                  line_elements.extend(tsv_elements)
-                  line_elements.append(sample)
-                  gt_tag = '.'
-                  for tag in sorted(vcf_sample_genotype_data[sample].keys()):
-                     if tag != 'GT':
-                        line_elements.append(vcf_sample_genotype_data[sample][tag])
-                     else:
-                        gt_tag = vcf_sample_genotype_data[sample][tag]
-                  line_elements.append(gt_tag)
-                  if gt_tag == './.' or gt_tag == '.':
-                     if keep_rejected_calls:
-                        out.write('\t'.join(line_elements) + '\n')
-                  else:
-                     out.write('\t'.join(line_elements) + '\n')
+               for j in sample_indices:
+                  line_elements = tsv_elements + [samples[j]] + [format_column[j] for format_column in format_value_columns] + [gt_column[j]]
+                  write_output_line(tsv_outputs, columnar_outputs, line_elements, len(tsv_elements), record_values, rec_rejected or gt_column[j] == './.')
          else:
             line_elements = []
             line_elements.extend(tsv_elements)
             line_elements = tsv_elements
-            out.write('\t'.join(line_elements) + '\n')
+            write_output_line(tsv_outputs, columnar_outputs, line_elements, len(tsv_elements), record_values, rec_rejected)
        
-   out.close()
-   
-   if compress is True:
-      command = 'gzip -f ' + str(out_tsv)
-      check_subprocess(command)
+   for out, output_keep_rejected_calls in tsv_outputs:
+      out.close()
+   for columnar_output in columnar_outputs:
+      close_columnar_output(columnar_output)
 
 if __name__=="__main__": __main__()
 
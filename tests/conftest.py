@@ -0,0 +1,8 @@
+import os
+import sys
+
+## gvanno.py (repository root), the in-container scripts (src/gvanno) and annoutils (src/gvanno/lib)
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for module_dir in [base_dir, os.path.join(base_dir, 'src', 'gvanno'), os.path.join(base_dir, 'src', 'gvanno', 'lib')]:
+   if not module_dir in sys.path:
+      sys.path.insert(0, module_dir)
@@ -0,0 +1,222 @@
+import gzip
+import os
+import random
+import shutil
+import struct
+import subprocess
+
+import pytest
+from cyvcf2 import VCF
+
+import annoutils
+
+header = '##fileformat=VCFv4.2\n##INFO=<ID=END,Number=1,Type=Integer,Description="End position">\n##contig=<ID=1>\n##contig=<ID=2>\n##contig=<ID=X>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+requires_htslib_tools = pytest.mark.skipif(shutil.which('bgzip') is None or shutil.which('tabix') is None, reason = 'bgzip/tabix (htslib) not installed')
+
+
+def vcf_records(num_records, seed = 1):
+   """
+   Sorted VCF records on chromosomes 1, 2 and X, spanning many 16kb windows (with some deletions and END-tagged records spanning windows)
+   """
+   random.seed(seed)
+   records = []
+   for chrom in ['1', '2', 'X']:
+      pos = 1
+      for i in range(num_records // 3):
+         pos += random.randint(1, 400)
+         if i % 50 == 0:
+            records.append(chrom + '\t' + str(pos) + '\t.\tA\t<DEL>\t50\tPASS\tEND=' + str(pos + 40000) + '\n')
+         elif i % 7 == 0:
+            records.append(chrom + '\t' + str(pos) + '\t.\tACGTACGT\tA\t50\tPASS\t.\n')
+         else:
+            records.append(chrom + '\t' + str(pos) + '\t.\tA\tG\t50\tPASS\tDP=' + str(i) + '\n')
+   return records
+
+
+def record_span(record):
+   fields = record.split('\t')
+   end = int(fields[1]) + len(fields[3]) - 1
+   if fields[7].startswith('END='):
+      end = int(fields[7][4:])
+   return (fields[0], int(fields[1]), end)
+
+
+def overlapping(records, chrom, start, end):
+   return [r for r in records if record_span(r)[0] == chrom and record_span(r)[1] <= end and record_span(r)[2] >= start]
+
+
+def write_bgzf_vcf(fname, records, index = 'tbi', threads = 1):
+   writer = annoutils.open_bgzf_writer(fname, threads = threads, index = index)
+   annoutils.write_bgzf(writer, header)
+   for i in range(0, len(records), 1000):
+      annoutils.write_bgzf(writer, ''.join(records[i:i + 1000]))
+   return annoutils.close_bgzf_writer(writer)
+
+
+def read_bgzf_blocks(fname):
+   data = open(fname, 'rb').read()
+   blocks = []
+   offset = 0
+   while offset < len(data):
+      assert data[offset:offset + 4] == b'\x1f\x8b\x08\x04'
+      assert data[offset + 12:offset + 14] == b'BC'
+      block_size = struct.unpack_from('<H', data, offset + 16)[0] + 1
+      blocks.append(data[offset:offset + block_size])
+      offset += block_size
+   return blocks
+
+
+def test_bgzf_writer(tmpdir):
+   records = vcf_records(9000)
+   text = header + ''.join(records)
+   fname = str(tmpdir.join('single.vcf.gz'))
+   write_bgzf_vcf(fname, records, index = None)
+   blocks = read_bgzf_blocks(fname)
+   assert len(blocks) > 2
+   assert blocks[-1] == annoutils.bgzf_eof_block
+   assert all(struct.unpack_from('<I', b, len(b) - 4)[0] == annoutils.bgzf_block_size for b in blocks[:-2])
+   assert gzip.open(fname, 'rt').read() == text
+   ## compressed by a thread pool, blocks are written in order
+   fname_threaded = str(tmpdir.join('threaded.vcf.gz'))
+   write_bgzf_vcf(fname_threaded, records, index = None, threads = 3)
+   assert open(fname_threaded, 'rb').read() == open(fname, 'rb').read()
+
+
+def test_reg2bin():
+   assert annoutils.reg2bin(0, 1, 14, 5) == 4681
+   assert annoutils.reg2bin(16384, 16385, 14, 5) == 4682
+   assert annoutils.reg2bin(0, 16385, 14, 5) == 585
+   assert annoutils.reg2bin(0, 1 << 17, 14, 5) == 585
+   assert annoutils.reg2bin(0, (1 << 17) + 1, 14, 5) == 73
+   assert annoutils.reg2bin(0, 1 << 29, 14, 5) == 0
+   assert annoutils.reg2bin(0, 1, 14, 6) == 37449
+   assert annoutils.reg2bin(0, 1 << 32, 14, 6) == 0
+
+
+@pytest.mark.parametrize('index_format', ['tbi', 'csi'])
+def test_bgzf_index_queries(tmpdir, index_format):
+   records = vcf_records(9000)
+   fname = str(tmpdir.join('indexed.vcf.gz'))
+   write_bgzf_vcf(fname, records, index = index_format, threads = 2)
+   assert os.path.exists(fname + '.' + index_format)
+   vcf = VCF(fname)
+   random.seed(2)
+   for chrom in ['1', '2', 'X']:
+      for i in range(25):
+         start = random.randint(1, 600000)
+         end = start + random.randint(0, 50000)
+         assert [str(rec).split('\t')[1] for rec in vcf(chrom + ':' + str(start) + '-' + str(end))] == [r.split('\t')[1] for r in overlapping(records, chrom, start, end)]
+   vcf.close()
+   if index_format == 'tbi':
+      assert [(seq['name'], seq['n_mapped']) for seq in annoutils.read_tabix_index(fname + '.tbi')] == [(chrom, len([r for r in records if r.startswith(chrom + '\t')])) for chrom in ['1', '2', 'X']]
+
+
+def test_bgzf_index_unsorted(tmpdir):
+   records = vcf_records(300)
+   writer = annoutils.open_bgzf_writer(str(tmpdir.join('unsorted.vcf.gz')), index = 'tbi')
+   annoutils.write_bgzf(writer, header + ''.join(records[:50]))
+   with pytest.raises(IOError):
+      annoutils.write_bgzf(writer, records[10])
+   with pytest.raises(ValueError):
+      annoutils.new_bgzf_index('bai')
+
+
+def test_concatenate_bgzf(tmpdir):
+   records = vcf_records(9000)
+   streams = []
+   indices = []
+   for part in [records[:2000], records[2000:2001], records[2001:]]:
+      streams.append(str(tmpdir.join('part' + str(len(streams)) + '.gz')))
+      writer = annoutils.open_bgzf_writer(streams[-1], eof = False, index = 'tbi')
+      annoutils.write_bgzf(writer, ''.join(part))
+      indices.append(annoutils.close_bgzf_writer(writer, write_index = False))
+   fname = str(tmpdir.join('concatenated.vcf.gz'))
+   annoutils.concatenate_bgzf(fname, header, streams, indices)
+   assert gzip.open(fname, 'rt').read() == header + ''.join(records)
+   assert read_bgzf_blocks(fname)[-1] == annoutils.bgzf_eof_block
+   vcf = VCF(fname)
+   for chrom, start, end in [('1', 1, 1000000), ('2', 1, 100), ('2', 150000, 250000), ('X', 300000, 300100)]:
+      assert [str(rec).split('\t')[1] for rec in vcf(chrom + ':' + str(start) + '-' + str(end))] == [r.split('\t')[1] for r in overlapping(records, chrom, start, end)]
+   vcf.close()
+   ## streams of the same sequence that are not contiguous
+   with pytest.raises(IOError):
+      annoutils.concatenate_bgzf(str(tmpdir.join('unsorted.vcf.gz')), header, [streams[0], streams[2], streams[0]], [indices[0], indices[2], indices[0]])
+
+
+@requires_htslib_tools
+def test_bgzf_round_trip_htslib(tmpdir):
+   records = vcf_records(9000)
+   fname = str(tmpdir.join('indexed.vcf.gz'))
+   write_bgzf_vcf(fname, records, threads = 2)
+   assert subprocess.check_output(['bgzip', '-dc', fname]).decode() == header + ''.join(records)
+   assert subprocess.check_output(['tabix', fname, '2:150000-250000']).decode() == ''.join(overlapping(records, '2', 150000, 250000))
+   ## bgzip output, indexed by tabix, as read by read_tabix_index and get_balanced_regions
+   bgzip_fname = str(tmpdir.join('bgzip.vcf.gz'))
+   subprocess.check_call('bgzip -dc ' + fname + ' | bgzip -c > ' + bgzip_fname + ' && tabix -p vcf ' + bgzip_fname, shell = True)
+   assert [(seq['name'], seq['n_mapped']) for seq in annoutils.read_tabix_index(bgzip_fname + '.tbi')] == [(seq['name'], seq['n_mapped']) for seq in annoutils.read_tabix_index(fname + '.tbi')]
+
+
+@pytest.mark.parametrize('num_regions', [1, 3, 8])
+def test_get_balanced_regions(tmpdir, num_regions):
+   records = vcf_records(30000)
+   fname = str(tmpdir.join('indexed.vcf.gz'))
+   write_bgzf_vcf(fname, records)
+   region_sets = annoutils.get_balanced_regions(fname, num_regions)
+   assert len(region_sets) == num_regions
+   region_index = annoutils.get_region_set_index(region_sets)
+   ## every record belongs to exactly one set (by POS), sets are contiguous and in genomic order
+   set_sizes = [0] * len(region_sets)
+   previous_set = 0
+   for record in records:
+      chrom, pos, end = record_span(record)
+      i = annoutils.find_region_set(region_index, chrom, pos)
+      assert len([r for r in region_sets[i] if r[0] == chrom and r[1] <= pos and (r[2] is None or pos <= r[2])]) == 1
+      assert i >= previous_set
+      previous_set = i
+      set_sizes[i] += 1
+   assert max(set_sizes) <= 1.25 * len(records) / num_regions
+
+
+def write_fasta(tmpdir, contigs, bgzipped = False):
+   """
+   Writes an indexed FASTA (.fai, and .gzi if bgzipped) with 10 bases per line, such that sequences span many lines (and BGZF blocks)
+   """
+   fasta = ''
+   fai = ''
+   for name, sequence in contigs:
+      offset = len(fasta) + len(name) + 2
+      fasta += '>' + name + '\n' + ''.join(sequence[i:i + 10] + '\n' for i in range(0, len(sequence), 10))
+      fai += name + '\t' + str(len(sequence)) + '\t' + str(offset) + '\t10\t11\n'
+   fname = str(tmpdir.join('reference.fa'))
+   if bgzipped:
+      fname = fname + '.gz'
+      writer = annoutils.open_bgzf_writer(fname)
+      annoutils.write_bgzf(writer, fasta)
+      annoutils.close_bgzf_writer(writer)
+      block_offsets = writer['block_offsets'][1:]
+      gzi = struct.pack('<Q', len(block_offsets)) + b''.join(struct.pack('<2Q', offset, (b + 1) * annoutils.bgzf_block_size) for b, offset in enumerate(block_offsets))
+      open(fname + '.gzi', 'wb').write(gzi)
+   else:
+      open(fname, 'w').write(fasta)
+   open(fname + '.fai', 'w').write(fai)
+   return annoutils.open_indexed_fasta(fname)
+
+
+@pytest.mark.parametrize('bgzipped', [False, True])
+def test_left_align_variant(tmpdir, bgzipped):
+   ## a (CA)n repeat at positions 4-11, flanked by a long sequence (the bgzipped FASTA spans several BGZF blocks)
+   random.seed(3)
+   flank = ''.join(random.choice('ACGT') for i in range(200000))
+   fasta = write_fasta(tmpdir, [('1', 'GGGCACACACAGGG' + flank), ('2', flank + 'GTTTTTTC')], bgzipped)
+   assert annoutils.fetch_fasta_sequence(fasta, '1', 0, 14) == 'GGGCACACACAGGG'
+   ## insertion and deletion of CA, at the end of the repeat
+   assert annoutils.left_align_variant(fasta, '1', 11, 'A', 'ACA') == (3, 'G', 'GCA')
+   assert annoutils.left_align_variant(fasta, '1', 9, 'ACA', 'A') == (3, 'GCA', 'G')
+   ## lower case alleles, and a deletion in a homopolymer (beyond the first BGZF block)
+   assert annoutils.left_align_variant(fasta, '1', 11, 'a', 'aca') == (3, 'G', 'GCA')
+   assert annoutils.left_align_variant(fasta, '2', 200007, 'TC', 'C') == (200001, 'GT', 'G')
+   ## MNPs are trimmed, SNVs, symbolic alleles and variants on other contigs are unchanged
+   assert annoutils.left_align_variant(fasta, '1', 4, 'CA', 'CT') == (5, 'A', 'T')
+   assert annoutils.left_align_variant(fasta, '1', 4, 'C', 'T') == (4, 'C', 'T')
+   assert annoutils.left_align_variant(fasta, '1', 4, 'C', '<DEL>') == (4, 'C', '<DEL>')
+   assert annoutils.left_align_variant(fasta, '3', 11, 'A', 'ACA') == (11, 'A', 'ACA')
@@ -0,0 +1,86 @@
+import gzip
+import sqlite3
+
+import annoutils
+import gvanno_cache
+
+header = ['##fileformat=VCFv4.2\n', '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+annotated_header = header[:2] + ['##INFO=<ID=SYMBOL,Number=.,Type=String,Description="Gene symbol">\n'] + header[2:]
+records = [('1', 1000, 'A', 'G', 'PASS'), ('1', 2000, 'C', 'T', 'LowQual'), ('2', 500, 'G', 'GA', 'PASS'), ('X', 300, 'T', 'C', 'PASS')]
+
+
+def write_vcf(fname, lines):
+   writer = annoutils.open_bgzf_writer(fname, index = 'tbi')
+   annoutils.write_bgzf(writer, ''.join(lines))
+   annoutils.close_bgzf_writer(writer)
+
+
+def query_lines():
+   return header + [chrom + '\t' + str(pos) + '\t.\t' + ref + '\t' + alt + '\t50\t' + filter_value + '\tDP=10\n' for chrom, pos, ref, alt, filter_value in records]
+
+
+def annotated_lines(symbol):
+   return annotated_header + [chrom + '\t' + str(pos) + '\t.\t' + ref + '\t' + alt + '\t50\t' + filter_value + '\tDP=10;SYMBOL=' + symbol + str(pos) + '\n' for chrom, pos, ref, alt, filter_value in records]
+
+
+def read_records(fname):
+   return [line for line in gzip.open(fname, 'rt') if not line.startswith('#')]
+
+
+def annotate_misses(tmpdir, cache, symbol):
+   """
+   Runs split, annotates the cache misses (as STEP 1-3 would) and merges them with the cached hits, returns the merged VCF
+   """
+   query_vcf = str(tmpdir.join('sample.gvanno_ready.vcf.gz'))
+   write_vcf(query_vcf, query_lines())
+   gvanno_cache.split_cached_variants(query_vcf, cache)
+   misses = set((line.split('\t')[0], line.split('\t')[1]) for line in read_records(str(tmpdir.join('sample.gvanno_ready.cache_miss.vcf.gz'))))
+   annotated_vcf = str(tmpdir.join('sample.gvanno_ready.cache_miss.vep.vcfanno.annotated.vcf.gz'))
+   write_vcf(annotated_vcf, [line for line in annotated_lines(symbol) if line.startswith('#') or (line.split('\t')[0], line.split('\t')[1]) in misses])
+   out_vcf = str(tmpdir.join('sample.vep.vcfanno.annotated.vcf'))
+   gvanno_cache.merge_cached_variants(query_vcf, annotated_vcf, out_vcf, cache)
+   return (out_vcf + '.gz', len(misses))
+
+
+def test_split_merge_round_trip(tmpdir):
+   cache = gvanno_cache.open_annotation_cache(str(tmpdir.join('cache.sqlite')), 'grch37', 'v1', 'lof_prediction=0')
+   out_vcf, num_misses = annotate_misses(tmpdir, cache, 'A')
+   assert num_misses == len(records)
+   assert read_records(out_vcf) == [line for line in annotated_lines('A') if not line.startswith('#')]
+   ## second run: all but the first variant (always annotated, for the VCF header) are cache hits with the annotations of the first run
+   out_vcf, num_misses = annotate_misses(tmpdir, cache, 'B')
+   assert num_misses == 1
+   assert read_records(out_vcf) == [line for line in annotated_lines('B')[:len(annotated_header) + 1] if not line.startswith('#')] + [line for line in annotated_lines('A')[len(annotated_header) + 1:]]
+   assert read_records(out_vcf.replace('.annotated.vcf.gz', '.annotated.pass.vcf.gz')) == [line for line in read_records(out_vcf) if line.split('\t')[6] == 'PASS']
+
+
+def test_other_versions_are_kept(tmpdir):
+   cache_db = str(tmpdir.join('cache.sqlite'))
+   cache = gvanno_cache.open_annotation_cache(cache_db, 'grch37', 'v1', 'lof_prediction=0')
+   annotate_misses(tmpdir, cache, 'A')
+   cache['db'].close()
+   ## another bundle version does not see (nor purge) the annotations of v1
+   cache = gvanno_cache.open_annotation_cache(cache_db, 'grch37', 'v2', 'lof_prediction=0')
+   assert gvanno_cache.lookup_annotation(cache, '1', 2000, 'C', 'T') is None
+   cache['db'].close()
+   cache = gvanno_cache.open_annotation_cache(cache_db, 'grch37', 'v1', 'lof_prediction=0')
+   assert gvanno_cache.lookup_annotation(cache, '1', 2000, 'C', 'T') == 'SYMBOL=A2000'
+   assert cache['key'][1] == 'v1;payload=' + str(gvanno_cache.cache_payload_version)
+
+
+def test_locked_cache_is_not_fatal(tmpdir):
+   cache_db = str(tmpdir.join('cache.sqlite'))
+   cache = gvanno_cache.open_annotation_cache(cache_db, 'grch37', 'v1', 'lof_prediction=0')
+   annotate_misses(tmpdir, cache, 'A')
+   cache['db'].close()
+   ## another gvanno run holds the write lock: lookups still succeed (write-ahead log), writes are skipped
+   other_run = sqlite3.connect(cache_db)
+   other_run.execute('BEGIN IMMEDIATE')
+   cache = gvanno_cache.open_annotation_cache(cache_db, 'grch37', 'v1', 'lof_prediction=0', timeout = 0.1)
+   out_vcf, num_misses = annotate_misses(tmpdir, cache, 'B')
+   assert num_misses == 1
+   assert read_records(out_vcf)[1:] == [line for line in annotated_lines('A')[len(annotated_header) + 1:]]
+   gvanno_cache.evict_annotations(cache, 0)
+   other_run.rollback()
+   other_run.close()
+   assert gvanno_cache.lookup_annotation(cache, '1', 1000, 'A', 'G') == 'SYMBOL=A1000'
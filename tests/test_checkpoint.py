@@ -0,0 +1,84 @@
+import logging
+import os
+
+import gvanno
+
+logger = logging.getLogger('test-checkpoint')
+
+stages = [{'name': 'validate', 'inputs': ['/workdir/input_vcf/sample.vcf'], 'outputs': ['/workdir/output/sample.gvanno_ready.vcf.gz'], 'settings': {'vcf_validation': 1}},
+          {'name': 'vep', 'inputs': ['/workdir/output/sample.gvanno_ready.vcf.gz'], 'outputs': ['/workdir/output/sample.vep.vcf.gz'], 'settings': {'n_vep_forks': 4}},
+          {'name': 'vcf2tsv', 'inputs': ['/workdir/output/sample.vep.vcf.gz'], 'outputs': ['/workdir/output/sample.tsv'], 'settings': {}}]
+
+
+def host_directories(tmpdir):
+   directories = {'input_vcf_dir_host': str(tmpdir.join('input')), 'output_dir_host': str(tmpdir.join('output'))}
+   for directory in directories.values():
+      if not os.path.isdir(directory):
+         os.makedirs(directory)
+   return directories
+
+
+def run_stages(tmpdir, resume, fail_at = None):
+   """
+   Simulates a run: every stage that is not skipped writes its outputs from its inputs, returns the skipped stages
+   """
+   directories = host_directories(tmpdir)
+   checkpoint = gvanno.init_checkpoint(str(tmpdir.join('output', 'manifest.json')), stages, directories, resume, logger)
+   for stage in stages:
+      if stage['name'] == fail_at:
+         break
+      if gvanno.stage_skipped(checkpoint, stage['name'], logger):
+         continue
+      data = ''
+      for fname in stage['inputs']:
+         data = data + open(gvanno.docker_to_host_path(fname, directories)).read()
+      for fname in stage['outputs']:
+         f = open(gvanno.docker_to_host_path(fname, directories), 'w')
+         f.write(stage['name'] + ':' + data)
+         f.close()
+      gvanno.record_stage(checkpoint, stage['name'])
+   return checkpoint['skip']
+
+
+def write_input(tmpdir, content):
+   f = open(os.path.join(host_directories(tmpdir)['input_vcf_dir_host'], 'sample.vcf'), 'w')
+   f.write(content)
+   f.close()
+
+
+def test_resume_skips_valid_stages(tmpdir):
+   write_input(tmpdir, 'variant 1\n')
+   assert run_stages(tmpdir, False) == []
+   assert run_stages(tmpdir, True) == ['validate', 'vep', 'vcf2tsv']
+
+
+def test_resume_after_input_change_reruns_all_stages(tmpdir):
+   ## a failed run leaves the gvanno-ready and VEP output behind, the input VCF is then fixed
+   write_input(tmpdir, 'variant 1\n')
+   assert run_stages(tmpdir, False, fail_at = 'vcf2tsv') == []
+   write_input(tmpdir, 'variant 2\n')
+   assert run_stages(tmpdir, True) == []
+   assert open(str(tmpdir.join('output', 'sample.tsv'))).read() == 'vcf2tsv:vep:validate:variant 2\n'
+
+
+def test_resume_rejects_stages_run_on_other_upstream_output(tmpdir):
+   ## VEP output recorded for a gvanno-ready VCF that differs from the one recorded by the validate stage
+   write_input(tmpdir, 'variant 1\n')
+   run_stages(tmpdir, False)
+   directories = host_directories(tmpdir)
+   checkpoint = gvanno.init_checkpoint(str(tmpdir.join('output', 'manifest.json')), stages, directories, True, logger)
+   checkpoint['manifest']['stages']['validate']['outputs']['/workdir/output/sample.gvanno_ready.vcf.gz'] = 'other'
+   gvanno.write_manifest(checkpoint)
+   assert run_stages(tmpdir, True) == []
+
+
+def test_resume_with_truncated_manifest(tmpdir):
+   write_input(tmpdir, 'variant 1\n')
+   run_stages(tmpdir, False)
+   manifest_file = str(tmpdir.join('output', 'manifest.json'))
+   data = open(manifest_file).read()
+   f = open(manifest_file, 'w')
+   f.write(data[:len(data) // 2])
+   f.close()
+   assert run_stages(tmpdir, True) == []
+   assert not os.path.exists(manifest_file + '.tmp')
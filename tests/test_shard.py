@@ -0,0 +1,55 @@
+import gzip
+import logging
+import time
+
+import pytest
+
+import gvanno
+import gvanno_shard
+from test_annoutils import header, vcf_records, write_bgzf_vcf
+
+
+def test_failing_shard_stops_other_shards(monkeypatch):
+   def run_annotation_chain(shard_vcf, *args, **kwargs):
+      if shard_vcf == 'failing.vcf.gz':
+         time.sleep(0.5)
+         gvanno.check_subprocess('exit 3')
+      gvanno.check_subprocess('sleep 60')
+      gvanno.check_subprocess('echo never started')
+
+   monkeypatch.setattr(gvanno, 'run_annotation_chain', run_annotation_chain)
+   monkeypatch.setattr(gvanno, 'workflow_stopped', gvanno.threading.Event())
+   start = time.time()
+   with pytest.raises(SystemExit) as e:
+      gvanno.run_annotation_shards(['failing.vcf.gz', 'running.vcf.gz', 'running.vcf.gz'], '', '', '', {}, 'grch37', 'GRCh37', '29', None, logging.getLogger('test'))
+   assert e.value.code == 1
+   assert time.time() - start < 30
+   assert len(gvanno.workflow_processes) == 0
+
+
+def test_shards_completed(monkeypatch):
+   completed = []
+   monkeypatch.setattr(gvanno, 'run_annotation_chain', lambda shard_vcf, *args, **kwargs: completed.append(shard_vcf))
+   gvanno.run_annotation_shards(['a.vcf.gz', 'b.vcf.gz'], '', '', '', {}, 'grch37', 'GRCh37', '29', None, logging.getLogger('test'))
+   assert sorted(completed) == ['a.vcf.gz', 'b.vcf.gz']
+
+
+@pytest.mark.parametrize('num_shards', [1, 4])
+def test_split_merge_round_trip(tmpdir, num_shards):
+   query_vcf = str(tmpdir.join('sample.gvanno_ready.vcf.gz'))
+   write_bgzf_vcf(query_vcf, vcf_records(9000))
+   gvanno_shard.split_vcf(query_vcf, num_shards)
+   shard_list = [line.rstrip().split('\t') for line in open(str(tmpdir.join('sample.gvanno_ready.shards.tsv')))]
+   assert len(shard_list) == num_shards
+   assert sum([int(shard[1]) for shard in shard_list]) == 9000
+   gvanno_shard.merge_vcf_shards(str(tmpdir.join('merged.vcf')), [shard[0] for shard in shard_list])
+   assert open(str(tmpdir.join('merged.vcf.gz')), 'rb').read() == open(query_vcf, 'rb').read()
+   assert open(str(tmpdir.join('merged.vcf.gz.tbi')), 'rb').read() == open(query_vcf + '.tbi', 'rb').read()
+
+
+def test_split_header_only(tmpdir):
+   query_vcf = str(tmpdir.join('sample.gvanno_ready.vcf.gz'))
+   write_bgzf_vcf(query_vcf, [])
+   gvanno_shard.split_vcf(query_vcf, 4)
+   assert open(str(tmpdir.join('sample.gvanno_ready.shards.tsv'))).read() == ''
+   assert gzip.open(query_vcf, 'rt').read() == header
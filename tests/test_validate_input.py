@@ -0,0 +1,71 @@
+import gzip
+import logging
+import os
+import random
+
+from cyvcf2 import VCF
+
+import gvanno_validate_input
+
+logger = logging.getLogger('test')
+header = ['##fileformat=VCFv4.2\n', '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n', '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">\n',
+   '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n', '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n',
+   '##contig=<ID=1>\n', '##contig=<ID=2>\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n']
+
+
+def normalize(tmpdir, records, sort_buffer_size = 1000000):
+   output_vcf = str(tmpdir.join('sample.gvanno_ready.vcf.gz'))
+   num_decomposed = gvanno_validate_input.normalize_vcf(iter(header + records), output_vcf, {}, logger, sort_buffer_size)
+   lines = gzip.open(output_vcf, 'rt').readlines()
+   return (output_vcf, num_decomposed, [l for l in lines if l.startswith('#')], [l for l in lines if not l.startswith('#')])
+
+
+def test_old_multiallelic_header_only_if_decomposed(tmpdir):
+   records = ['1\t100\t.\tA\tC\t50\tPASS\tDP=10;AF=0.1\tGT:AD\t0/1:5,3\n', 'chr2\t200\t.\tG\tT\t50\tPASS\tDP=12;AF=0.2\tGT:AD\t0/1:6,6\n']
+   (output_vcf, num_decomposed, header_lines, record_lines) = normalize(tmpdir, records)
+   assert num_decomposed == 0
+   assert header_lines == header
+   assert record_lines == [records[0], records[1][3:]]
+
+   records.append('2\t300\t.\tA\tC,T\t50\tPASS\tDP=10;AF=0.1,0.2\tGT:AD\t1/2:5,3,4\n')
+   (output_vcf, num_decomposed, header_lines, record_lines) = normalize(tmpdir, records)
+   assert num_decomposed == 1
+   assert header_lines[-2].startswith('##INFO=<ID=OLD_MULTIALLELIC,')
+   assert header_lines[:-2] + header_lines[-1:] == header
+   assert len(record_lines) == 4
+   ## the tabix index of the record stream is shifted past the header
+   assert [str(rec.POS) + rec.ALT[0] for rec in VCF(output_vcf)('2:250-300')] == ['300C', '300T']
+
+
+def test_decompose_multiallelic_record():
+   ## example (and output) of vt decompose -s, https://genome.sph.umich.edu/wiki/Vt#Decompose
+   header_numbers = {'INFO': {'AF': 'A', 'DP': '1'}, 'FORMAT': {'GT': '1', 'DP': '1', 'PL': 'G'}}
+   record = '1\t3759889\t.\tTA\tTAA,TAAA,T\t.\tPASS\tAF=0.342,0.173,0.037\tGT:DP:PL\t1/2:81:281,5,9,58,0,115,338,46,116,809\n'
+   assert gvanno_validate_input.decompose_multiallelic_record(record, header_numbers) == [
+      '1\t3759889\t.\tTA\tTAA\t.\tPASS\tAF=0.342;OLD_MULTIALLELIC=1:3759889:TA/TAA/TAAA/T\tGT:DP:PL\t1/.:81:281,5,9\n',
+      '1\t3759889\t.\tTA\tTAAA\t.\tPASS\tAF=0.173;OLD_MULTIALLELIC=1:3759889:TA/TAA/TAAA/T\tGT:DP:PL\t./1:81:281,58,115\n',
+      '1\t3759889\t.\tTA\tT\t.\tPASS\tAF=0.037;OLD_MULTIALLELIC=1:3759889:TA/TAA/TAAA/T\tGT:DP:PL\t./.:81:281,338,809\n']
+   ## Number=R values, phased genotypes, flags and missing values
+   header_numbers = {'INFO': {'AC': 'A', 'DB': '0'}, 'FORMAT': {'GT': '1', 'AD': 'R'}}
+   record = '2\t100\trs1\tA\tC,G\t50\tPASS\tAC=1,.;DB\tGT:AD\t0|2:5,3,4\t.:.\n'
+   assert gvanno_validate_input.decompose_multiallelic_record(record, header_numbers) == [
+      '2\t100\trs1\tA\tC\t50\tPASS\tAC=1;DB;OLD_MULTIALLELIC=2:100:A/C/G\tGT:AD\t0|.:5,3\t.:.\n',
+      '2\t100\trs1\tA\tG\t50\tPASS\tAC=.;DB;OLD_MULTIALLELIC=2:100:A/C/G\tGT:AD\t0|1:5,4\t.:.\n']
+
+
+def test_normalize_vcf_external_merge_sort(tmpdir):
+   records = []
+   for chrom in ['1', '2', '10', 'X']:
+      for pos in range(1, 3000, 3):
+         records.append(chrom + '\t' + str(pos) + '\t.\tA\t' + ('C,G' if pos % 7 == 0 else 'C') + '\t50\tPASS\tDP=10;AF=' + ('0.1,0.2' if pos % 7 == 0 else '0.1') + '\tGT:AD\t0/1:5,3' + (',4' if pos % 7 == 0 else '') + '\n')
+   expected_records = []
+   for record in records:
+      expected_records.extend(gvanno_validate_input.decompose_multiallelic_record(record, {'INFO': {'AF': 'A'}, 'FORMAT': {'AD': 'R'}}) if ',' in record.split('\t')[4] else [record])
+   random.seed(4)
+   random.shuffle(records)
+   ## runs of 500 records, sorted by contig (numerically, then X), position and REF/ALT
+   (output_vcf, num_decomposed, header_lines, record_lines) = normalize(tmpdir, records[:1000] + ['chr' + r for r in records[1000:]], sort_buffer_size = 500)
+   assert num_decomposed == len([r for r in records if ',' in r.split('\t')[4]])
+   assert record_lines == expected_records
+   assert sorted(os.listdir(str(tmpdir))) == ['sample.gvanno_ready.vcf.gz', 'sample.gvanno_ready.vcf.gz.tbi']
+   assert len(list(VCF(output_vcf)('10:1000-1999'))) == len([r for r in expected_records if r.startswith('10\t') and 1000 <= int(r.split('\t')[1]) <= 1999])